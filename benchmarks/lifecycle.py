@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# Container lifecycle throughput, checked against lifecycle_baseline.json.
+#
+#   python benchmarks/lifecycle.py                    # fakes in a scratch dir, no root needed
+#   python benchmarks/lifecycle.py --sizes 1,10,1000  # container counts to run
+#   python benchmarks/lifecycle.py --update           # store the numbers as the new baseline
+#   sudo python benchmarks/lifecycle.py --real --image arch
+#
+# The fakes are systemd.FakeBus, mounts.FakeMounter and network.FakeNftables, with every
+# lxns path moved under a scratch directory (tmpfs when /dev/shm exists). Passwords
+# are hashed for real. --real drives systemd, overlayfs and nftables on this host.
+#
+# Numbers only compare on the machine that recorded them, store a baseline from the
+# commit you start from before measuring a change.
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "lifecycle_baseline.json")
+sys.path.insert(0, ROOT)
+
+IMAGE = "bench"
+PASSWORD = "bench"
+# Below these, timer and scheduler noise outweighs a regression
+MIN_COUNT = 10
+MIN_SECONDS = 0.1
+
+
+def relocate(root):
+    # Before anything else from lxns is imported, some modules bind paths at import time
+    from lxns import consts
+
+    for key, value in list(vars(consts).items()):
+        if key.isupper() and isinstance(value, str) and value.startswith("/"):
+            setattr(consts, key, root + value)
+
+
+def use_fakes(root):
+    from lxns import disk
+    from lxns import mounts
+    from lxns import network
+    from lxns import systemd
+
+    systemd.set_manager(systemd.Manager(systemd.FakeBus()))
+    mounts.set_mounter(mounts.FakeMounter(os.path.join(root, "mountinfo")))
+    network.set_forwarder(network.Forwarder(network.FakeNftables()))
+    # A detached purger would see the real paths, the trash is purged between phases instead
+    disk.purge_later = lambda: None
+
+
+def make_image(root):
+    # Just enough of a root filesystem for build to write units and set a password
+    from lxns import images
+
+    rootfs = os.path.join(root, "rootfs")
+    for directory in ("etc", "usr/lib/systemd/system", "var/lib", "root"):
+        os.makedirs(os.path.join(rootfs, directory), exist_ok=True)
+    with open(os.path.join(rootfs, "etc/passwd"), "w") as f:
+        f.write("root:x:0:0:root:/root:/bin/bash\n")
+    with open(os.path.join(rootfs, "etc/shadow"), "w") as f:
+        f.write("root:*:19000:0:99999:7:::\n")
+    os.chmod(os.path.join(rootfs, "etc/shadow"), 0o600)
+    with open(os.path.join(rootfs, "etc/os-release"), "w") as f:
+        f.write("ID=bench\n")
+    images.stage(IMAGE, rootfs)
+
+
+def percentile(values, percent):
+    # Nearest rank on sorted values
+    return values[max(0, -(-len(values) * percent // 100) - 1)]
+
+
+def summarize(total, latencies, count):
+    latencies = sorted(latencies)
+    result = {"count": count, "seconds": round(total, 4),
+              "ops": round(count / total, 2) if total else None}
+    for percent in (50, 90, 99):
+        result[f"p{percent}"] = round(percentile(latencies, percent) * 1000, 2) if latencies else None
+    result["max"] = round(latencies[-1] * 1000, 2) if latencies else None
+    return result
+
+
+def timed(func, items):
+    latencies = []
+    start = time.perf_counter()
+    for item in items:
+        t0 = time.perf_counter()
+        func(item)
+        latencies.append(time.perf_counter() - t0)
+    return time.perf_counter() - start, latencies
+
+
+def run_containers(index, image, names):
+    # One container at a time through the Container API, for per-operation latencies
+    from lxns import disk
+    from lxns.container import Container
+
+    containers = {}
+    results = {}
+
+    def create(name):
+        container = Container(name, image)
+        container.password = PASSWORD
+        container.build()
+        index.add(container)
+        container.finish_build()
+        containers[name] = container
+
+    def destroy(name):
+        containers[name].destroy()
+        index.remove(name)
+
+    for op, func in (("create", create),
+                     ("start", lambda x: containers[x].start(lazy=False)),
+                     ("stop", lambda x: containers[x].stop()),
+                     ("destroy", destroy)):
+        total, latencies = timed(func, names)
+        results[op] = summarize(total, latencies, len(names))
+    total, _ = timed(lambda _: disk.purge(), [None])
+    results["purge"] = summarize(total, [], len(names))
+    return results
+
+
+def run_batch(image, names, jobs):
+    # The whole set at once through entrypoint, the way lxns create a,b,c runs
+    from lxns import disk
+    from lxns import request
+    from lxns.__main__ import entrypoint
+
+    uid_token = request.peer_uid.set(0)
+    password_token = request.password.set(PASSWORD)
+    results = {}
+    try:
+        cli = entrypoint()
+        with contextlib.redirect_stdout(io.StringIO()):
+            total, _ = timed(lambda _: cli.create(tuple(names), image, jobs=jobs), [None])
+            results["create_batch"] = summarize(total, [], len(names))
+            total, _ = timed(lambda _: cli.destroy(*names, jobs=jobs), [None])
+            results["destroy_batch"] = summarize(total, [], len(names))
+        disk.purge()
+    finally:
+        request.password.reset(password_token)
+        request.peer_uid.reset(uid_token)
+    return results
+
+
+def load_baseline():
+    try:
+        with open(BASELINE_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def compare(key, measured, baseline, tolerance):
+    # Throughput may drop and p90 may grow by the tolerance before it counts
+    problems = []
+    if measured["seconds"] >= MIN_SECONDS and baseline.get("ops") and \
+            measured["ops"] < baseline["ops"] / (1 + tolerance):
+        problems.append(f"{key}: {measured['ops']} ops/s, baseline {baseline['ops']}")
+    if measured["count"] >= MIN_COUNT and baseline.get("p90") and measured["p90"] and \
+            measured["p90"] > baseline["p90"] * (1 + tolerance):
+        problems.append(f"{key}: p90 {measured['p90']}ms, baseline {baseline['p90']}ms")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Container lifecycle benchmark for lxns.")
+    parser.add_argument("--sizes", default="1,10,100",
+                        help="comma separated container counts")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="parallel jobs for the batch runs, [lxns] jobs by default")
+    parser.add_argument("--tolerance", type=float, default=0.3,
+                        help="allowed regression against the baseline, 0.3 is 30%%")
+    parser.add_argument("--real", action="store_true",
+                        help="use this host's systemd, mounts and nftables (root only)")
+    parser.add_argument("--image", help="image to build from with --real")
+    parser.add_argument("--update", action="store_true",
+                        help="write the measured numbers to the baseline file")
+    args = parser.parse_args()
+    sizes = [int(x) for x in args.sizes.split(",")]
+
+    if args.real:
+        if os.geteuid() != 0 or not args.image:
+            parser.error("--real needs root and --image")
+        scratch = None
+        image = args.image
+    else:
+        os.environ["LXNS_DIRECT"] = "1"
+        scratch = tempfile.mkdtemp(prefix="lxns-bench-",
+                                   dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+        relocate(scratch)
+        image = IMAGE
+
+    from loguru import logger
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    try:
+        from lxns.index import ContainerIndex
+
+        if not args.real:
+            use_fakes(scratch)
+            make_image(scratch)
+        index = ContainerIndex()
+        measured = {}
+        for size in sizes:
+            names = [f"bench-{size}-{i}" for i in range(size)]
+            for op, result in run_containers(index, image, names).items():
+                measured[f"{op}@{size}"] = result
+            for op, result in run_batch(image, [f"{x}-batch" for x in names], args.jobs).items():
+                measured[f"{op}@{size}"] = result
+        index.close()
+    finally:
+        if scratch is not None:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    mode = "real" if args.real else "fake"
+    baseline = load_baseline().get(mode, {})
+    problems = []
+    print(f"{'operation':<20} {'ops/s':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9} {'baseline':>9}")
+    for key, result in measured.items():
+        cells = ["-" if result[x] is None else result[x] for x in ("ops", "p50", "p90", "p99", "max")]
+        print(f"{key:<20} " + " ".join(f"{x:>9}" for x in cells)
+              + f" {baseline.get(key, {}).get('ops', '-'):>9}")
+        if not args.update and key in baseline:
+            problems.extend(compare(key, result, baseline[key], args.tolerance))
+    for problem in problems:
+        print(f"  regression {problem}")
+
+    if args.update:
+        stored = load_baseline()
+        stored[mode] = measured
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(stored, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline written to {BASELINE_FILE}")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
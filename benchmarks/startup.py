@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# Import-time benchmark for the CLI's startup paths, checked against startup_budget.json.
+#
+#   python benchmarks/startup.py            # measure and compare with the budget
+#   python benchmarks/startup.py --update   # store the current module counts as the budget
+#
+# Only module counts and forbidden imports are checked. Timings are printed for
+# comparing before and after a change on one machine, they don't transfer between hosts.
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+BUDGET_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "startup_budget.json")
+
+# What each CLI path imports before it does any work
+SCENARIOS = {
+    # Every invocation, including the lxnsd client round trip
+    "cli": "import lxns.__main__",
+    # lxns list, served by main()'s fast path
+    "list": "import lxns.__main__, lxns.index, lxns.status",
+    # lxns info, which unpickles one Container
+    "info": "import lxns.__main__, lxns.index, lxns.container",
+}
+
+# Modules the read-only paths must never pull in
+FORBIDDEN = {
+    "cli": ["fire", "prettytable", "slugify", "lxns.container", "lxns.index"],
+    "list": ["fire", "slugify", "lxns.container", "lxns.pool"],
+    "info": ["fire", "prettytable", "slugify", "tarfile", "ctypes", "lxns.images",
+             "lxns.mounts", "lxns.ports", "lxns.pipeline", "lxns.pool", "lxns.supervisor"],
+}
+
+
+def measure(statement, runs):
+    best = None
+    modules = set()
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement],
+                                cwd=ROOT, capture_output=True, text=True, check=True)
+        total = 0
+        modules = set()
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            _, cumulative, name = line.split("|")
+            if not cumulative.strip().isdigit():
+                continue
+            modules.add(name.strip())
+            # Top-level entries carry their children's time already
+            if name.startswith(" ") and not name.startswith("  "):
+                total += int(cumulative)
+        best = total if best is None else min(best, total)
+    return best / 1000, modules
+
+
+def load_budget():
+    try:
+        with open(BUDGET_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time benchmark for lxns startup.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--update", action="store_true",
+                        help="write the measured numbers to the budget file")
+    args = parser.parse_args()
+
+    budget = load_budget()
+    measured = {}
+    failed = False
+    print(f"{'scenario':<8} {'ms':>8} {'modules':>8} {'budget':>8}")
+    for name, statement in SCENARIOS.items():
+        ms, modules = measure(statement, args.runs)
+        measured[name] = {"max_modules": len(modules)}
+        limit = budget.get(name, {})
+        print(f"{name:<8} {ms:>8.1f} {len(modules):>8} {limit.get('max_modules', '-'):>8}")
+        for module in FORBIDDEN[name]:
+            if module in modules:
+                print(f"  {name} imports {module}")
+                failed = True
+        if args.update:
+            continue
+        if "max_modules" in limit and len(modules) > limit["max_modules"]:
+            print(f"  {name} imports {len(modules) - limit['max_modules']} more modules than budgeted")
+            failed = True
+
+    if args.update:
+        with open(BUDGET_FILE, "w") as f:
+            json.dump(measured, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Budget written to {BUDGET_FILE}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,9 @@
 #!/bin/python
-import os
 import click
 import subprocess
 
+from lxns import utils
+
 @click.group()
 def cli():
     pass
@@ -21,13 +22,12 @@ def container():
 @click.argument('workdir')
 @click.argument('mountpoint')
 def overlay_mount(lowerdir, upperdir, workdir, mountpoint):
-    [lower, upper, work, mnt] = map(lambda x: os.path.abspath(x), [lowerdir, upperdir, workdir, mountpoint])
-    subprocess.run(["mount", "-t", "overlay", "overlay", "-o", f"lowerdir={lower},upperdir={upper},workdir={work}", mnt])
+    utils.overlay_mount(lowerdir.split(":"), upperdir, workdir, mountpoint)
 
 @overlay.command("unmount")
 @click.argument('mountpoint')
 def overlay_unmount(mountpoint):
-    subprocess.run(["umount", mountpoint])
+    utils.overlay_unmount(mountpoint)
 
 @container.command("boot")
 @click.argument('rootdir')
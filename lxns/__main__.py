@@ -1,31 +1,31 @@
 #!/bin/python
-import tarfile
-import getpass
 import os
-import pickle
-import shutil
-import subprocess
+import sys
 from functools import wraps
 
-import fire
 from loguru import logger
-from slugify import slugify
-import prettytable
 
+from . import client
 from . import consts
-from . import utils
-from .container import Container
+from . import request
+
+# Everything else is imported where it's used, read-only commands shouldn't pay for
+# fire, prettytable or the container machinery (see benchmarks/startup.py)
 
 # TODO plugin system
 
 # TODO refract init func
 @logger.catch
 def init_all():
+    import subprocess
+
+    from . import bootstrap
+    from . import images
+    from .template import Template
+
     logger.info("Creating dirs...")
-    os.makedirs("containers")
-    os.makedirs("containers/base/arch")
-    os.makedirs("containers/workdirs")
-    os.makedirs("containers/machines")
+    for directory in (consts.IMAGE_DIR, consts.BOOTSTRAP_DIR, consts.CACHE_DIR):
+        os.makedirs(directory, exist_ok=True)
     try:
         os.makedirs("/etc/systemd/nspawn")
     except FileExistsError:
@@ -40,15 +40,36 @@ def init_all():
             f.write("net.ipv4.ip_forward=1")
     subprocess.run(["sysctl", "-p", "/etc/sysctl.d/30-ip-forward.conf"])
     logger.info("Installing OS...")
-    utils.os_install("containers/base/arch", "arch")
-    utils.post_os_install("containers/base/arch")
+    root = bootstrap.bootstrap("arch", "arch")
+    images.stage("arch", root, replace=True)
+    logger.info("Installing idle supervisor and daemon units...")
+    with open(os.path.join(consts.SYSTEMD_UNIT_DIR, "lxns-supervisor.service"), mode="w") as f:
+        f.write(Template().supervisor_service.substitute(python=sys.executable))
+    with open(os.path.join(consts.SYSTEMD_UNIT_DIR, "lxnsd.service"), mode="w") as f:
+        f.write(Template().daemon_service.substitute(python=sys.executable))
     logger.success("Init finished.")
 
 
+def is_root():
+    # Under lxnsd it's the client that counts, not the daemon
+    uid = request.peer_uid.get()
+    if uid is not None:
+        return uid == 0
+    # sudo, or root itself as when systemd runs us from a unit
+    return os.getenv("SUDO_UID") is not None or os.geteuid() == 0
+
+
+def read_password():
+    import getpass
+
+    password = request.password.get()
+    return password if password is not None else getpass.getpass()
+
+
 def root(func):
     @wraps(func)
     def root_func(*args, **kwargs):
-        if os.getenv("SUDO_UID") is None:
+        if not is_root():
             logger.critical("Root required.")
         else:
             return func(*args, **kwargs)
@@ -60,121 +81,665 @@ class entrypoint(object):
     def __init__(self):
         # TODO save/load through plugins
 
-        # Load container list
-        if not os.path.exists(consts.CONTAINER_INDEX):
-            self._containers = []
-        else:
-            with open(consts.CONTAINER_INDEX, "rb") as f:
-                self._containers = pickle.load(f)
-
         # Warn user if not root user
-        if os.getenv("SUDO_UID") is None:
+        readonly = not is_root()
+        if readonly:
             logger.warning("Not root user. Read-only Mode.")
 
+        self._readonly = readonly
+        self._opened = None
+
+    @property
+    def _index(self):
+        # Opened on first use, --help and the like never touch the database
+        if self._opened is None:
+            from .index import ContainerIndex
+            self._opened = ContainerIndex(readonly=self._readonly)
+        return self._opened
+
     def __del__(self):
-        # Save container list
-        if not os.getenv("SUDO_UID") is None:
-            with open(consts.CONTAINER_INDEX, "wb") as f:
-                pickle.dump(self._containers, f, protocol=pickle.HIGHEST_PROTOCOL)
+        if self._opened is not None:
+            self._opened.close()
+
+    def _image_in_use(self, name):
+        # Pooled containers sit on the image's layers too, removing them breaks the pool
+        users = self._index.by_image(name)
+        if users:
+            logger.error("Image is in use.")
+            print("Image is used by the following containers:")
+            print(*users, sep="\n")
+            return True
+        pooled = self._index.pool_count(name)
+        if pooled:
+            logger.error(f"Image has {pooled} pooled container(s), run lxns pool_drain {name} first.")
+            return True
+        return False
+
+    def _select(self, names, select_all):
+        from . import batch
+
+        selected, missing = batch.resolve(names, self._index.names(), select_all)
+        for name in missing:
+            logger.error(f"Container {name} not found.")
+        return [self._index.get(name) for name in selected]
 
     @root
-    def create(self, name, image):
-        if not os.path.exists(os.path.join(consts.IMAGE_DIR, image)):
+    def create(self, name, image, jobs=None, cpu_weight=None, cpu_quota=None,
+               memory_max=None, memory_high=None, io_weight=None, tasks_max=None,
+               bind=None, bind_ro=None, tmpfs=None, cache=None):
+        from . import images
+        from . import limits
+        from . import pool
+        from . import volumes
+        from .container import Container, build_all
+
+        if not images.exists(image):
             logger.error("Image not found.")
             return
-        container = Container(name, image)
-        container.password = getpass.getpass()
-        container.build()
-        self._containers.append(container)
+        try:
+            changes = limits.parse(cpu_weight=cpu_weight, cpu_quota=cpu_quota,
+                                   memory_max=memory_max, memory_high=memory_high,
+                                   io_weight=io_weight, tasks_max=tasks_max)
+        except limits.LimitError as e:
+            logger.error(str(e))
+            return
+        try:
+            spec = volumes.parse(bind=bind, bind_ro=bind_ro, tmpfs=tmpfs, cache=cache)
+            # The image's volumes from the config are checked along with ours
+            volumes.check(volumes.merge(volumes.for_image(image), spec))
+        except volumes.VolumeError as e:
+            logger.error(str(e))
+            return
+        # Fire hands us a tuple for "a,b,c" or "[a,b,c]"
+        names = [name] if isinstance(name, str) else list(dict.fromkeys(name))
+        password = read_password()
+        containers = []
+        rejected = {}
+        pooled = 0
+        for _name in names:
+            try:
+                container = Container(_name, image)
+            except Exception as e:
+                # e.g. a name that's taken, it fails alone and shows up in the report
+                rejected[_name] = e
+                continue
+            # Hand out a pre-built container from the warm pool when there is one
+            warm = pool.take(self._index, image, container.name, password)
+            if warm is not None:
+                if changes:
+                    warm.set_limits(changes)
+                if spec:
+                    warm.set_volumes(spec)
+                self._index.add(warm)
+                logger.success(f"Container {warm.name} taken from the pool.")
+                pooled += 1
+                continue
+            container.password = password
+            container.limits = limits.merge({}, changes)
+            container.volumes = spec
+            containers.append(container)
+        if pooled:
+            pool.refill_async(image)
+        if not containers and not rejected:
+            return
+
+        report = build_all("create", containers, self._index.add, jobs=jobs)
+        report.failures.update(rejected)
+        report.print()
 
     @root
-    def destroy(self, name):
-        container = next(
-            filter(lambda x: x.name == name, self._containers), None)
-        if container:
+    def destroy(self, *names, all=False, jobs=None):
+        from . import batch
+        from . import disk
+        from . import units
+
+        def destroy(container):
             container.destroy()
-            self._containers.remove(container)
-            logger.success("Container destroyed.")
-        else:
+        with units.transaction():
+            report = batch.run("destroy", destroy, self._select(
+                names, all), jobs=jobs, key=lambda x: x.name)
+        for name in report.results:
+            self._index.remove(name)
+        if report.results:
+            # One background purger for the whole batch
+            disk.purge_later()
+        report.print()
+
+    @root
+    def start(self, *names, all=False, lazy=True, jobs=None):
+        from . import batch
+
+        report = batch.run("start", lambda x: x.start(lazy), self._select(
+            names, all), jobs=jobs, key=lambda x: x.name)
+        report.print()
+
+    @root
+    def stop(self, *names, all=False, grace=False, jobs=None):
+        from . import batch
+
+        report = batch.run("stop", lambda x: x.stop(grace), self._select(
+            names, all), jobs=jobs, key=lambda x: x.name)
+        report.print()
+
+    @root
+    def update(self, *names, all=False, jobs=None, cpu_weight=None, cpu_quota=None,
+               memory_max=None, memory_high=None, io_weight=None, tasks_max=None):
+        from . import batch
+        from . import limits
+        from . import units
+
+        # Pass "default" to drop a limit
+        try:
+            changes = limits.parse(cpu_weight=cpu_weight, cpu_quota=cpu_quota,
+                                   memory_max=memory_max, memory_high=memory_high,
+                                   io_weight=io_weight, tasks_max=tasks_max)
+        except limits.LimitError as e:
+            logger.error(str(e))
+            return
+        if not changes:
+            logger.error("Nothing to update.")
+            return
+
+        def update(container):
+            container.set_limits(changes)
+            return container
+        # Drop-ins of every container land with a single daemon-reload
+        with units.transaction():
+            report = batch.run("update", update, self._select(names, all),
+                               jobs=jobs, key=lambda x: x.name)
+        for container in report.results.values():
+            self._index.update(container)
+        report.print()
+
+    def usage(self, *names, all=False, format="table"):
+        from . import status
+
+        if format not in status.FORMATS:
+            logger.error(f"Unknown format {format}, expected one of {', '.join(status.FORMATS)}.")
+            return
+        containers = self._select(names, all or not names)
+        status.FORMATS[format](status.collect_usage([x.name for x in containers]),
+                               status.USAGE_COLUMNS)
+
+    @root
+    def du(self, *names, all=False, images=False, format="table", fresh=False):
+        from . import disk
+        from . import status
+
+        if format not in status.FORMATS:
+            logger.error(f"Unknown format {format}, expected one of {', '.join(status.FORMATS)}.")
+            return
+        if images:
+            status.FORMATS[format](disk.image_usage(self._index, fresh), status.IMAGE_DU_COLUMNS)
+            return
+        summaries = self._index.summaries()
+        if names and not all:
+            missing = set(names) - {x[0] for x in summaries}
+            if missing:
+                logger.error(f"Containers not found: {', '.join(sorted(missing))}.")
+                return
+            summaries = [x for x in summaries if x[0] in names]
+        status.FORMATS[format](disk.container_usage(summaries, fresh), status.DU_COLUMNS)
+
+    @root
+    def gc(self, dry_run=False, min_age=600):
+        # Directories left behind by containers the index no longer knows, and the trash
+        from . import disk
+        from . import utils
+
+        def known():
+            return set(self._index.names()) | {x[0] for x in self._index.pool_summaries()}
+
+        found = disk.orphans(known(), min_age)
+        for name, path in found:
+            print(f"{'Would remove' if dry_run else 'Removing'} {path}")
+            if dry_run:
+                continue
+            with utils.container_lock(name):
+                # Recheck under the lock, a create may have just finished
+                if name not in known():
+                    disk.trash(path)
+        if dry_run:
+            return
+        removed = disk.purge()
+        logger.success(f"Reclaimed {len(found)} orphaned and {removed} trashed director(ies).")
+
+    @root
+    def purge_trash(self):
+        # Spawned in the background by destroy
+        from . import disk
+
+        disk.purge()
+
+    @root
+    def trace_stats(self, *files, format="table"):
+        # Percentiles per span over the given traces, by default every one under TRACE_DIR
+        from . import status
+        from . import trace
+
+        if format not in status.FORMATS:
+            logger.error(f"Unknown format {format}, expected one of {', '.join(status.FORMATS)}.")
+            return
+        files = files or trace.files()
+        if not files:
+            logger.error("No traces found, run a command with --trace first.")
+            return
+        spans = []
+        for path in files:
+            spans.extend(trace.load(path))
+        print(f"{len(spans)} span(s) from {len(files)} trace(s)", file=sys.stderr)
+        status.FORMATS[format](trace.stats(spans), trace.STATS_COLUMNS)
+
+    @root
+    def trace_export(self, file, output=None):
+        # Chrome trace format, for chrome://tracing or ui.perfetto.dev
+        from . import trace
+
+        if output is None:
+            output = f"{os.path.splitext(file)[0]}.json"
+        if not output.endswith(".json"):
+            logger.error("Chrome traces are written to .json files.")
+            return
+        trace.save(trace.load(file), output)
+        print(f"Chrome trace written to {output}")
+
+    def journal(self):
+        import prettytable
+
+        from . import pipeline
+
+        table = prettytable.PrettyTable()
+        table.field_names = ["Operation", "Container", "Done", "Failed At"]
+        for op, name, journal in pipeline.pending():
+            _, steps = journal.read()
+            done = [x for x, (state, _) in steps.items() if state == pipeline.DONE]
+            started = [x for x, (state, _) in steps.items() if state == pipeline.STARTED]
+            table.add_row([op, name, ", ".join(done) or "-", ", ".join(started) or "-"])
+        print(table)
+
+    @root
+    def resume(self, name):
+        from . import disk
+        from . import pipeline
+
+        for op, _name, journal in pipeline.pending():
+            if _name != name:
+                continue
+            container = journal.subject()
+            if op == "build":
+                container.resume_build(journal)
+                self._index.add(container)
+                container.finish_build()
+                logger.success(f"Container {name} built.")
+            else:
+                container.destroy()
+                self._index.remove(name)
+                disk.purge_later()
+                logger.success(f"Container {name} destroyed.")
+            return
+        logger.error(f"No unfinished operation on {name}.")
+
+    @root
+    def rollback(self, name):
+        from . import pipeline
+
+        path = pipeline.journal_path("build", name)
+        if not os.path.exists(path):
+            logger.error(f"No unfinished build of {name}.")
+            return
+        journal = pipeline.Journal(path)
+        journal.subject().rollback_build(journal)
+        logger.success(f"Build of {name} rolled back.")
+
+    @root
+    def pool_fill(self, image=None, watch=False, jobs=None):
+        from . import pool
+
+        targets = [image] if image else pool.configured_images()
+        if watch:
+            pool.watch(self._index, targets, jobs)
+        for target in targets:
+            pool.fill(self._index, target, jobs)
+
+    @root
+    def pool_drain(self, image):
+        from . import pool
+
+        logger.success(
+            f"Destroyed {pool.drain(self._index, image)} pooled container(s).")
+
+    def pool_status(self):
+        import prettytable
+
+        from . import pool
+
+        table = prettytable.PrettyTable()
+        table.field_names = ["Image", "Ready", "Size"]
+        counts = {}
+        for _, image, _ in self._index.pool_summaries():
+            counts[image] = counts.get(image, 0) + 1
+        for image in sorted(set(counts) | set(pool.configured_images())):
+            table.add_row([image, counts.get(image, 0), pool.size(image)])
+        print(table)
+
+    @root
+    def mount(self, name):
+        container = self._index.get(name)
+        if not container:
             logger.error("Container not found.")
+            return
+        # Idempotent, it runs as ExecStartPre on every socket activation
+        container.mount(exist_ok=True)
 
     @root
-    def start(self, name, lazy=True):
-        container = next(
-            filter(lambda x: x.name == name, self._containers), None)
+    def umount(self, name):
+        container = self._index.get(name)
         if container:
-            container.start(lazy)
-            logger.success("Container started.")
+            container.umount()
         else:
             logger.error("Container not found.")
 
     @root
-    def stop(self, name, grace=False):
-        container = next(
-            filter(lambda x: x.name == name, self._containers), None)
+    def net_up(self, name, wait=False):
+        from . import network
+
+        # ExecStartPost of the container service. It hands off to a detached net_up --wait,
+        # the start job shouldn't block on the guest's DHCP lease.
+        if not wait:
+            network.forward_later(name)
+            return
+        container = self._index.get(name)
+        if not container:
+            logger.error("Container not found.")
+            return
+        network.forward(container.name, container.port)
+
+    @root
+    def net_down(self, name):
+        from . import network
+
+        # ExecStopPost of the container service
+        container = self._index.get(name)
+        if not container:
+            logger.error("Container not found.")
+            return
+        network.unforward(container.port)
+
+    @root
+    def supervise(self, once=False):
+        from .supervisor import Supervisor
+
+        supervisor = Supervisor(self._index)
+        if once:
+            supervisor.tick()
+        else:
+            supervisor.run()
+
+    @root
+    def sync_ports(self):
+        from . import ports
+
+        ports.sync()
+
+    @root
+    def clone(self, src, dst):
+        # src is either a container name or name@snapshot
+        name, _, tag = src.partition("@")
+        container = self._index.get(name)
+        if not container:
+            logger.error("Container not found.")
+            return
+        try:
+            clone = container.clone(dst, tag or None)
+        except KeyError as e:
+            logger.error(e.args[0])
+            return
+        self._index.add(clone)
+        logger.success(f"Container cloned to {clone.name}.")
+
+    @root
+    def snapshot(self, name, tag=None, delete=False):
+        container = self._index.get(name)
+        if not container:
+            logger.error("Container not found.")
+            return
+        if delete:
+            if tag is None:
+                logger.error("Snapshot tag required.")
+                return
+            try:
+                container.drop_snapshot(tag)
+            except KeyError as e:
+                logger.error(e.args[0])
+                return
+            logger.success("Snapshot deleted.")
+        else:
+            try:
+                tag = container.snapshot(tag)
+            except KeyError as e:
+                logger.error(e.args[0])
+                return
+            logger.success(f"Snapshot {name}@{tag} created.")
+
+    def snapshots(self, name):
+        container = self._index.get(name)
         if container:
-            container.stop(grace)
-            logger.success("Container stopped.")
+            print(*container.snapshots(), sep="\n")
         else:
             logger.error("Container not found.")
 
+    @root
+    def passwd(self, *names, all=False, generate=False, jobs=None):
+        import secrets
+
+        import prettytable
+
+        from . import batch
+
+        containers = self._select(names, all)
+        if not containers:
+            return
+        if generate:
+            passwords = {x.name: secrets.token_urlsafe(12) for x in containers}
+        else:
+            password = read_password()
+            passwords = {x.name: password for x in containers}
+
+        def change(container):
+            container.password = passwords[container.name]
+            return container
+        report = batch.run("passwd", change, containers,
+                           jobs=jobs, key=lambda x: x.name)
+        for container in report.results.values():
+            self._index.update(container)
+        if generate:
+            table = prettytable.PrettyTable()
+            table.field_names = ["Name", "Password"]
+            for name in sorted(report.results):
+                table.add_row([name, passwords[name]])
+            print(table)
+        report.print()
+
     def info(self, name):
-        container = next(
-            filter(lambda x: x.name == name, self._containers), None)
+        from . import limits
+        from . import volumes
+
+        container = self._index.get(name)
         if container:
             print(f"Name: {container.name}")
             print(f"Password: {container.password}")
             print(f"Port: {container.port}")
+            for key, value in sorted(container.limits.items()):
+                print(f"{limits.PROPERTIES[key]}: {value}")
+            for key, entry in volumes.describe(container.effective_volumes()):
+                print(f"Volume: {key} {entry}")
         else:
             logger.error("Container not found.")
 
     def status(self, name):
-        container = next(
-            filter(lambda x: x.name == name, self._containers), None)
+        import subprocess
+
+        container = self._index.get(name)
         if container:
-            subprocess.run(["machinectl", "status", container.name])
+            result = subprocess.run(["machinectl", "status", "--no-pager", container.name],
+                                    capture_output=True)
+            # Through print so lxnsd can hand it back to the client
+            print(result.stdout.decode("utf-8"), end="")
+            print(result.stderr.decode("utf-8"), end="", file=sys.stderr)
         else:
             logger.error("Container not found.")
 
     @root
-    def stage_image(self, name, tar_file):
+    def stage_image(self, name, tar_file, base=None, templates=None):
+        from slugify import slugify
+
+        from . import images
+        from . import template
+
         _name = name
         name = slugify(name, word_boundary=True, separator="-")
         if name != _name:
             logger.warning(f"Image name changed to {name}.")
-        if os.path.exists(os.path.join(consts.IMAGE_DIR, name)):
+        if images.exists(name):
             logger.error("Image exists.")
             return
-        os.makedirs(os.path.join(consts.IMAGE_DIR, name))
-        print(f"Decompressing {tar_file} to image {name}")
-        with tarfile.open(tar_file) as f:
-            f.extractall(os.path.join(consts.IMAGE_DIR, name))
+        if base is not None and not images.exists(base):
+            logger.error("Base image not found.")
+            return
+        if templates is not None and templates not in template.registry.sets():
+            logger.error(f"Template set {templates} not found.")
+            return
+        if os.path.isdir(tar_file):
+            print(f"Copying {tar_file} to image {name}")
+        else:
+            print(f"Decompressing {tar_file} to image {name}")
+        images.stage(name, tar_file, base, templates)
+        print("Image staged.")
+
+    @root
+    def bootstrap(self, name, distro="arch", mirror=None, packages=None, templates=None,
+                  fresh=False):
+        # Running it again updates the kept root and restages the image from it
+        from slugify import slugify
+
+        from . import bootstrap
+        from . import images
+        from . import template
+
+        _name = name
+        name = slugify(name, word_boundary=True, separator="-")
+        if name != _name:
+            logger.warning(f"Image name changed to {name}.")
+        if distro not in bootstrap.BACKENDS:
+            logger.error(f"Unsupported distro, expected one of {', '.join(sorted(bootstrap.BACKENDS))}.")
+            return
+        if templates is not None and templates not in template.registry.sets():
+            logger.error(f"Template set {templates} not found.")
+            return
+        if images.exists(name) and self._image_in_use(name):
+            return
+        if isinstance(packages, str):
+            packages = packages.replace(",", " ").split()
+        try:
+            root = bootstrap.bootstrap(name, distro, mirror, packages, fresh)
+        except bootstrap.BootstrapError as e:
+            logger.error(f"Bootstrap failed: {e}")
+            return
+        images.stage(name, root, templates=templates, replace=True)
         print("Image staged.")
 
     @root
     def unstage_image(self, name):
-        if not os.path.exists(os.path.join(consts.IMAGE_DIR, name)):
+        from . import images
+
+        if not images.exists(name):
             logger.error("Image doesn't exist.")
             return
-        elif name in map(lambda x: x.image, self._containers):
-            logger.error("Image is in use.")
-            print("Image is used by the following containers:")
-            print(*list(map(lambda x: x.name, filter(
-                lambda x: x.image == name, self._containers))), sep="\n")
+        if self._image_in_use(name):
             return
         print("Deleting image")
-        shutil.rmtree(os.path.join(consts.IMAGE_DIR, name))
+        images.unstage(name)
         print("Image unstaged.")
 
-    def list_containers(self):
+    def list_images(self):
+        import prettytable
+
+        from . import images
+        from . import template
+
         table = prettytable.PrettyTable()
-        table.field_names = ["Name", "Port"]
-        for container in self._containers:
-            table.add_row([container.name, container.port])
+        table.field_names = ["Name", "Layers", "Base", "Templates"]
+        for name in images.list_images():
+            manifest = images.read_manifest(name) or {}
+            table.add_row([name, len(manifest.get("layers", [])) or "-", manifest.get("base") or "-",
+                           template.set_for_image(name)])
         print(table)
 
+    def list(self, format="table"):
+        from . import status
+
+        if format not in status.FORMATS:
+            logger.error(f"Unknown format {format}, expected one of {', '.join(status.FORMATS)}.")
+            return
+        status.FORMATS[format](status.collect(self._index), status.LIST_COLUMNS)
+
+    def list_containers(self, format="table"):
+        self.list(format)
+
+# Read-only commands main() runs without going through fire
+FAST_COMMANDS = {"info", "status", "list", "list_containers"}
+
+
+def _fast_path(argv):
+    # Only the plain forms, anything else (--help, odd flags) goes through fire
+    if not argv or argv[0] not in FAST_COMMANDS:
+        return False
+    command, args = argv[0], argv[1:]
+    if command in ("info", "status"):
+        if len(args) != 1 or args[0].startswith("-"):
+            return False
+        getattr(entrypoint(), command)(args[0])
+        return True
+    if not args:
+        format = "table"
+    elif len(args) == 1 and args[0].startswith("--format="):
+        format = args[0][len("--format="):]
+    elif len(args) == 2 and args[0] == "--format":
+        format = args[1]
+    else:
+        return False
+    getattr(entrypoint(), command)(format)
+    return True
+
+
+def _run(argv):
+    if _fast_path(argv):
+        return
+    import fire
+
+    fire.Fire(entrypoint, command=argv, name="lxns")
+
+
 def main():
-    fire.Fire(entrypoint, name="lxns")
+    argv = sys.argv[1:]
+    # Hand the command to lxnsd when it's running, LXNS_DIRECT forces in-process.
+    # lxnsd strips --trace itself and records there.
+    if not os.getenv("LXNS_DIRECT"):
+        code = client.call(argv)
+        if code is not None:
+            sys.exit(code)
+    if not any(x.startswith("--trace") for x in argv):
+        _run(argv)
+        return
+    from . import trace
+
+    argv, path = trace.parse_flag(argv)
+    trace.start()
+    try:
+        with trace.span(f"lxns {argv[0] if argv else ''}".strip(), "command", argv=argv):
+            _run(argv)
+    finally:
+        trace.finish(path, argv[0] if argv else None)
 
 
 if __name__ == "__main__":
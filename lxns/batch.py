@@ -0,0 +1,83 @@
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import prettytable
+from loguru import logger
+
+from . import config
+from . import consts
+
+
+def resolve(patterns, names, select_all=False):
+    # Expand plain names and glob patterns against the known container names
+    if select_all:
+        return list(names), []
+    names = list(names)
+    known = set(names)
+    selected = []
+    missing = []
+    for pattern in patterns:
+        if any(c in pattern for c in "*?["):
+            matches = fnmatch.filter(names, pattern)
+            if not matches:
+                missing.append(pattern)
+            selected.extend(m for m in matches if m not in selected)
+        elif pattern in known:
+            if pattern not in selected:
+                selected.append(pattern)
+        else:
+            missing.append(pattern)
+    return selected, missing
+
+
+def jobs_or_default(jobs):
+    if jobs is None:
+        jobs = config.getint("lxns", "jobs", fallback=consts.DEFAULT_JOBS)
+    return max(1, int(jobs))
+
+
+class BatchReport(object):
+    def __init__(self, action):
+        self.action = action
+        self.results = {}
+        self.failures = {}
+
+    @property
+    def ok(self):
+        return not self.failures
+
+    def print(self):
+        if not self.failures:
+            logger.success(
+                f"{self.action}: {len(self.results)} container(s) succeeded.")
+            return
+        table = prettytable.PrettyTable()
+        table.field_names = ["Name", "Error"]
+        for name, error in sorted(self.failures.items()):
+            table.add_row([name, f"{type(error).__name__}: {error}"])
+        print(table)
+        logger.error(
+            f"{self.action}: {len(self.results)} succeeded, {len(self.failures)} failed.")
+
+
+def run(action, func, items, jobs=None, key=str):
+    # Run func over items on a bounded pool, collecting per-item results and errors
+    report = BatchReport(action)
+    items = list(items)
+    if len(items) == 1:
+        # No point spinning up a pool for a single target
+        item = items[0]
+        try:
+            report.results[key(item)] = func(item)
+        except Exception as e:
+            report.failures[key(item)] = e
+        return report
+    with ThreadPoolExecutor(max_workers=jobs_or_default(jobs)) as pool:
+        futures = {pool.submit(func, item): key(item) for item in items}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                report.results[name] = future.result()
+            except Exception as e:
+                report.failures[name] = e
+    return report
@@ -0,0 +1,207 @@
+import json
+import os
+import shutil
+import tempfile
+
+from loguru import logger
+
+from . import config
+from . import consts
+from . import locks
+from . import trace
+
+
+class BootstrapError(OSError):
+    pass
+
+
+def _run(command, **kwargs):
+    logger.debug(f"Running {' '.join(command)}")
+    result = trace.run(command, **kwargs)
+    if result.returncode != 0:
+        raise BootstrapError(f"{command[0]} exited with status {result.returncode}")
+    return result
+
+
+def _mirror_url(mirror):
+    # A local directory works offline, anything else is used as a URL
+    return f"file://{os.path.abspath(mirror)}" if os.path.isdir(mirror) else mirror
+
+
+class Bootstrapper(object):
+    distro = None
+    default_packages = []
+
+    def __init__(self, cache_dir, mirror=None, packages=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.mirror = mirror
+        self.packages = list(packages) if packages else list(self.default_packages)
+
+    def install(self, root):
+        raise NotImplementedError
+
+    def update(self, root):
+        # Bring an earlier bootstrap up to date instead of reinstalling it
+        raise NotImplementedError
+
+    def configure(self, root):
+        # Idempotent, runs after installs and updates alike
+        wants = os.path.join(root, "etc/systemd/system/multi-user.target.wants")
+        os.makedirs(wants, exist_ok=True)
+        link = os.path.join(wants, "systemd-networkd.service")
+        if not os.path.lexists(link):
+            os.symlink("/usr/lib/systemd/system/systemd-networkd.service", link)
+        securetty = os.path.join(root, "etc/securetty")
+        if os.path.exists(securetty):
+            _append_once(securetty, "pts/0")
+        sshd_config = os.path.join(root, "etc/ssh/sshd_config")
+        if os.path.exists(sshd_config):
+            _append_once(sshd_config, "PermitRootLogin yes")
+
+
+def _append_once(path, line):
+    with open(path) as f:
+        if line in f.read().splitlines():
+            return
+    with open(path, mode="a") as f:
+        f.write(f"\n{line}\n")
+
+
+class Pacstrap(Bootstrapper):
+    distro = "arch"
+    default_packages = ["base", "base-devel", "openssh"]
+
+    def _pacman_conf(self, directory):
+        path = os.path.join(directory, "pacman.conf")
+        if self.mirror:
+            server = f"Server = {_mirror_url(self.mirror)}/$repo/os/$arch"
+        else:
+            server = "Include = /etc/pacman.d/mirrorlist"
+        with open(path, mode="w") as f:
+            f.write("[options]\nArchitecture = auto\nSigLevel = Required DatabaseOptional\n"
+                    f"CacheDir = {self.cache_dir}\n")
+            for repo in ("core", "extra"):
+                f.write(f"[{repo}]\n{server}\n")
+        return path
+
+    def install(self, root):
+        with tempfile.TemporaryDirectory() as directory:
+            _run(["pacstrap", "-C", self._pacman_conf(directory), root, *self.packages,
+                  "--cachedir", self.cache_dir, "--ignore", "linux,linux-firmware", "--noconfirm"])
+        # From the filesystem package, whatever the package list is
+        if not os.path.exists(os.path.join(root, "etc/os-release")):
+            raise BootstrapError("OS installation failed")
+
+    def update(self, root):
+        with tempfile.TemporaryDirectory() as directory:
+            _run(["pacman", "--config", self._pacman_conf(directory), "--root", root,
+                  "--dbpath", os.path.join(root, "var/lib/pacman"), "--cachedir", self.cache_dir,
+                  "-Syu", "--needed", "--noconfirm", *self.packages,
+                  "--ignore", "linux,linux-firmware"])
+
+
+class Debootstrap(Bootstrapper):
+    distro = "debian"
+    default_packages = ["openssh-server", "systemd-sysv", "dbus", "sudo"]
+    DEFAULT_MIRROR = "http://deb.debian.org/debian"
+
+    def __init__(self, cache_dir, mirror=None, packages=None):
+        super().__init__(cache_dir, mirror, packages)
+        self.suite = config.get("bootstrap:debian", "suite", fallback="stable")
+
+    def install(self, root):
+        _run(["debootstrap", f"--cache-dir={self.cache_dir}", f"--include={','.join(self.packages)}",
+              self.suite, root, _mirror_url(self.mirror or self.DEFAULT_MIRROR)])
+
+    def update(self, root):
+        # apt inside the guest, with our cache standing in for its archive dir
+        script = ("apt-get update && apt-get -y dist-upgrade && "
+                  f"apt-get -y install {' '.join(self.packages)} && apt-get -y autoremove")
+        extra = []
+        if self.mirror and os.path.isdir(self.mirror):
+            extra = [f"--bind-ro={os.path.abspath(self.mirror)}"]
+        _run(["systemd-nspawn", "-q", "-D", root, f"--bind={self.cache_dir}:/var/cache/apt/archives",
+              *extra, "sh", "-c", script])
+
+
+class Dnf(Bootstrapper):
+    distro = "fedora"
+    default_packages = ["systemd", "passwd", "dnf", "fedora-release", "openssh-server", "sudo",
+                        "iproute"]
+
+    def __init__(self, cache_dir, mirror=None, packages=None):
+        super().__init__(cache_dir, mirror, packages)
+        self.release = config.get("bootstrap:fedora", "release", fallback=None)
+
+    def _dnf(self, root, *args):
+        command = ["dnf", "-y", f"--installroot={root}", f"--setopt=cachedir={self.cache_dir}",
+                   "--setopt=keepcache=True"]
+        if self.release:
+            command.append(f"--releasever={self.release}")
+        if self.mirror:
+            command += ["--disablerepo=*", f"--repofrompath=lxns,{_mirror_url(self.mirror)}",
+                        "--enablerepo=lxns"]
+        _run(command + list(args))
+
+    def install(self, root):
+        self._dnf(root, "install", *self.packages)
+
+    def update(self, root):
+        self._dnf(root, "upgrade")
+        self._dnf(root, "install", *self.packages)
+
+
+BACKENDS = {x.distro: x for x in (Pacstrap, Debootstrap, Dnf)}
+
+
+def get(distro, mirror=None, packages=None):
+    if distro not in BACKENDS:
+        raise BootstrapError(
+            f"Unsupported distro {distro}, expected one of {', '.join(sorted(BACKENDS))}.")
+    section = f"bootstrap:{distro}"
+    cache_dir = os.path.join(
+        config.get("bootstrap", "cache_dir", fallback=consts.CACHE_DIR), distro)
+    mirror = mirror or config.get(section, "mirror", fallback=None)
+    if packages is None and config.get(section, "packages"):
+        packages = config.get(section, "packages").split()
+    return BACKENDS[distro](cache_dir, mirror, packages)
+
+
+def _state_path(name):
+    return os.path.join(consts.BOOTSTRAP_DIR, f"{name}.json")
+
+
+def _read_state(name):
+    try:
+        with open(_state_path(name)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def bootstrap(name, distro, mirror=None, packages=None, fresh=False):
+    # Builds or updates the root under BOOTSTRAP_DIR, which stays around for the next run
+    backend = get(distro, mirror, packages)
+    root = os.path.join(consts.BOOTSTRAP_DIR, name)
+    os.makedirs(backend.cache_dir, exist_ok=True)
+    with locks.file_lock(f"bootstrap-{name}"):
+        state = _read_state(name)
+        if not fresh and state is not None and state["distro"] == distro and os.path.isdir(root):
+            logger.info(f"Updating {distro} root {name}...")
+            backend.update(root)
+        else:
+            logger.info(f"Installing {distro} root {name}...")
+            shutil.rmtree(root, ignore_errors=True)
+            os.makedirs(root)
+            try:
+                backend.install(root)
+            except BaseException:
+                # A half-installed root mustn't be mistaken for one to update
+                shutil.rmtree(root, ignore_errors=True)
+                raise
+        backend.configure(root)
+        tmp = f"{_state_path(name)}.tmp"
+        with open(tmp, mode="w") as f:
+            json.dump({"distro": distro, "packages": backend.packages, "mirror": backend.mirror}, f)
+        os.replace(tmp, _state_path(name))
+    return root
@@ -0,0 +1,138 @@
+import os
+import string
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+_UNIT_SAFE = set(string.ascii_letters + string.digits + ":_.")
+
+
+def escape(name):
+    # systemd-escape semantics, as used for machine-<name>.scope
+    escaped = []
+    for i, c in enumerate(name):
+        if c == "/":
+            escaped.append("-")
+        elif c in _UNIT_SAFE and not (i == 0 and c == "."):
+            escaped.append(c)
+        else:
+            escaped.extend(f"\\x{b:02x}" for b in c.encode("utf-8"))
+    return "".join(escaped)
+
+
+def candidates(name):
+    # nspawn registers its own scope, unless it runs with --keep-unit inside our service
+    return [
+        os.path.join(CGROUP_ROOT, "system.slice", f"container_{name}.service"),
+        os.path.join(CGROUP_ROOT, "machine.slice", f"machine-{escape(name)}.scope"),
+    ]
+
+
+def find(name):
+    for path in candidates(name):
+        # A service cgroup without processes is just a leftover of a stopped unit
+        if os.path.isdir(path) and read_int(path, "pids.current", 1) > 0:
+            return path
+    return None
+
+
+def read_int(path, filename, default=None):
+    try:
+        with open(os.path.join(path, filename)) as f:
+            value = f.read().strip()
+    except (FileNotFoundError, ProcessLookupError):
+        return default
+    return None if value == "max" else int(value)
+
+
+def read_keyed(path, filename):
+    result = {}
+    try:
+        with open(os.path.join(path, filename)) as f:
+            for line in f:
+                key, _, value = line.partition(" ")
+                if value:
+                    result[key] = int(value)
+    except FileNotFoundError:
+        pass
+    return result
+
+
+def cpu_usage_usec(path):
+    return read_keyed(path, "cpu.stat").get("usage_usec", 0)
+
+
+def memory_current(path):
+    return read_int(path, "memory.current", 0)
+
+
+def io_bytes(path):
+    # io.stat has one "MAJ:MIN rbytes=.. wbytes=.." line per device
+    read = written = 0
+    try:
+        with open(os.path.join(path, "io.stat")) as f:
+            for line in f:
+                for field in line.split()[1:]:
+                    key, _, value = field.partition("=")
+                    if key == "rbytes":
+                        read += int(value)
+                    elif key == "wbytes":
+                        written += int(value)
+    except FileNotFoundError:
+        pass
+    return read, written
+
+
+def usage(path):
+    cpu = read_keyed(path, "cpu.stat")
+    io_read, io_write = io_bytes(path)
+    return {
+        "memory": read_int(path, "memory.current", 0),
+        "memory_peak": read_int(path, "memory.peak"),
+        "memory_max": read_int(path, "memory.max"),
+        "cpu": cpu.get("usage_usec", 0) / 1e6,
+        "cpu_throttled": cpu.get("throttled_usec", 0) / 1e6,
+        "io_read": io_read,
+        "io_write": io_write,
+        "tasks": read_int(path, "pids.current", 0),
+        "tasks_max": read_int(path, "pids.max"),
+    }
+
+
+_boot_time = None
+
+
+def _started_at(pid):
+    # /proc/<pid>/stat field 22 is the start time in clock ticks since boot. The command
+    # name in field 2 may hold spaces, so split after its closing parenthesis.
+    global _boot_time
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            ticks = int(f.read().rpartition(")")[2].split()[19])
+        if _boot_time is None:
+            with open("/proc/stat") as f:
+                _boot_time = next(int(x.split()[1]) for x in f if x.startswith("btime "))
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    return _boot_time + ticks / os.sysconf("SC_CLK_TCK")
+
+
+def started(path):
+    # When the oldest process of the cgroup tree started, what machined reports as the
+    # machine's Timestamp. Delegated units keep their processes in child cgroups, so
+    # look level by level until one has any.
+    level = [path]
+    while level:
+        times = []
+        for directory in level:
+            try:
+                with open(os.path.join(directory, "cgroup.procs")) as f:
+                    times.extend(_started_at(int(x)) for x in f.read().split())
+            except FileNotFoundError:
+                pass
+        times = [x for x in times if x is not None]
+        if times:
+            return min(times)
+        level = [entry.path for directory in level if os.path.isdir(directory)
+                 for entry in os.scandir(directory) if entry.is_dir(follow_symlinks=False)]
+    return None
+
@@ -0,0 +1,56 @@
+import getpass
+import json
+import os
+import socket
+import sys
+
+from . import consts
+
+# Unit hooks run while a daemon job may be waiting on that very unit, and the
+# long-running loops would hold the daemon's queue forever
+DIRECT_COMMANDS = {"mount", "net_up", "net_down", "supervise", "pool_fill", "purge_trash"}
+
+
+def _wants_password(argv):
+    if not argv or "--help" in argv or "-h" in argv:
+        return False
+    if argv[0] == "create":
+        return True
+    return argv[0] == "passwd" and not any(x.startswith("--generate") for x in argv)
+
+
+def _connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def call(argv, path=consts.DAEMON_SOCKET):
+    # Returns the command's exit code, or None when it has to run in this process
+    if argv and (argv[0] in DIRECT_COMMANDS or "-" in argv):
+        return None
+    sock = _connect(path)
+    if sock is None:
+        return None
+    with sock:
+        request = {
+            "argv": argv,
+            "cwd": os.getcwd(),
+            "tty": sys.stderr.isatty(),
+            "password": getpass.getpass() if _wants_password(argv) else None,
+        }
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with sock.makefile("r", encoding="utf-8") as f:
+            for line in f:
+                message = json.loads(line)
+                if "exit" in message:
+                    return message["exit"]
+                stream = sys.stdout if "stdout" in message else sys.stderr
+                stream.write(message.get("stdout", message.get("stderr")))
+                stream.flush()
+    print("lxns: daemon closed the connection.", file=sys.stderr)
+    return 1
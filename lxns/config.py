@@ -0,0 +1,48 @@
+import configparser
+
+from . import consts
+
+_config = None
+
+
+def load(path=consts.CONFIG_FILE):
+    global _config
+    _config = configparser.ConfigParser()
+    _config.read(path)
+    return _config
+
+
+def get(section, key, fallback=None):
+    if _config is None:
+        load()
+    return _config.get(section, key, fallback=fallback)
+
+
+def getint(section, key, fallback=None):
+    if _config is None:
+        load()
+    return _config.getint(section, key, fallback=fallback)
+
+
+def getfloat(section, key, fallback=None):
+    if _config is None:
+        load()
+    return _config.getfloat(section, key, fallback=fallback)
+
+
+def getboolean(section, key, fallback=None):
+    if _config is None:
+        load()
+    return _config.getboolean(section, key, fallback=fallback)
+
+
+def section(name):
+    if _config is None:
+        load()
+    return dict(_config[name]) if _config.has_section(name) else {}
+
+
+def sections(prefix=""):
+    if _config is None:
+        load()
+    return [name for name in _config.sections() if name.startswith(prefix)]
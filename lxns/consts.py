@@ -7,11 +7,41 @@ VAR_DIR = "/var/lib/lxns"
 CONTAINER_DIR = os.path.join(BASE_DIR, "containers")
 MACHINE_DIR = os.path.join(CONTAINER_DIR, "machines")
 WORK_DIR = os.path.join(CONTAINER_DIR, "workdirs")
+SNAPSHOT_DIR = os.path.join(CONTAINER_DIR, "snapshots")
+
+# User overrides and extra template sets, searched before the packaged templates
+TEMPLATE_DIR = os.path.join(BASE_DIR, "templates")
 
 IMAGE_DIR = os.path.join(BASE_DIR, "images")
+# Content-addressed image layers and the deduplicated file objects they hardlink
+LAYER_DIR = os.path.join(BASE_DIR, "layers")
+OBJECT_DIR = os.path.join(BASE_DIR, "objects")
 
 SYSTEMD_NSPAWN_DIR = "/etc/systemd/nspawn"
 SYSTEMD_UNIT_DIR = "/etc/systemd/system"
 SYSTEMD_MOUNTPOINT = "/var/lib/machines"
 
+# Legacy whole-file index, migrated into CONTAINER_DB on first use
 CONTAINER_INDEX = os.path.join(VAR_DIR, "containers.pickle")
+CONTAINER_DB = os.path.join(VAR_DIR, "containers.db")
+
+LOCK_DIR = os.path.join(VAR_DIR, "locks")
+# Bootstrapped roots kept for incremental updates, and the package caches they share
+BOOTSTRAP_DIR = os.path.join(VAR_DIR, "bootstrap")
+CACHE_DIR = os.path.join(VAR_DIR, "cache")
+# Step journals of unfinished builds and destroys
+JOURNAL_DIR = os.path.join(VAR_DIR, "journal")
+# Span recordings of commands run with --trace
+TRACE_DIR = os.path.join(VAR_DIR, "traces")
+# Shared cache volumes, one directory per name
+VOLUME_DIR = os.path.join(VAR_DIR, "volumes")
+# Directory sizes computed by lxns du
+DU_CACHE = os.path.join(VAR_DIR, "du.json")
+PORT_MAP = os.path.join(VAR_DIR, "ports.bitmap")
+
+# Unix socket lxnsd serves the CLI on
+DAEMON_SOCKET = "/run/lxns/lxnsd.sock"
+
+CONFIG_FILE = os.path.join(BASE_DIR, "lxns.conf")
+
+DEFAULT_JOBS = 8
@@ -1,24 +1,44 @@
 #!/bin/python
 import os
 import shutil
-import subprocess
+import sys
+import time
 
-from slugify import slugify
+from loguru import logger
 
 from . import consts
-from . import utils
-from .template import Template
+
+# Every other lxns module is imported where it's used. lxns info and list unpickle
+# containers, and shouldn't pay for images, mounts, the pipeline or slugify to do it.
 
 # TODO implement custom containers (as plugins?)
 
 
+def check_tag(tag):
+    # Tags become directory names, hold them to what slugify leaves of container names
+    from slugify import slugify
+
+    tag = str(tag)
+    if not tag or slugify(tag, word_boundary=True, separator='-') != tag:
+        raise KeyError(f"Invalid snapshot tag {tag}, use lowercase letters, digits and dashes.")
+    return tag
+
+
 class Container(object):
+    # Containers indexed before resource limits existed have none. Those indexed before
+    # volumes existed have None and keep what their template used to bind.
+    limits = {}
+    volumes = None
+
     def __init__(self, name, image):
+        from slugify import slugify
+
         self._name = ""
         self._password = ""
         self._created = False
         self.port = -1
         self._image = image
+        self.volumes = {}
         self.name = slugify(name, word_boundary=True, separator='-')
 
     @property
@@ -31,15 +51,18 @@ class Container(object):
 
     @password.setter
     def password(self, value):
+        from . import images
+        from . import utils
+
         if self._created:
-            if not os.path.ismount(os.path.join(consts.SYSTEMD_MOUNTPOINT, self.name)):
-                utils.overlay_mount_with_name(self.name, self._image)
-                utils.change_pass(os.path.join(
-                    consts.SYSTEMD_MOUNTPOINT, self.name), "root", value)
-                utils.overlay_unmount_with_name(self.name)
-            else:
-                utils.change_pass(os.path.join(
-                    consts.SYSTEMD_MOUNTPOINT, self.name), "root", value)
+            with utils.container_lock(self.name):
+                if not utils.is_mounted(os.path.join(consts.SYSTEMD_MOUNTPOINT, self.name)):
+                    # Copy shadow up into the upperdir ourselves instead of mounting the overlay
+                    utils.change_pass(os.path.join(consts.MACHINE_DIR, self.name),
+                                      "root", value, images.lowerdirs(self._image))
+                else:
+                    utils.change_pass(os.path.join(
+                        consts.SYSTEMD_MOUNTPOINT, self.name), "root", value)
         self._password = value
 
     @property
@@ -56,25 +79,27 @@ class Container(object):
         self._name = value
 
     def start(self, lazy=True):
-        if self._created:
+        from . import systemd
+        from . import utils
+
+        if not self._created:
+            raise OSError("Container hasn't been built.")
+        with utils.container_lock(self.name):
             # Mount container if not mounted
-            if not os.path.ismount(os.path.join(consts.SYSTEMD_MOUNTPOINT, self.name)):
+            if not utils.is_mounted(os.path.join(consts.SYSTEMD_MOUNTPOINT, self.name)):
                 utils.overlay_mount_with_name(self.name, self._image)
 
             # Start socket unit
-            subprocess.run(
-                ["systemctl", "start", f"container_{self.name}.socket"])
-            if not lazy:
-                # Start service unit
-                subprocess.run(
-                    ["systemctl", "start", f"container_{self.name}.service"])
-        else:
-            raise OSError("Container hasn't been built.")
+            systemd.get_manager().start_unit(f"container_{self.name}.socket")
+        if not lazy:
+            # Start service unit. Outside the lock, its ExecStartPre takes it to check the mount.
+            systemd.get_manager().start_unit(f"container_{self.name}.service")
 
     def build(self):
+        from . import pipeline
+        from . import utils
+
         # TODO move build func to inherited classes (eg. ArchContainer, DebianContainer)
-        # Init template instance
-        templates = Template()
 
         # Throw out an exception if container already exists
         if self._created:
@@ -83,110 +108,539 @@ class Container(object):
             raise KeyError("Empty name isn't allowed.")
         elif not self._password:
             raise KeyError("Empty password isn't allowed.")
+        if os.path.exists(pipeline.journal_path("build", self.name)):
+            raise OSError(
+                f"Container {self.name} has an unfinished build, resume or roll it back first.")
+
+        # The journal outlives the build, see finish_build
+        with utils.container_lock(self.name):
+            journal = pipeline.Journal.create("build", self.name, self)
+            self._run_build(journal)
+
+    def resume_build(self, journal):
+        from . import template
+        from . import units
+        from . import utils
+        from .template import Template
+
+        with utils.container_lock(self.name), units.transaction() as txn:
+            self._run_build(journal)
+            # host_units may be journaled done while the transaction carrying them never
+            # committed. Rewriting unchanged files costs no reload.
+            self._write_host_units(txn, Template(template.set_for_image(self._image)))
+
+    def finish_build(self):
+        # Once the unit transaction around build has committed and the container is in
+        # the index. Until then lxns resume and rollback can still find it.
+        from . import pipeline
+
+        pipeline.Journal(pipeline.journal_path("build", self.name)).remove()
+
+    def abort_build(self):
+        # Undoes a finished build whose units or index entry never landed
+        from . import pipeline
+
+        self.rollback_build(pipeline.Journal(pipeline.journal_path("build", self.name)))
+        self._created = False
+
+    def rollback_build(self, journal):
+        from . import pipeline
+        from . import utils
+
+        with utils.container_lock(self.name):
+            flow = self._build_pipeline(journal)
+            # Restores the reserved port, so undoing releases the right one
+            for name, (state, result) in journal.read()[1].items():
+                step = flow.steps.get(name)
+                if state == pipeline.DONE and step is not None and step.restore is not None:
+                    step.restore(result)
+            flow.rollback()
+
+    def _run_build(self, journal):
+        from . import pipeline
+        from . import units
+
+        flow = self._build_pipeline(journal)
+        try:
+            # Unit files land with one daemon-reload, possibly batch-wide
+            with units.transaction():
+                flow.run(keep_journal=True)
+        except pipeline.PipelineError:
+            logger.warning(f"Rolling back the build of {self.name}.")
+            try:
+                flow.rollback()
+            except pipeline.PipelineError as e:
+                logger.error(f"{e} Its journal is kept, retry with lxns rollback {self.name}.")
+            raise
+        self._created = True
+
+    def _build_pipeline(self, journal):
+        from . import fscopy
+        from . import pipeline
+        from . import ports
+        from . import template
+        from . import units
+        from . import utils
+        from .template import Template
+
+        templates = Template(template.set_for_image(self._image))
+        upper = os.path.join(consts.MACHINE_DIR, self.name)
+        work = os.path.join(consts.WORK_DIR, self.name)
+        root = os.path.join(consts.SYSTEMD_MOUNTPOINT, self.name)
+
+        def make_dirs():
+            # Create rootfs, overlay workdir and mountpoint
+            if not os.path.isdir(upper):
+                fscopy.make_dir(upper)
+            os.makedirs(work, exist_ok=True)
+            os.makedirs(root, exist_ok=True)
+
+        def remove_dirs():
+            fscopy.remove_tree(upper)
+            shutil.rmtree(work, ignore_errors=True)
+            utils.rmdir(root)
+
+        def allocate_port():
+            # Reserve a port for our new container
+            self.port = ports.allocate()
+            return self.port
+
+        def restore_port(port):
+            self.port = port
+
+        def release_port():
+            ports.release(self.port)
+
+        def write_host_units():
+            with units.transaction() as txn:
+                self._write_host_units(txn, templates)
+
+        def remove_host_units():
+            with units.transaction() as txn:
+                self._remove_host_units(txn)
+
+        def mount():
+            utils.overlay_mount_with_name(self.name, self._image)
+
+        def unmount():
+            utils.overlay_unmount_with_name(self.name)
+
+        def write_guest_units():
+            self._write_guest_units(root, templates)
+
+        def enable_sshd():
+            # What "systemctl enable" would do for the socket, without booting into the guest
+            wants = os.path.join(root, consts.SYSTEMD_UNIT_DIR[1:], "sockets.target.wants")
+            os.makedirs(wants, exist_ok=True)
+            link = os.path.join(wants, "sshd-alter.socket")
+            if not os.path.lexists(link):
+                os.symlink(os.path.join(consts.SYSTEMD_UNIT_DIR, "sshd-alter.socket"), link)
+
+        def set_password():
+            utils.change_pass(root, "root", self._password)
+
+        def make_mountpoints():
+            self._make_mountpoints(root)
+
+        return pipeline.Pipeline(f"build {self.name}", [
+            pipeline.Step("dirs", make_dirs, remove_dirs),
+            pipeline.Step("port", allocate_port, release_port, restore=restore_port),
+            pipeline.Step("host_units", write_host_units, remove_host_units, after=["port"]),
+            pipeline.Step("mount", mount, unmount, after=["dirs"],
+                          check=lambda: utils.is_mounted(root)),
+            pipeline.Step("guest_units", write_guest_units, after=["mount", "port"]),
+            pipeline.Step("sshd", enable_sshd, after=["mount"]),
+            pipeline.Step("password", set_password, after=["mount"]),
+            pipeline.Step("mountpoints", make_mountpoints, after=["mount"]),
+            pipeline.Step("unmount", unmount,
+                          after=["guest_units", "sshd", "password", "mountpoints"]),
+        ], journal)
+
+    def _write_host_units(self, txn, templates):
+        from . import limits
+        from . import volumes
+
+        # Generate essential systemd configs, they're written with a single
+        # daemon-reload when the (possibly batch-wide) transaction commits
+        spec = self.effective_volumes()
+        volumes.prepare(spec)
+        txn.write(os.path.join(consts.SYSTEMD_NSPAWN_DIR, f"{self.name}.nspawn"),
+                  templates.nspawn.substitute(port=self.port) + volumes.render(spec))
+        txn.write(os.path.join(consts.SYSTEMD_UNIT_DIR, f"container_{self.name}.service"),
+                  templates.container_service.substitute(name=self.name, python=sys.executable))
+        txn.write(os.path.join(consts.SYSTEMD_UNIT_DIR, f"container_{self.name}.socket"),
+                  templates.container_socket.substitute(name=self.name, port=self.port))
+        if self.limits:
+            txn.write(self._limits_path(), limits.render(self.limits))
+        else:
+            txn.remove(self._limits_path())
 
-        # Create rootfs, overlay workdir and mountpoint
-        os.makedirs(os.path.join(consts.MACHINE_DIR, self.name))
-        os.makedirs(os.path.join(consts.WORK_DIR, self.name))
-        os.makedirs(os.path.join(consts.SYSTEMD_MOUNTPOINT, self.name))
+    def own_volumes(self):
+        from . import template
+        from . import volumes
 
-        # Assign a free port to our new container
-        self.port = utils.get_free_port()
-        utils.get_free_port()
+        if self.volumes is None:
+            return volumes.legacy(template.set_for_image(self._image))
+        return self.volumes
 
-        # Generate essential systemd configs
-        with open(os.path.join(consts.SYSTEMD_NSPAWN_DIR, f"{self.name}.nspawn"), mode="w") as f:
-            f.write(templates.nspawn.substitute(port=self.port))
-        with open(os.path.join(consts.SYSTEMD_UNIT_DIR, f"container_{self.name}.service"), mode="w") as f:
-            f.write(templates.container_service.substitute(name=self.name))
-        with open(os.path.join(consts.SYSTEMD_UNIT_DIR, f"container_{self.name}.socket"), mode="w") as f:
-            f.write(templates.container_socket.substitute(
-                name=self.name, port=self.port))
+    def effective_volumes(self):
+        from . import volumes
 
-        # Restart systemd daemon to apply changes
-        subprocess.run(["systemctl", "daemon-reload"])
+        # The image's volumes from the config, then the container's own
+        return volumes.merge(volumes.for_image(self._image), self.own_volumes())
 
-        # Mount the container first
-        utils.overlay_mount_with_name(self.name, self._image)
+    def _make_mountpoints(self, rootdir):
+        from . import volumes
 
+        # In the upperdir once, so nspawn doesn't have to create them on every boot and
+        # the shared data behind them is never copied up
+        for guest in volumes.mountpoints(self.effective_volumes()):
+            os.makedirs(os.path.join(rootdir, guest[1:]), exist_ok=True)
+
+    def _limits_path(self):
+        from . import limits
+
+        return os.path.join(consts.SYSTEMD_UNIT_DIR, f"container_{self.name}.service.d",
+                            limits.DROPIN_NAME)
+
+    def _remove_host_units(self, txn):
+        txn.remove(os.path.join(
+            consts.SYSTEMD_NSPAWN_DIR, f"{self.name}.nspawn"))
+        txn.remove(os.path.join(consts.SYSTEMD_UNIT_DIR,
+                                f"container_{self.name}.service"))
+        txn.remove(os.path.join(consts.SYSTEMD_UNIT_DIR,
+                                f"container_{self.name}.socket"))
+        txn.remove(self._limits_path())
+
+    def _write_guest_units(self, rootdir, templates):
         # Write port number to guest os
-        with open(os.path.join(consts.SYSTEMD_MOUNTPOINT, self.name, consts.SYSTEMD_UNIT_DIR[1:], "sshd-alter.socket"), mode="w") as f:
+        unit_dir = os.path.join(rootdir, consts.SYSTEMD_UNIT_DIR[1:])
+        os.makedirs(unit_dir, exist_ok=True)
+        with open(os.path.join(unit_dir, "sshd-alter.socket"), mode="w") as f:
             f.write(templates.sshd_socket.substitute(port=self.port))
-        with open(os.path.join(consts.SYSTEMD_MOUNTPOINT, self.name, consts.SYSTEMD_UNIT_DIR[1:], "sshd-alter@.service"), mode="w") as f:
+        with open(os.path.join(unit_dir, "sshd-alter@.service"), mode="w") as f:
             f.write(templates.sshd_service)
 
-        # Enable sshd unit and socket
-        subprocess.run(["systemd-nspawn", "-D", os.path.join(consts.SYSTEMD_MOUNTPOINT, self.name), "ln", "-s", os.path.join(
-            consts.SYSTEMD_UNIT_DIR, "sshd-alter.socket"), os.path.join(consts.SYSTEMD_UNIT_DIR, "sockets.target.wants")])
-        utils.change_pass(os.path.join(
-            consts.SYSTEMD_MOUNTPOINT, self.name), "root", self._password)
-
-        # Clean up
-        utils.overlay_unmount_with_name(self.name)
-        self._created = True
+    def set_limits(self, changes):
+        from . import cgroup
+        from . import limits
+        from . import systemd
+        from . import units
+        from . import utils
 
-    def destroy(self):
         if not self._created:
             raise KeyError("Container hasn't been built.")
+        with utils.container_lock(self.name):
+            with units.transaction() as txn:
+                self.limits = limits.merge(self.limits, changes)
+                if self.limits:
+                    txn.write(self._limits_path(), limits.render(self.limits))
+                else:
+                    txn.remove(self._limits_path())
+            # The drop-in covers the next boot, a running machine gets them live
+            if cgroup.find(self.name) is not None:
+                systemd.get_manager().set_limits(
+                    f"container_{self.name}.service", changes)
+
+    def set_volumes(self, spec):
+        from . import template
+        from . import units
+        from . import utils
+        from . import volumes
+        from .template import Template
+
+        # Replaces the container's own volumes, they apply from the next boot
+        if not self._created:
+            raise KeyError("Container hasn't been built.")
+        templates = Template(template.set_for_image(self._image))
+        with utils.container_lock(self.name):
+            self.volumes = volumes.merge(spec)
+            with units.transaction() as txn:
+                self._write_host_units(txn, templates)
+            root = os.path.join(consts.SYSTEMD_MOUNTPOINT, self.name)
+            if not utils.is_mounted(root):
+                # Straight into the upperdir, like the password setter
+                root = os.path.join(consts.MACHINE_DIR, self.name)
+            self._make_mountpoints(root)
+
+    def rename(self, name, port=None):
+        from slugify import slugify
+
+        from . import template
+        from . import units
+        from . import utils
+        from .template import Template
 
-        # Shutdown container
-        subprocess.run(["systemctl", "stop", f"container_{self.name}.socket"])
-        subprocess.run(
-            ["systemctl", "stop", f"container_{self.name}.service"])
-
-        # Unmount overlay fs
-        utils.overlay_unmount_with_name(self.name)
+        if not self._created:
+            raise KeyError("Container hasn't been built.")
+        name = slugify(name, word_boundary=True, separator='-')
+        if os.path.exists(os.path.join(consts.MACHINE_DIR, name)):
+            raise OSError(f"Container {name} exists.")
+        templates = Template(template.set_for_image(self._image))
+        with utils.container_lock(self.name), units.transaction() as txn:
+            if utils.is_mounted(os.path.join(consts.SYSTEMD_MOUNTPOINT, self.name)):
+                raise OSError(f"Container {self.name} is mounted.")
+            self._remove_host_units(txn)
+            for base in (consts.MACHINE_DIR, consts.WORK_DIR, consts.SYSTEMD_MOUNTPOINT, consts.SNAPSHOT_DIR):
+                if os.path.exists(os.path.join(base, self.name)):
+                    os.rename(os.path.join(base, self.name),
+                              os.path.join(base, name))
+            self._name = name
+            if port is not None:
+                self.port = port
+            self._write_host_units(txn, templates)
+            self._write_guest_units(os.path.join(
+                consts.MACHINE_DIR, self.name), templates)
+
+    def clone(self, name, snapshot=None):
+        from . import fscopy
+        from . import limits
+        from . import ports
+        from . import template
+        from . import units
+        from . import utils
+        from .template import Template
 
-        # Delete rootfs
-        shutil.rmtree(os.path.join(consts.MACHINE_DIR,
-                                   self.name), ignore_errors=True)
-        shutil.rmtree(os.path.join(consts.WORK_DIR,
-                                   self.name), ignore_errors=True)
+        if not self._created:
+            raise KeyError("Container hasn't been built.")
+        if snapshot:
+            snapshot = check_tag(snapshot)
+            src = os.path.join(consts.SNAPSHOT_DIR, self.name, snapshot)
+            if not os.path.isdir(src):
+                raise KeyError(
+                    f"Snapshot {snapshot} of {self.name} doesn't exist.")
+        else:
+            src = os.path.join(consts.MACHINE_DIR, self.name)
+        templates = Template(template.set_for_image(self._image))
+        container = Container(name, self._image)
+        container._password = self._password
+        container.volumes = self.volumes
+        # _write_host_units renders them into the clone's drop-in
+        container.limits = limits.merge({}, self.limits)
+
+        # Share the source upperdir's extents instead of rebuilding from the image
+        with utils.container_lock(self.name):
+            if not snapshot and utils.is_mounted(os.path.join(consts.SYSTEMD_MOUNTPOINT, self.name)):
+                logger.warning(
+                    f"Container {self.name} is mounted, the clone may be inconsistent.")
+            method = fscopy.copy_tree(src, os.path.join(
+                consts.MACHINE_DIR, container.name))
+        logger.debug(f"Cloned {self.name} to {container.name} via {method}")
+
+        with utils.container_lock(container.name), units.transaction() as txn:
+            try:
+                os.makedirs(os.path.join(consts.WORK_DIR, container.name))
+                os.makedirs(os.path.join(
+                    consts.SYSTEMD_MOUNTPOINT, container.name))
+                container.port = ports.allocate()
+                container._write_host_units(txn, templates)
+                # The guest units were copied up by build, rewrite them in the upperdir directly
+                container._write_guest_units(os.path.join(
+                    consts.MACHINE_DIR, container.name), templates)
+            except BaseException:
+                ports.release(container.port)
+                fscopy.remove_tree(os.path.join(
+                    consts.MACHINE_DIR, container.name))
+                shutil.rmtree(os.path.join(consts.WORK_DIR,
+                                           container.name), ignore_errors=True)
+                utils.rmdir(os.path.join(
+                    consts.SYSTEMD_MOUNTPOINT, container.name))
+                raise
+            container._created = True
+        return container
+
+    def snapshot(self, tag=None):
+        from . import fscopy
+        from . import utils
 
-        # Delete mountpoint
-        utils.rmdir(os.path.join(consts.SYSTEMD_MOUNTPOINT, self.name))
+        if not self._created:
+            raise KeyError("Container hasn't been built.")
+        tag = check_tag(tag or time.strftime("%Y%m%d-%H%M%S"))
+        dest = os.path.join(consts.SNAPSHOT_DIR, self.name, tag)
+        if os.path.exists(dest):
+            raise OSError(f"Snapshot {tag} of {self.name} exists.")
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with utils.container_lock(self.name):
+            if utils.is_mounted(os.path.join(consts.SYSTEMD_MOUNTPOINT, self.name)):
+                logger.warning(
+                    f"Container {self.name} is mounted, the snapshot may be inconsistent.")
+            fscopy.copy_tree(os.path.join(
+                consts.MACHINE_DIR, self.name), dest)
+        return tag
+
+    def snapshots(self):
+        path = os.path.join(consts.SNAPSHOT_DIR, self.name)
+        return sorted(os.listdir(path)) if os.path.isdir(path) else []
+
+    def drop_snapshot(self, tag):
+        from . import fscopy
+
+        tag = check_tag(tag)
+        path = os.path.join(consts.SNAPSHOT_DIR, self.name, tag)
+        if not os.path.isdir(path):
+            raise KeyError(f"Snapshot {tag} of {self.name} doesn't exist.")
+        fscopy.remove_tree(path)
 
-        # Delete systemd configs
-        os.remove(os.path.join(
-            consts.SYSTEMD_NSPAWN_DIR, f"{self.name}.nspawn"))
-        os.remove(os.path.join(consts.SYSTEMD_UNIT_DIR,
-                               f"container_{self.name}.service"))
-        os.remove(os.path.join(consts.SYSTEMD_UNIT_DIR,
-                               f"container_{self.name}.socket"))
+    def destroy(self):
+        # The trees go to the trash, callers purge it once per batch with disk.purge_later
+        from . import pipeline
+        from . import utils
 
-        # Reload systemd daemon to apply changes
-        subprocess.run(["systemctl", "daemon-reload"])
+        if not self._created:
+            raise KeyError("Container hasn't been built.")
 
-        self._created = False
+        with utils.container_lock(self.name):
+            # Pick up where an interrupted destroy stopped
+            path = pipeline.journal_path("destroy", self.name)
+            if os.path.exists(path):
+                journal = pipeline.Journal(path)
+            else:
+                journal = pipeline.Journal.create("destroy", self.name, self)
+            self._destroy_pipeline(journal).run()
+            self._created = False
+
+    def _destroy_pipeline(self, journal):
+        from . import disk
+        from . import network
+        from . import pipeline
+        from . import ports
+        from . import systemd
+        from . import units
+        from . import utils
+
+        upper = os.path.join(consts.MACHINE_DIR, self.name)
+
+        def stop():
+            # Socket first, so a connection can't activate the service again
+            for unit in (f"container_{self.name}.socket", f"container_{self.name}.service"):
+                try:
+                    systemd.get_manager().stop_unit(unit)
+                except systemd.SystemdError as e:
+                    logger.warning(e)
+
+        def unforward():
+            # In case the stop hook didn't get to run
+            try:
+                network.unforward(self.port)
+            except network.NetworkError as e:
+                logger.warning(e)
+
+        def unmount():
+            utils.overlay_unmount_with_name(self.name)
+
+        def remove_upper():
+            # A rename, the tree itself is deleted in the background
+            disk.trash(upper)
+
+        def remove_work():
+            disk.trash(os.path.join(consts.WORK_DIR, self.name))
+
+        def remove_snapshots():
+            # A later container of the same name mustn't inherit them
+            disk.trash(os.path.join(consts.SNAPSHOT_DIR, self.name))
+
+        def remove_mountpoint():
+            utils.rmdir(os.path.join(consts.SYSTEMD_MOUNTPOINT, self.name))
+
+        def remove_host_units():
+            # Applied with one daemon-reload, possibly batch-wide
+            with units.transaction() as txn:
+                self._remove_host_units(txn)
+
+        def release_port():
+            # Hand the port back to the allocator
+            ports.release(self.port)
+
+        return pipeline.Pipeline(f"destroy {self.name}", [
+            pipeline.Step("stop", stop),
+            pipeline.Step("unforward", unforward),
+            pipeline.Step("unmount", unmount, after=["stop"]),
+            pipeline.Step("upper", remove_upper, after=["unmount"]),
+            pipeline.Step("work", remove_work, after=["unmount"]),
+            pipeline.Step("snapshots", remove_snapshots, after=["stop"]),
+            pipeline.Step("mountpoint", remove_mountpoint, after=["unmount"]),
+            pipeline.Step("host_units", remove_host_units, after=["stop"]),
+            pipeline.Step("port", release_port, after=["stop", "unforward"]),
+        ], journal)
+
+    def mount(self, exist_ok=False):
+        from . import utils
 
-    def mount(self):
         if not self._created:
             raise KeyError(f"Container {self.name} doesn't exist.")
-            return
-        if os.path.ismount(os.path.join(consts.SYSTEMD_MOUNTPOINT, self.name)):
-            raise OSError(f"Container {self.name} is mounted.")
-            return
-        utils.overlay_mount_with_name(self.name, self._image)
+        with utils.container_lock(self.name):
+            if utils.is_mounted(os.path.join(consts.SYSTEMD_MOUNTPOINT, self.name)):
+                if exist_ok:
+                    return
+                raise OSError(f"Container {self.name} is mounted.")
+            utils.overlay_mount_with_name(self.name, self._image)
 
     def umount(self):
+        from . import utils
+
         if not self._created:
             raise KeyError(f"Container {self.name} doesn't exist.")
-            return
-        if not os.path.ismount(os.path.join(consts.SYSTEMD_MOUNTPOINT, self.name)):
-            raise OSError(f"Container {self.name} isn't mounted.")
-            return
-        utils.overlay_unmount_with_name(self.name)
+        with utils.container_lock(self.name):
+            if not utils.is_mounted(os.path.join(consts.SYSTEMD_MOUNTPOINT, self.name)):
+                raise OSError(f"Container {self.name} isn't mounted.")
+            utils.overlay_unmount_with_name(self.name)
 
+    def suspend(self):
+        from . import systemd
+        from . import utils
+
+        # Stop the machine but keep its socket armed, the next connection boots it again.
+        # The service's ExecStartPre waits on our lock, so it remounts after we unmount.
+        if not self._created:
+            raise OSError("Container hasn't been built.")
+        with utils.container_lock(self.name):
+            systemd.get_manager().stop_unit(f"container_{self.name}.service")
+            # Umount overlay fs to drop its page cache
+            utils.overlay_unmount_with_name(self.name)
 
     def stop(self, grace=False):
-        if self._created:
+        from . import systemd
+        from . import utils
+
+        if not self._created:
+            raise OSError("Container hasn't been built.")
+        with utils.container_lock(self.name):
             # Stop socket unit
-            subprocess.run(
-                ["systemctl", "stop", f"container_{self.name}.socket"])
+            systemd.get_manager().stop_unit(f"container_{self.name}.socket")
             if not grace:
                 # Stop service unit
-                subprocess.run(
-                    ["systemctl", "stop", f"container_{self.name}.service"])
+                systemd.get_manager().stop_unit(f"container_{self.name}.service")
                 # Umount overlay fs
                 utils.overlay_unmount_with_name(self.name)
-        else:
-            raise OSError("Container hasn't been built.")
+
+
+def build_all(action, containers, add, jobs=None):
+    # Builds containers in parallel under one unit transaction. add(container) records
+    # each built one, only then is its journal dropped. Should writing the units fail,
+    # every container built is rolled back.
+    from . import batch
+    from . import units
+
+    report = batch.BatchReport(action)
+    if not containers:
+        return report
+
+    def build(container):
+        container.build()
+        return container
+    try:
+        # Unit files of every container land with a single daemon-reload
+        with units.transaction():
+            report = batch.run(action, build, containers, jobs=jobs, key=lambda x: x.name)
+    except Exception as e:
+        logger.error(f"{action}: writing the units failed, rolling back: {e}")
+        for container in report.results.values():
+            try:
+                container.abort_build()
+            except Exception as e:
+                logger.error(f"Rolling back {container.name} failed: {e}")
+        raise
+    for container in report.results.values():
+        add(container)
+        container.finish_build()
+    return report
@@ -0,0 +1,203 @@
+import json
+import os
+import queue
+import signal
+import socket
+import struct
+import sys
+import threading
+from contextlib import redirect_stderr, redirect_stdout
+
+import fire
+from loguru import logger
+
+from . import consts
+from . import request
+from . import trace
+
+LOG_FORMAT = "<level>{level: <8}</level> | {message}"
+
+_PEERCRED = struct.Struct("3i")
+
+
+class _Stream(object):
+    # File-like end of one client connection, batch workers may write concurrently
+
+    def __init__(self, conn, key, lock):
+        self._conn = conn
+        self._key = key
+        self._lock = lock
+
+    def write(self, data):
+        if data:
+            message = json.dumps({self._key: data}).encode("utf-8") + b"\n"
+            with self._lock:
+                try:
+                    self._conn.sendall(message)
+                except OSError:
+                    # The client went away, the command still runs to completion
+                    pass
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class _Job(object):
+    def __init__(self, conn, uid, payload):
+        self.conn = conn
+        self.uid = uid
+        self.payload = payload
+        self.done = threading.Event()
+
+
+# What clients other than root may run. Everything else changes state, the daemon turns
+# them away itself rather than trusting each command to be decorated with @root.
+READ_ONLY_COMMANDS = {"list", "list_containers", "list_images", "info", "status", "usage",
+                      "snapshots", "journal", "pool_status"}
+
+
+def _reject(argv, uid):
+    # Fire resolves private members and chains calls on return values, only plain
+    # public commands get through
+    for arg in argv:
+        if arg in ("-", "--") or arg.startswith("_"):
+            return f"Argument {arg} isn't allowed through lxnsd."
+    if not argv or argv[0] in ("--help", "-h"):
+        return None
+    command = argv[0]
+    if command.startswith("-") or command not in _commands():
+        return f"Unknown command {command}."
+    if uid != 0 and command not in READ_ONLY_COMMANDS:
+        return "Root required."
+    return None
+
+
+def _commands():
+    from .__main__ import entrypoint
+
+    return {x for x in dir(entrypoint) if not x.startswith("_")}
+
+
+def _exit_code(e):
+    if e.code is None:
+        return 0
+    return e.code if isinstance(e.code, int) else 1
+
+
+class Daemon(object):
+    def __init__(self, path=consts.DAEMON_SOCKET):
+        self._path = path
+        self._jobs = queue.Queue()
+        self._sock = None
+
+    def _listen(self):
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self._path)
+        # Anyone may connect, root-only commands check the peer's uid
+        os.chmod(self._path, 0o666)
+        self._sock.listen(64)
+
+    def _work(self):
+        # The index is opened here, the only thread running commands
+        from .__main__ import entrypoint
+        component = entrypoint()
+        while True:
+            job = self._jobs.get()
+            try:
+                self._run(component, job)
+            finally:
+                job.done.set()
+
+    def _run(self, component, job):
+        lock = threading.Lock()
+        out = _Stream(job.conn, "stdout", lock)
+        err = _Stream(job.conn, "stderr", lock)
+        uid_token = request.peer_uid.set(job.uid)
+        password_token = request.password.set(job.payload.get("password"))
+        sink = logger.add(err, format=LOG_FORMAT, colorize=bool(job.payload.get("tty")))
+        code = 0
+        argv, trace_path = trace.parse_flag(job.payload["argv"])
+        if trace_path and job.uid != 0:
+            # Written as root, only root picks where
+            logger.warning("--trace=PATH needs root, writing under the trace directory instead.")
+            trace_path = ""
+        try:
+            error = _reject(argv, job.uid)
+            if error is not None:
+                logger.critical(error)
+                raise SystemExit(1)
+            os.chdir(job.payload.get("cwd") or "/")
+            if trace_path is not None:
+                trace.start()
+            with redirect_stdout(out), redirect_stderr(err), \
+                    trace.span(f"lxns {argv[0] if argv else ''}".strip(), "command", argv=argv):
+                fire.Fire(component, command=argv, name="lxns")
+        except SystemExit as e:
+            code = _exit_code(e)
+        except Exception:
+            logger.exception(f"lxns {' '.join(argv)} failed.")
+            code = 1
+        finally:
+            if trace_path is not None:
+                # Written from the client's cwd, a relative --trace=PATH lands where they expect
+                trace.finish(trace_path, argv[0] if argv else None)
+            logger.remove(sink)
+            request.password.reset(password_token)
+            request.peer_uid.reset(uid_token)
+            os.chdir("/")
+        with lock:
+            try:
+                job.conn.sendall(json.dumps({"exit": code}).encode("utf-8") + b"\n")
+            except OSError:
+                pass
+
+    def _handle(self, conn):
+        with conn:
+            uid = _PEERCRED.unpack(conn.getsockopt(
+                socket.SOL_SOCKET, socket.SO_PEERCRED, _PEERCRED.size))[1]
+            with conn.makefile("r", encoding="utf-8") as f:
+                line = f.readline()
+            try:
+                payload = json.loads(line)
+                if not isinstance(payload.get("argv"), list):
+                    raise ValueError("argv missing")
+            except ValueError as e:
+                logger.warning(f"Malformed request from uid {uid}: {e}")
+                return
+            # One command at a time, concurrent clients wait their turn
+            job = _Job(conn, uid, payload)
+            self._jobs.put(job)
+            job.done.wait()
+
+    def serve(self):
+        self._listen()
+        threading.Thread(target=self._work, name="lxnsd-worker", daemon=True).start()
+        logger.info(f"lxnsd listening on {self._path}.")
+        try:
+            while True:
+                conn, _ = self._sock.accept()
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            self._sock.close()
+            if os.path.exists(self._path):
+                os.remove(self._path)
+
+
+def main():
+    if os.geteuid() != 0:
+        logger.critical("lxnsd must run as root.")
+        sys.exit(1)
+    # SIGTERM from systemd unwinds through serve() so the socket gets removed
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    Daemon().serve()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import json
+import os
+import stat
+import subprocess
+import sys
+import time
+
+from loguru import logger
+
+from . import config
+from . import consts
+from . import fscopy
+from . import locks
+from . import mounts
+from . import trace
+
+TRASH = ".trash"
+# Directories holding one entry per container, each with its own trash on the same filesystem
+CONTAINER_BASES = (consts.MACHINE_DIR, consts.WORK_DIR, consts.SNAPSHOT_DIR)
+
+
+def walk(path):
+    # (allocated bytes, inodes) of a tree, hardlinked files counted once
+    total = 0
+    count = 0
+    seen = set()
+    stack = [path]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        with it:
+            for entry in it:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+                    if (st.st_dev, st.st_ino) in seen:
+                        continue
+                    seen.add((st.st_dev, st.st_ino))
+                total += st.st_blocks * 512
+                count += 1
+                if stat.S_ISDIR(st.st_mode):
+                    stack.append(entry.path)
+    return total, count
+
+
+class SizeCache(object):
+    # Walk results kept across runs. An unmounted upperdir and a committed layer can't
+    # change behind our back, anything else is trusted for ttl seconds.
+
+    def __init__(self, path=consts.DU_CACHE, ttl=None):
+        self._path = path
+        self._ttl = config.getint("du", "cache_ttl", fallback=300) if ttl is None else ttl
+        self._entries = None
+        self._dirty = False
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self._path) as f:
+                    self._entries = json.load(f)
+            except (FileNotFoundError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def size(self, path, frozen=False, fresh=False):
+        entries = self._load()
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            entries.pop(path, None)
+            return 0, 0
+        # A directory's ctime moves when it's renamed over or replaced
+        signature = [st.st_ino, st.st_ctime_ns]
+        cached = entries.get(path)
+        if cached is not None and not fresh and cached["signature"] == signature and (
+                frozen or time.time() - cached["time"] < self._ttl):
+            return cached["size"], cached["files"]
+        size, files = walk(path)
+        entries[path] = {"signature": signature, "time": time.time(), "size": size, "files": files}
+        self._dirty = True
+        return size, files
+
+    def save(self):
+        if not self._dirty:
+            return
+        entries = self._load()
+        # Forget trees that went away
+        for path in [x for x in entries if not os.path.exists(x)]:
+            del entries[path]
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        tmp = f"{self._path}.tmp"
+        with open(tmp, mode="w") as f:
+            json.dump(entries, f)
+        os.replace(tmp, self._path)
+        self._dirty = False
+
+
+def container_usage(summaries, fresh=False):
+    cache = SizeCache()
+    mtab = mounts.table.snapshot()
+    rows = []
+    for name, image, _ in summaries:
+        mounted = os.path.join(consts.SYSTEMD_MOUNTPOINT, name) in mtab
+        upper, files = cache.size(os.path.join(consts.MACHINE_DIR, name), frozen=not mounted,
+                                  fresh=fresh)
+        snapshots = 0
+        snapshot_dir = os.path.join(consts.SNAPSHOT_DIR, name)
+        if os.path.isdir(snapshot_dir):
+            for tag in os.listdir(snapshot_dir):
+                snapshots += cache.size(os.path.join(snapshot_dir, tag), frozen=True, fresh=fresh)[0]
+        rows.append({"name": name, "image": image, "upper": upper, "files": files,
+                     "snapshots": snapshots})
+    cache.save()
+    return rows
+
+
+def image_usage(index, fresh=False):
+    # Layers are shared between images derived from one another, a layer's size
+    # counts once per image using it and again under "shared" when others use it too
+    from . import images
+    from . import layers
+
+    cache = SizeCache()
+    manifests = {x: images.read_manifest(x) for x in images.list_images()}
+    users = {}
+    for manifest in manifests.values():
+        for layer_id in (manifest or {}).get("layers", []):
+            users[layer_id] = users.get(layer_id, 0) + 1
+    rows = []
+    for name, manifest in manifests.items():
+        size = shared = 0
+        if manifest is None:
+            size = cache.size(images._legacy_path(name), frozen=True, fresh=fresh)[0]
+        else:
+            for layer_id in manifest["layers"]:
+                layer_size = cache.size(layers.path(layer_id), frozen=True, fresh=fresh)[0]
+                size += layer_size
+                if users[layer_id] > 1:
+                    shared += layer_size
+        rows.append({"name": name, "layers": len(manifest["layers"]) if manifest else None,
+                     "size": size, "shared": shared, "containers": len(index.by_image(name))})
+    cache.save()
+    return rows
+
+
+def _trash_dir(path):
+    return os.path.join(os.path.dirname(path), TRASH)
+
+
+def trash(path):
+    # Rename out of the way now, the actual deletion happens in purge()
+    if not os.path.lexists(path):
+        return
+    directory = _trash_dir(path)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    try:
+        with trace.span("trash", "fs", target=path):
+            os.rename(path, os.path.join(directory, f"{os.path.basename(path)}-{os.urandom(4).hex()}"))
+    except OSError as e:
+        # A tree on another filesystem, e.g. an upperdir mounted in its own right
+        logger.debug(f"Can't move {path} to the trash, deleting in place: {e}")
+        fscopy.remove_tree(path)
+
+
+def _trashed():
+    result = []
+    for base in CONTAINER_BASES:
+        directory = os.path.join(base, TRASH)
+        if os.path.isdir(directory):
+            result.extend(os.path.join(directory, x) for x in os.listdir(directory))
+    return result
+
+
+def purge():
+    # Loops while the trash keeps filling, trash() callers that found the lock held rely on it
+    removed = 0
+    while True:
+        with locks.file_lock("trash"):
+            entries = _trashed()
+            for entry in entries:
+                fscopy.remove_tree(entry)
+            removed += len(entries)
+        # Whatever is left over from this pass couldn't be removed, don't spin on it
+        if not set(_trashed()) - set(entries):
+            return removed
+
+
+def purge_later():
+    # One detached purger at a time, it outlives the CLI process that trashed something
+    try:
+        with locks.file_lock("trash", blocking=False):
+            pass
+    except BlockingIOError:
+        # The running purger looks again after letting go of the lock
+        return
+    subprocess.Popen([sys.executable, "-m", "lxns", "purge_trash"], stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def orphans(known, min_age=600):
+    # Container directories with no container behind them. Young ones may belong to a
+    # build or a pool handover that hasn't reached the index yet.
+    from . import pipeline
+
+    busy = {name for _, name, _ in pipeline.pending()}
+    now = time.time()
+    result = []
+    # Not /var/lib/machines, other tools keep their machines there too
+    for base in CONTAINER_BASES:
+        if not os.path.isdir(base):
+            continue
+        for entry in os.scandir(base):
+            if entry.name.startswith(".") or entry.name in known or entry.name in busy:
+                continue
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            if now - entry.stat(follow_symlinks=False).st_mtime < min_age:
+                continue
+            result.append((entry.name, entry.path))
+    return result
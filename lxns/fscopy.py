@@ -0,0 +1,144 @@
+import errno
+import fcntl
+import os
+import shutil
+import stat
+
+from loguru import logger
+
+from . import mounts
+from . import trace
+
+# ioctl(dest_fd, FICLONE, src_fd) shares all extents of src with dest
+FICLONE = 0x40049409
+
+BTRFS_SUBVOLUME_INODE = 256
+
+
+def is_subvolume(path):
+    return os.lstat(path).st_ino == BTRFS_SUBVOLUME_INODE and mounts.fstype(path) == "btrfs"
+
+
+def make_dir(path):
+    # Upperdirs on btrfs become subvolumes so they can be snapshotted later
+    with trace.span("make dir", "fs", target=path):
+        _make_dir(path)
+
+
+def _make_dir(path):
+    if mounts.fstype(os.path.dirname(path)) == "btrfs" and shutil.which("btrfs"):
+        result = trace.run(["btrfs", "subvolume", "create", path], capture_output=True)
+        if result.returncode == 0:
+            return
+    os.makedirs(path)
+
+
+def remove_tree(path):
+    with trace.span("remove tree", "fs", target=path):
+        _remove_tree(path)
+
+
+def _remove_tree(path):
+    if os.path.isdir(path) and is_subvolume(path) and shutil.which("btrfs"):
+        if trace.run(["btrfs", "subvolume", "delete", path], capture_output=True).returncode == 0:
+            return
+    shutil.rmtree(path, ignore_errors=True)
+
+
+class _TreeCopier(object):
+    def __init__(self):
+        self.reflink = True
+        self.stats = {"reflinked": 0, "copied": 0, "hardlinked": 0}
+        self._inodes = {}
+
+    def _copy_data(self, src, dst, st):
+        with open(src, "rb") as fsrc:
+            fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with open(fd, "wb") as fdst:
+                if self.reflink:
+                    try:
+                        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                        self.stats["reflinked"] += 1
+                        return
+                    except OSError as e:
+                        if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                            raise
+                        # The filesystem can't share extents, stop trying for this tree
+                        self.reflink = False
+                remaining = st.st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                self.stats["copied"] += 1
+
+    def _copy_meta(self, src, dst, st):
+        os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+        if not stat.S_ISLNK(st.st_mode):
+            os.chmod(dst, stat.S_IMODE(st.st_mode))
+        # Overlay keeps opaque-dir and redirect markers in trusted.overlay.* xattrs
+        try:
+            names = os.listxattr(src, follow_symlinks=False)
+        except OSError:
+            names = []
+        for name in names:
+            os.setxattr(dst, name, os.getxattr(src, name, follow_symlinks=False),
+                        follow_symlinks=False)
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+    def copy(self, src, dst):
+        st = os.lstat(src)
+        os.mkdir(dst, 0o700)
+        self._copy_children(src, dst)
+        self._copy_meta(src, dst, st)
+
+    def _copy_children(self, src, dst):
+        with os.scandir(src) as it:
+            entries = list(it)
+        for entry in entries:
+            s = entry.path
+            d = os.path.join(dst, entry.name)
+            st = entry.stat(follow_symlinks=False)
+            if stat.S_ISDIR(st.st_mode):
+                os.mkdir(d, 0o700)
+                self._copy_children(s, d)
+            elif st.st_nlink > 1 and (st.st_dev, st.st_ino) in self._inodes:
+                # Keep hardlinks within the tree hardlinked in the copy
+                os.link(self._inodes[(st.st_dev, st.st_ino)], d)
+                self.stats["hardlinked"] += 1
+                continue
+            elif stat.S_ISREG(st.st_mode):
+                self._copy_data(s, d, st)
+                if st.st_nlink > 1:
+                    self._inodes[(st.st_dev, st.st_ino)] = d
+            elif stat.S_ISLNK(st.st_mode):
+                os.symlink(os.readlink(s), d)
+            else:
+                # Devices, fifos and overlay whiteouts (0/0 char devices)
+                os.mknod(d, st.st_mode, st.st_rdev)
+            self._copy_meta(s, d, st)
+
+
+def copy_tree(src, dst):
+    # Cheapest available copy: btrfs snapshot, then per-file reflinks, then plain copies
+    with trace.span("copy tree", "fs", source=src, target=dst) as span:
+        method = _copy_tree(src, dst)
+        span.set(method=method)
+    return method
+
+
+def _copy_tree(src, dst):
+    if is_subvolume(src) and shutil.which("btrfs"):
+        result = trace.run(["btrfs", "subvolume", "snapshot", src, dst], capture_output=True)
+        if result.returncode == 0:
+            logger.debug(f"Snapshotted subvolume {src} to {dst}")
+            return "snapshot"
+    copier = _TreeCopier()
+    try:
+        copier.copy(src, dst)
+    except BaseException:
+        shutil.rmtree(dst, ignore_errors=True)
+        raise
+    logger.debug(f"Copied {src} to {dst}: {copier.stats}")
+    return "reflink" if copier.reflink else "copy"
@@ -0,0 +1,320 @@
+import bz2
+import gzip
+import json
+import lzma
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+from loguru import logger
+
+from . import consts
+from . import fscopy
+from . import layers
+from . import locks
+from . import trace
+
+CHUNK_SIZE = 1 << 20
+
+MAGIC = [
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x1f\x8b", "gzip"),
+    (b"BZh", "bzip2"),
+]
+
+# Multi-threaded tools first, single-threaded ones as fallback
+DECOMPRESSORS = {
+    "zstd": [["zstd", "-T0", "-dc"]],
+    "xz": [["xz", "-T0", "-dc"]],
+    "gzip": [["pigz", "-dc"], ["gzip", "-dc"]],
+    "bzip2": [["lbzip2", "-dc"], ["pbzip2", "-dc"], ["bzip2", "-dc"]],
+}
+
+TAR_EXTRACT = ["tar", "--numeric-owner", "--xattrs", "--xattrs-include=*",
+               "--acls", "--same-permissions", "--same-owner", "-xf", "-"]
+
+
+class ImageError(OSError):
+    pass
+
+
+class _ProgressReader(object):
+    def __init__(self, f, total=None, head=b""):
+        self._f = f
+        self._head = head
+        self.total = total
+        self.done = 0
+        self._start = time.monotonic()
+        self._last = 0
+        self._finished = False
+
+    def read(self, size=-1):
+        if self._head:
+            data, self._head = self._head, b""
+        else:
+            data = self._f.read(size)
+        self.done += len(data)
+        now = time.monotonic()
+        if now - self._last >= 0.5 or not data:
+            self._last = now
+            self.report(final=not data)
+        return data
+
+    def close(self):
+        if self._f is not sys.stdin.buffer:
+            self._f.close()
+
+    def report(self, final=False):
+        if self._finished:
+            return
+        self._finished = final
+        elapsed = max(time.monotonic() - self._start, 1e-6)
+        rate = self.done / elapsed / (1 << 20)
+        progress = f"{self.done / (1 << 20):.1f} MiB"
+        if self.total:
+            progress += f" / {self.total / (1 << 20):.1f} MiB ({self.done * 100 // self.total}%)"
+        print(f"\r{progress} at {rate:.1f} MiB/s", end="\n" if final else "",
+              file=sys.stderr, flush=True)
+
+
+def _open_source(source):
+    if source == "-":
+        f = sys.stdin.buffer
+        total = None
+    else:
+        f = open(source, "rb")
+        total = os.fstat(f.fileno()).st_size
+    head = f.read(8)
+    codec = next((name for magic, name in MAGIC if head.startswith(magic)), None)
+    return _ProgressReader(f, total, head), codec
+
+
+def _feed(reader, pipe):
+    try:
+        while True:
+            data = reader.read(CHUNK_SIZE)
+            if not data:
+                break
+            pipe.write(data)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+def _python_decompressor(reader, codec):
+    if codec == "gzip":
+        return gzip.GzipFile(fileobj=reader)
+    if codec == "xz":
+        return lzma.LZMAFile(reader)
+    if codec == "bzip2":
+        return bz2.BZ2File(reader)
+    if codec == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImageError("zstd tarballs need the zstd binary or the zstandard module.")
+        return zstandard.ZstdDecompressor().stream_reader(reader)
+    return reader
+
+
+def _apply_xattrs(path, member):
+    for key, value in member.pax_headers.items():
+        if key.startswith("SCHILY.xattr."):
+            os.setxattr(path, key[len("SCHILY.xattr."):],
+                        value.encode("utf-8", "surrogateescape"), follow_symlinks=False)
+
+
+def _python_extract(stream, dest):
+    # Streaming mode, members are extracted as they're read
+    kwargs = {"filter": "fully_trusted"} if hasattr(tarfile, "fully_trusted_filter") else {}
+    with tarfile.open(fileobj=stream, mode="r|") as tar:
+        for member in tar:
+            tar.extract(member, dest, numeric_owner=True, **kwargs)
+            if member.pax_headers:
+                _apply_xattrs(os.path.join(dest, member.name), member)
+
+
+def extract(source, dest):
+    with trace.span("extract", "fs", source=source, target=dest) as span:
+        reader = _extract(source, dest)
+        span.set(bytes=reader.done)
+    return reader
+
+
+def _extract(source, dest):
+    reader, codec = _open_source(source)
+    procs = []
+    feeder = None
+    try:
+        command = next((cmd for cmd in DECOMPRESSORS.get(codec, [])
+                        if shutil.which(cmd[0])), None)
+        if command:
+            logger.debug(f"Decompressing {codec} with {command[0]}")
+            decompressor = subprocess.Popen(
+                command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            procs.append(decompressor)
+            feeder = threading.Thread(target=_feed, args=(
+                reader, decompressor.stdin), daemon=True)
+            feeder.start()
+            stream = decompressor.stdout
+        else:
+            stream = _python_decompressor(reader, codec)
+
+        if shutil.which("tar") is None:
+            _python_extract(stream, dest)
+        elif command:
+            # Let the kernel pipe decompressor output straight into tar
+            procs.append(subprocess.Popen(
+                TAR_EXTRACT + ["-C", dest], stdin=stream))
+            stream.close()
+        else:
+            extractor = subprocess.Popen(
+                TAR_EXTRACT + ["-C", dest], stdin=subprocess.PIPE)
+            procs.append(extractor)
+            _feed(stream, extractor.stdin)
+
+        for proc in reversed(procs):
+            if proc.wait() != 0:
+                raise ImageError(
+                    f"{proc.args[0]} exited with status {proc.returncode}")
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        if feeder is not None:
+            feeder.join()
+        reader.report(final=True)
+        reader.close()
+    return reader
+
+
+def _manifest_path(name):
+    return os.path.join(consts.IMAGE_DIR, f"{name}.json")
+
+
+def read_manifest(name):
+    try:
+        with open(_manifest_path(name)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_manifest(name, manifest):
+    tmp = f"{_manifest_path(name)}.tmp"
+    with open(tmp, mode="w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, _manifest_path(name))
+
+
+def _legacy_path(name):
+    # Images staged before layering are plain extracted rootfs directories
+    return os.path.join(consts.IMAGE_DIR, name)
+
+
+def exists(name):
+    return os.path.exists(_manifest_path(name)) or os.path.isdir(_legacy_path(name))
+
+
+def list_images():
+    if not os.path.isdir(consts.IMAGE_DIR):
+        return []
+    names = set()
+    for entry in os.scandir(consts.IMAGE_DIR):
+        if entry.name.startswith("."):
+            continue
+        if entry.name.endswith(".json"):
+            names.add(entry.name[:-len(".json")])
+        elif entry.is_dir():
+            names.add(entry.name)
+    return sorted(names)
+
+
+def lowerdirs(name):
+    # Overlay wants the topmost layer first
+    manifest = read_manifest(name)
+    if manifest is None:
+        return [_legacy_path(name)]
+    return [layers.path(layer_id) for layer_id in reversed(manifest["layers"])]
+
+
+def _referenced():
+    referenced = set()
+    for name in list_images():
+        manifest = read_manifest(name)
+        if manifest is not None:
+            referenced.update(manifest["layers"])
+    return referenced
+
+
+def stage(name, source, base=None, templates=None, replace=False):
+    # source is a tarball, "-" for stdin, or a root directory such as a bootstrap
+    if exists(name) and not replace:
+        raise ImageError(f"Image {name} exists.")
+    parent_layers = []
+    if base is not None:
+        manifest = read_manifest(base)
+        if manifest is None:
+            raise ImageError(f"Base image {base} isn't a layered image.")
+        parent_layers = manifest["layers"]
+        # Derived images keep their base's template set
+        templates = templates or manifest.get("templates")
+    os.makedirs(consts.IMAGE_DIR, exist_ok=True)
+    os.makedirs(consts.LAYER_DIR, exist_ok=True)
+    # Extract next to the layer store so committing is a rename and objects can be hardlinked
+    tmp = tempfile.mkdtemp(prefix=f".staging-{name}-", dir=consts.LAYER_DIR)
+    try:
+        os.chmod(tmp, 0o755)
+        start = time.monotonic()
+        if source != "-" and os.path.isdir(source):
+            root = os.path.join(tmp, "rootfs")
+            method = fscopy.copy_tree(source, root)
+            size = None
+        else:
+            root = tmp
+            size = extract(source, tmp).done
+        with locks.file_lock("images"):
+            layer_id = layers.commit(
+                root, [layers.path(x) for x in reversed(parent_layers)])
+            manifest = {"layers": parent_layers + [layer_id], "base": base}
+            if templates:
+                manifest["templates"] = templates
+            _write_manifest(name, manifest)
+            if replace:
+                # Layers only the previous version used
+                layers.gc(_referenced())
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    if root != tmp:
+        os.rmdir(tmp)
+    elapsed = time.monotonic() - start
+    if size is None:
+        logger.info(f"Staged {source} in {elapsed:.1f}s ({method}).")
+    else:
+        logger.info(
+            f"Staged {size / (1 << 20):.1f} MiB in {elapsed:.1f}s ({size / max(elapsed, 1e-6) / (1 << 20):.1f} MiB/s).")
+    logger.info(f"Image {name} uses layer {layer_id[:12]}.")
+
+
+def unstage(name):
+    with locks.file_lock("images"):
+        if read_manifest(name) is None:
+            shutil.rmtree(_legacy_path(name))
+            return
+        os.remove(_manifest_path(name))
+        # Reclaim only the layers and objects no remaining image references
+        removed_layers, removed_objects = layers.gc(_referenced())
+    logger.info(
+        f"Reclaimed {removed_layers} layer(s) and {removed_objects} object(s).")
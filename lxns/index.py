@@ -0,0 +1,215 @@
+import os
+import pickle
+import sqlite3
+
+from loguru import logger
+
+from . import consts
+
+
+class ContainerIndex(object):
+    def __init__(self, path=consts.CONTAINER_DB, readonly=False):
+        self._path = path
+        self._readonly = readonly
+        # Pickled rows as last seen in the database, used to skip unchanged writes
+        self._snapshots = {}
+        if readonly:
+            if not os.path.exists(path):
+                if os.path.exists(consts.CONTAINER_INDEX):
+                    logger.warning(
+                        "Container index hasn't been migrated yet. Run lxns as root once.")
+                self._conn = None
+                return
+            self._conn = self._open_readonly(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._conn = sqlite3.connect(
+                path, isolation_level=None, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._init_schema()
+            self._migrate(consts.CONTAINER_INDEX)
+
+    @staticmethod
+    def _open_readonly(path):
+        # A WAL database needs its -shm file even to read. Once root's last connection
+        # has checkpointed and removed it, everything is in the main file and it can
+        # be read as immutable.
+        for query in ("mode=ro", "mode=ro&immutable=1"):
+            conn = None
+            try:
+                conn = sqlite3.connect(
+                    f"file:{path}?{query}", uri=True, isolation_level=None, check_same_thread=False)
+                conn.execute("SELECT 1 FROM containers LIMIT 1").fetchall()
+                return conn
+            except sqlite3.OperationalError as e:
+                if conn is not None:
+                    conn.close()
+                error = e
+        logger.warning(f"Can't read the container index: {error}")
+        return None
+
+    def _init_schema(self):
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS containers (
+                name TEXT PRIMARY KEY,
+                image TEXT NOT NULL,
+                port INTEGER NOT NULL,
+                data BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS containers_image ON containers (image);
+            CREATE INDEX IF NOT EXISTS containers_port ON containers (port);
+            CREATE TABLE IF NOT EXISTS pool (
+                name TEXT PRIMARY KEY,
+                image TEXT NOT NULL,
+                port INTEGER NOT NULL,
+                data BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS pool_image ON pool (image);
+        """)
+
+    def _migrate(self, legacy_path):
+        # Import the old whole-file pickle index once, then move it out of the way
+        if not os.path.exists(legacy_path):
+            return
+        with open(legacy_path, "rb") as f:
+            containers = pickle.load(f)
+        with self.transaction():
+            for container in containers:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO containers (name, image, port, data) VALUES (?, ?, ?, ?)",
+                    (container.name, container.image, container.port, self._dump(container)))
+        os.rename(legacy_path, f"{legacy_path}.migrated")
+        logger.info(
+            f"Migrated {len(containers)} containers from {legacy_path}.")
+
+    @staticmethod
+    def _dump(container):
+        return pickle.dumps(container, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _load(self, name, data):
+        self._snapshots[name] = bytes(data)
+        return pickle.loads(data)
+
+    def transaction(self):
+        return _Transaction(self._conn)
+
+    def get(self, name):
+        if self._conn is None:
+            return None
+        row = self._conn.execute(
+            "SELECT data FROM containers WHERE name = ?", (name,)).fetchone()
+        return self._load(name, row[0]) if row else None
+
+    def __contains__(self, name):
+        if self._conn is None:
+            return False
+        return self._conn.execute(
+            "SELECT 1 FROM containers WHERE name = ?", (name,)).fetchone() is not None
+
+    def __iter__(self):
+        if self._conn is None:
+            return iter(())
+        rows = self._conn.execute(
+            "SELECT name, data FROM containers ORDER BY name").fetchall()
+        return iter([self._load(name, data) for name, data in rows])
+
+    def __len__(self):
+        if self._conn is None:
+            return 0
+        return self._conn.execute("SELECT COUNT(*) FROM containers").fetchone()[0]
+
+    def names(self):
+        if self._conn is None:
+            return []
+        return [row[0] for row in self._conn.execute("SELECT name FROM containers ORDER BY name")]
+
+    def summaries(self):
+        # Cheap (name, image, port) rows that don't need unpickling
+        if self._conn is None:
+            return []
+        return self._conn.execute(
+            "SELECT name, image, port FROM containers ORDER BY name").fetchall()
+
+    def ports(self):
+        if self._conn is None:
+            return []
+        return [row[0] for row in self._conn.execute(
+            "SELECT port FROM containers UNION SELECT port FROM pool")]
+
+    def by_image(self, image):
+        if self._conn is None:
+            return []
+        return [row[0] for row in self._conn.execute(
+            "SELECT name FROM containers WHERE image = ? ORDER BY name", (image,))]
+
+    def add(self, container):
+        data = self._dump(container)
+        self._conn.execute(
+            "INSERT INTO containers (name, image, port, data) VALUES (?, ?, ?, ?)",
+            (container.name, container.image, container.port, data))
+        self._snapshots[container.name] = data
+
+    def update(self, container):
+        # Only touch the row when the container actually changed
+        data = self._dump(container)
+        if self._snapshots.get(container.name) == data:
+            return False
+        self._conn.execute(
+            "UPDATE containers SET image = ?, port = ?, data = ? WHERE name = ?",
+            (container.image, container.port, data, container.name))
+        self._snapshots[container.name] = data
+        return True
+
+    def remove(self, name):
+        self._conn.execute("DELETE FROM containers WHERE name = ?", (name,))
+        self._snapshots.pop(name, None)
+
+    def pool_add(self, container):
+        self._conn.execute(
+            "INSERT INTO pool (name, image, port, data) VALUES (?, ?, ?, ?)",
+            (container.name, container.image, container.port, self._dump(container)))
+
+    def pool_take(self, image):
+        # Claim one pre-built container, other CLI processes can't take the same one
+        with self.transaction():
+            row = self._conn.execute(
+                "SELECT name, data FROM pool WHERE image = ? LIMIT 1", (image,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("DELETE FROM pool WHERE name = ?", (row[0],))
+        return pickle.loads(row[1])
+
+    def pool_count(self, image):
+        if self._conn is None:
+            return 0
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM pool WHERE image = ?", (image,)).fetchone()[0]
+
+    def pool_summaries(self):
+        if self._conn is None:
+            return []
+        return self._conn.execute(
+            "SELECT name, image, port FROM pool ORDER BY image, name").fetchall()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class _Transaction(object):
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __enter__(self):
+        # Take the write lock up front so concurrent CLI calls serialize cleanly
+        self._conn.execute("BEGIN IMMEDIATE")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._conn.execute("COMMIT")
+        else:
+            self._conn.execute("ROLLBACK")
+        return False
@@ -0,0 +1,211 @@
+import errno
+import hashlib
+import json
+import os
+import shutil
+import stat
+
+from loguru import logger
+
+from . import consts
+from . import trace
+
+CHUNK_SIZE = 1 << 20
+
+
+def _walk(root, rel=""):
+    # Depth-first listing of (relative path, lstat) without following symlinks
+    entries = []
+    stack = [rel]
+    while stack:
+        current = stack.pop()
+        with os.scandir(os.path.join(root, current)) as it:
+            for entry in it:
+                path = os.path.join(current, entry.name)
+                st = entry.stat(follow_symlinks=False)
+                entries.append((path, st))
+                if stat.S_ISDIR(st.st_mode):
+                    stack.append(path)
+    return entries
+
+
+def _xattrs(path):
+    try:
+        names = os.listxattr(path, follow_symlinks=False)
+    except OSError:
+        return []
+    return sorted((name, os.getxattr(path, name, follow_symlinks=False)) for name in names)
+
+
+def _meta(path, st):
+    h = hashlib.sha256(
+        f"{stat.S_IMODE(st.st_mode)}:{st.st_uid}:{st.st_gid}\0".encode("utf-8"))
+    for name, value in _xattrs(path):
+        h.update(name.encode("utf-8") + b"\0" + value + b"\0")
+    return h
+
+
+def file_key(path, st):
+    # Content plus ownership, mode and xattrs: hardlinked copies share all of them
+    h = _meta(path, st)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def is_whiteout(st):
+    return stat.S_ISCHR(st.st_mode) and st.st_rdev == 0
+
+
+class _KeyCache(object):
+    def __init__(self):
+        self._keys = {}
+
+    def get(self, path, st):
+        inode = (st.st_dev, st.st_ino)
+        if inode not in self._keys:
+            self._keys[inode] = file_key(path, st)
+        return self._keys[inode]
+
+
+def lookup(lowers, rel):
+    # Topmost entry for rel in a stack of lowerdirs (top first), honoring whiteouts
+    for lower in lowers:
+        path = os.path.join(lower, rel)
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            continue
+        return None if is_whiteout(st) else (path, st)
+    return None
+
+
+def _same(path, st, base_path, base_st, keys):
+    if stat.S_IFMT(st.st_mode) != stat.S_IFMT(base_st.st_mode):
+        return False
+    if (st.st_mode, st.st_uid, st.st_gid) != (base_st.st_mode, base_st.st_uid, base_st.st_gid):
+        return False
+    if stat.S_ISREG(st.st_mode):
+        return st.st_size == base_st.st_size and keys.get(path, st) == keys.get(base_path, base_st)
+    if stat.S_ISLNK(st.st_mode):
+        return os.readlink(path) == os.readlink(base_path)
+    if stat.S_ISDIR(st.st_mode):
+        return _xattrs(path) == _xattrs(base_path)
+    return st.st_rdev == base_st.st_rdev
+
+
+def _diff(root, lowers, keys):
+    # Turn a full rootfs into a layer on top of lowers: whiteout what's gone, drop what's unchanged
+    merged = {}
+    for lower in reversed(lowers):
+        for rel, st in _walk(lower):
+            if is_whiteout(st):
+                merged.pop(rel, None)
+            else:
+                merged[rel] = st
+    for rel in sorted(merged):
+        parent = os.path.dirname(rel)
+        if not os.path.lexists(os.path.join(root, rel)) and (not parent or os.path.isdir(os.path.join(root, parent))) \
+                and not os.path.islink(os.path.join(root, parent)):
+            os.mknod(os.path.join(root, rel), stat.S_IFCHR | 0o000, os.makedev(0, 0))
+
+    entries = _walk(root)
+    # Children come after their parents, so walking backwards empties dirs before they're checked
+    for rel, st in reversed(entries):
+        path = os.path.join(root, rel)
+        if is_whiteout(st):
+            continue
+        base = lookup(lowers, rel)
+        if base is None or not _same(path, st, base[0], base[1], keys):
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            if not os.listdir(path):
+                os.rmdir(path)
+        else:
+            os.remove(path)
+
+
+def _dedupe(root, keys):
+    manifest = []
+    for rel, st in sorted(_walk(root)):
+        path = os.path.join(root, rel)
+        mode = stat.S_IFMT(st.st_mode)
+        if stat.S_ISREG(st.st_mode):
+            key = keys.get(path, st)
+            manifest.append([rel, mode, st.st_mode, st.st_uid, st.st_gid, key])
+            if st.st_size == 0:
+                # Empty files would pile up links on one inode for no gain
+                continue
+            obj = os.path.join(consts.OBJECT_DIR, key[:2], key[2:])
+            try:
+                obj_st = os.lstat(obj)
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(obj), exist_ok=True)
+                os.link(path, obj)
+                continue
+            if obj_st.st_ino == st.st_ino:
+                continue
+            tmp = f"{path}.lxns-dedupe"
+            try:
+                os.link(obj, tmp)
+            except OSError as e:
+                if e.errno in (errno.EMLINK, errno.EXDEV):
+                    continue
+                raise
+            os.replace(tmp, path)
+        elif stat.S_ISLNK(st.st_mode):
+            manifest.append([rel, mode, st.st_mode, st.st_uid, st.st_gid, os.readlink(path)])
+        elif stat.S_ISDIR(st.st_mode):
+            manifest.append([rel, mode, st.st_mode, st.st_uid, st.st_gid,
+                             _meta(path, st).hexdigest()])
+        else:
+            manifest.append([rel, mode, st.st_mode, st.st_uid, st.st_gid, st.st_rdev])
+    return manifest
+
+
+def commit(root, lowers=()):
+    # Convert an extracted tree under LAYER_DIR into a content-addressed layer, returning its id
+    with trace.span("commit layer", "fs", target=root, lowers=len(lowers)):
+        return _commit(root, lowers)
+
+
+def _commit(root, lowers):
+    keys = _KeyCache()
+    if lowers:
+        _diff(root, list(lowers), keys)
+    manifest = _dedupe(root, keys)
+    root_st = os.lstat(root)
+    manifest.append(["", stat.S_IFDIR, root_st.st_mode, root_st.st_uid, root_st.st_gid, ""])
+    layer_id = hashlib.sha256(json.dumps(manifest).encode("utf-8")).hexdigest()
+    dest = path(layer_id)
+    if os.path.exists(dest):
+        logger.info(f"Layer {layer_id[:12]} already exists.")
+        shutil.rmtree(root)
+    else:
+        os.rename(root, dest)
+    return layer_id
+
+
+def path(layer_id):
+    return os.path.join(consts.LAYER_DIR, layer_id)
+
+
+def gc(referenced):
+    # Drop layers no image references, then objects no layer links to anymore
+    referenced = set(referenced)
+    removed_layers = 0
+    removed_objects = 0
+    if os.path.isdir(consts.LAYER_DIR):
+        for entry in os.scandir(consts.LAYER_DIR):
+            if entry.name.startswith(".") or entry.name in referenced:
+                continue
+            shutil.rmtree(entry.path)
+            removed_layers += 1
+    if os.path.isdir(consts.OBJECT_DIR):
+        for bucket in os.scandir(consts.OBJECT_DIR):
+            for entry in os.scandir(bucket.path):
+                if entry.stat(follow_symlinks=False).st_nlink == 1:
+                    os.remove(entry.path)
+                    removed_objects += 1
+    return removed_layers, removed_objects
@@ -0,0 +1,139 @@
+import re
+
+# CLI option -> systemd resource control property
+PROPERTIES = {
+    "cpu_weight": "CPUWeight",
+    "cpu_quota": "CPUQuota",
+    "memory_max": "MemoryMax",
+    "memory_high": "MemoryHigh",
+    "io_weight": "IOWeight",
+    "tasks_max": "TasksMax",
+}
+
+DROPIN_NAME = "50-lxns-limits.conf"
+
+# Resets a previously set limit
+DEFAULT = "default"
+
+UINT64_MAX = 2 ** 64 - 1
+
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+_SIZE = re.compile(r"^(\d+(?:\.\d+)?)([KMGT]?)$", re.IGNORECASE)
+
+
+class LimitError(ValueError):
+    pass
+
+
+def _weight(value):
+    value = int(value)
+    if not 1 <= value <= 10000:
+        raise LimitError(f"Weight {value} isn't in 1-10000.")
+    return value
+
+
+def _quota(value):
+    # Percent of one CPU, 200% means two full cores
+    value = str(value).rstrip("%")
+    percent = float(value)
+    if percent <= 0:
+        raise LimitError(f"CPU quota {value}% must be positive.")
+    return f"{value}%"
+
+
+def _size(value):
+    value = str(value)
+    if value == "infinity":
+        return value
+    if value.endswith("%"):
+        percent = float(value[:-1])
+        if not 0 < percent <= 100:
+            raise LimitError(f"Memory share {value} isn't in (0, 100].")
+        return value
+    match = _SIZE.match(value)
+    if not match:
+        raise LimitError(f"Invalid size {value}.")
+    return str(int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()]))
+
+
+def _count(value):
+    value = str(value)
+    if value == "infinity":
+        return value
+    if int(value) <= 0:
+        raise LimitError(f"Task limit {value} must be positive.")
+    return str(int(value))
+
+
+_PARSERS = {
+    "cpu_weight": _weight,
+    "cpu_quota": _quota,
+    "memory_max": _size,
+    "memory_high": _size,
+    "io_weight": _weight,
+    "tasks_max": _count,
+}
+
+
+def parse(**options):
+    # Normalize CLI values. None means "leave as is", DEFAULT drops the limit.
+    result = {}
+    for key, value in options.items():
+        if key not in PROPERTIES:
+            raise LimitError(f"Unknown limit {key}.")
+        if value is None:
+            continue
+        if value == DEFAULT:
+            result[key] = None
+            continue
+        try:
+            result[key] = str(_PARSERS[key](value))
+        except (TypeError, ValueError) as e:
+            raise LimitError(f"Invalid {key}: {e}") from e
+    return result
+
+
+def merge(current, changes):
+    limits = dict(current)
+    for key, value in changes.items():
+        if value is None:
+            limits.pop(key, None)
+        else:
+            limits[key] = value
+    return limits
+
+
+def render(limits):
+    lines = ["# Generated by lxns, edit with lxns update", "[Service]"]
+    lines.extend(f"{PROPERTIES[key]}={value}" for key, value in sorted(limits.items()))
+    return "\n".join(lines) + "\n"
+
+
+def assignments(limits):
+    # systemctl set-property arguments, reset limits go back to systemd's defaults
+    result = []
+    for key, value in sorted(limits.items()):
+        result.append(f"{PROPERTIES[key]}={'' if value is None else value}")
+    return result
+
+
+def _memory_bytes(value):
+    return UINT64_MAX if value == "infinity" else int(value)
+
+
+def dbus_properties(limits):
+    # (name, (signature, value)) pairs for Manager.SetUnitProperties
+    result = []
+    for key, value in sorted(limits.items()):
+        if key in ("cpu_weight", "io_weight"):
+            result.append((PROPERTIES[key], ("t", UINT64_MAX if value is None else int(value))))
+        elif key == "cpu_quota":
+            usec = UINT64_MAX if value is None else int(float(value.rstrip("%")) * 10000)
+            result.append(("CPUQuotaPerSecUSec", ("t", usec)))
+        elif value is not None and value.endswith("%"):
+            # Relative memory limits go through the scaled variant
+            scale = int(float(value[:-1]) / 100 * 0xffffffff)
+            result.append((f"{PROPERTIES[key]}Scale", ("u", scale)))
+        else:
+            result.append((PROPERTIES[key], ("t", UINT64_MAX if value is None else _memory_bytes(value))))
+    return result
@@ -0,0 +1,18 @@
+import fcntl
+import os
+from contextlib import contextmanager
+
+from . import consts
+
+
+@contextmanager
+def file_lock(name, shared=False, blocking=True):
+    # flock-based lock, held across threads and processes alike. Without blocking,
+    # a lock held elsewhere raises BlockingIOError.
+    os.makedirs(consts.LOCK_DIR, exist_ok=True)
+    with open(os.path.join(consts.LOCK_DIR, f"{name}.lock"), "w") as f:
+        fcntl.flock(f, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
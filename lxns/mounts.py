@@ -0,0 +1,299 @@
+import ctypes
+import ctypes.util
+import errno
+import filecmp
+import itertools
+import os
+import select
+import shutil
+import tempfile
+import threading
+from collections import namedtuple
+
+from . import config
+from . import trace
+
+MNT_DETACH = 2
+
+# Syscall numbers of the new mount API are shared by all mainstream architectures
+SYS_MOVE_MOUNT = 429
+SYS_FSOPEN = 430
+SYS_FSCONFIG = 431
+SYS_FSMOUNT = 432
+FSOPEN_CLOEXEC = 1
+FSCONFIG_SET_STRING = 1
+FSCONFIG_CMD_CREATE = 6
+FSMOUNT_CLOEXEC = 1
+MOVE_MOUNT_F_EMPTY_PATH = 4
+AT_FDCWD = -100
+
+# mount(2) copies at most one page of option data
+MAX_MOUNT_DATA = 4095
+
+MountEntry = namedtuple(
+    "MountEntry", ["mount_id", "mountpoint", "fstype", "source", "options", "super_options"])
+
+
+def _escape(field):
+    return field.replace("\\", "\\134").replace(" ", "\\040").replace("\t", "\\011").replace("\n", "\\012")
+
+
+def _unescape(field):
+    # mountinfo escapes space, tab, newline and backslash as octal
+    return field.replace("\\040", " ").replace("\\011", "\t").replace("\\012", "\n").replace("\\134", "\\")
+
+
+class MountTable(object):
+    # Parsed /proc/self/mountinfo, re-read only when the kernel reports a change
+
+    def __init__(self, path="/proc/self/mountinfo"):
+        self._path = path
+        self._lock = threading.Lock()
+        self._entries = None
+        self._fd = None
+        self._poll = None
+
+    def _open(self):
+        self._fd = os.open(self._path, os.O_RDONLY | os.O_CLOEXEC)
+        self._poll = select.poll()
+        self._poll.register(self._fd, select.POLLERR | select.POLLPRI)
+
+    def _changed(self):
+        # The kernel flags POLLERR|POLLPRI on this fd whenever the mount table changes
+        return bool(self._poll.poll(0))
+
+    def _read(self):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(self._fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        entries = {}
+        for line in b"".join(chunks).decode("utf-8", "surrogateescape").splitlines():
+            fields = line.split(" ")
+            separator = fields.index("-")
+            entry = MountEntry(int(fields[0]), _unescape(fields[4]), fields[separator + 1],
+                               _unescape(fields[separator + 2]), fields[5], fields[separator + 3])
+            # Later entries shadow earlier ones stacked on the same mountpoint
+            entries[entry.mountpoint] = entry
+        return entries
+
+    def snapshot(self):
+        with self._lock:
+            if self._fd is None:
+                self._open()
+                self._entries = self._read()
+            elif self._entries is None or self._changed():
+                self._entries = self._read()
+            return self._entries
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = None
+
+    def get(self, path):
+        return self.snapshot().get(os.path.abspath(path))
+
+    def is_mounted(self, path):
+        return os.path.abspath(path) in self.snapshot()
+
+    def find(self, path):
+        # Mount containing path, i.e. the longest mountpoint prefix
+        path = os.path.realpath(path)
+        entries = self.snapshot()
+        while True:
+            if path in entries:
+                return entries[path]
+            if path == "/":
+                return None
+            path = os.path.dirname(path)
+
+
+table = MountTable()
+
+
+def is_mounted(path):
+    return table.is_mounted(path)
+
+
+def fstype(path):
+    entry = table.find(path)
+    return entry.fstype if entry else None
+
+
+class NativeMounter(object):
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._libc.mount.argtypes = [ctypes.c_char_p, ctypes.c_char_p,
+                                     ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p]
+        self._libc.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+        self._libc.syscall.restype = ctypes.c_long
+
+    def _check(self, ret, path):
+        if ret < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return ret
+
+    def _overlay_fsapi(self, lowers, upper, work, mnt):
+        # fsconfig takes one lowerdir+ per layer, so long layer stacks fit
+        syscall = self._libc.syscall
+        fs_fd = self._check(syscall(SYS_FSOPEN, b"overlay", FSOPEN_CLOEXEC), mnt)
+        try:
+            for lower in lowers:
+                self._check(syscall(SYS_FSCONFIG, fs_fd, FSCONFIG_SET_STRING,
+                                    b"lowerdir+", os.fsencode(lower), 0), lower)
+            self._check(syscall(SYS_FSCONFIG, fs_fd, FSCONFIG_SET_STRING,
+                                b"upperdir", os.fsencode(upper), 0), upper)
+            self._check(syscall(SYS_FSCONFIG, fs_fd, FSCONFIG_SET_STRING,
+                                b"workdir", os.fsencode(work), 0), work)
+            self._check(syscall(SYS_FSCONFIG, fs_fd, FSCONFIG_CMD_CREATE, None, None, 0), mnt)
+            mnt_fd = self._check(syscall(SYS_FSMOUNT, fs_fd, FSMOUNT_CLOEXEC, 0), mnt)
+        finally:
+            os.close(fs_fd)
+        try:
+            self._check(syscall(SYS_MOVE_MOUNT, mnt_fd, b"", AT_FDCWD,
+                                os.fsencode(mnt), MOVE_MOUNT_F_EMPTY_PATH), mnt)
+        finally:
+            os.close(mnt_fd)
+
+    def overlay_mount(self, lowers, upper, work, mnt):
+        data = f"lowerdir={':'.join(lowers)},upperdir={upper},workdir={work}"
+        if len(data) > MAX_MOUNT_DATA:
+            self._overlay_fsapi(lowers, upper, work, mnt)
+            return
+        self._check(self._libc.mount(b"overlay", os.fsencode(mnt), b"overlay",
+                                     0, data.encode("utf-8")), mnt)
+
+    def umount(self, mnt, lazy=False):
+        self._check(self._libc.umount2(os.fsencode(mnt), MNT_DETACH if lazy else 0), mnt)
+
+
+class SubprocessMounter(object):
+    def overlay_mount(self, lowers, upper, work, mnt):
+        trace.run(["mount", "-t", "overlay", "overlay", "-o",
+                        f"lowerdir={':'.join(lowers)},upperdir={upper},workdir={work}", mnt], check=True)
+
+    def umount(self, mnt, lazy=False):
+        trace.run(["umount", *(["-l"] if lazy else []), mnt], check=True)
+
+
+class FakeMounter(object):
+    # Userspace stand-in for overlayfs, so tests and benchmarks run without root.
+    # Mounting copies the layers into the mountpoint, unmounting copies new and changed
+    # files up to the upperdir. Deletions are lost, there are no whiteouts. Its mounts
+    # are listed in a mountinfo-format file that serves as the module's table.
+
+    def __init__(self, mountinfo=None):
+        if mountinfo is None:
+            fd, mountinfo = tempfile.mkstemp(prefix="lxns-mountinfo-")
+            os.close(fd)
+        self._mountinfo = mountinfo
+        self._mounts = {}
+        self._ids = itertools.count(1000)
+        self._lock = threading.Lock()
+        self._write()
+        self.table = MountTable(mountinfo)
+
+    def _write(self):
+        with open(self._mountinfo, mode="w") as f:
+            for mnt, (mount_id, lowers, upper, work) in self._mounts.items():
+                options = f"lowerdir={':'.join(lowers)},upperdir={upper},workdir={work}"
+                f.write(f"{mount_id} 1 0:0 / {_escape(mnt)} rw - overlay overlay rw,{_escape(options)}\n")
+
+    def overlay_mount(self, lowers, upper, work, mnt):
+        with self._lock:
+            if mnt in self._mounts:
+                raise OSError(errno.EBUSY, os.strerror(errno.EBUSY), mnt)
+            self._mounts[mnt] = (next(self._ids), lowers, upper, work)
+            self._write()
+        for layer in list(reversed(lowers)) + [upper]:
+            shutil.copytree(layer, mnt, symlinks=True, dirs_exist_ok=True)
+
+    def _copy_up(self, mnt, lowers, upper):
+        for dirpath, dirnames, filenames in os.walk(mnt):
+            rel = os.path.relpath(dirpath, mnt)
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                sources = [os.path.join(x, rel, name) for x in [upper] + lowers]
+                source = next((x for x in sources if os.path.lexists(x)), None)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    if source is None:
+                        os.makedirs(os.path.join(upper, rel, name), exist_ok=True)
+                    continue
+                if source is not None and os.path.islink(path) == os.path.islink(source):
+                    if os.path.islink(path):
+                        if os.readlink(path) == os.readlink(source):
+                            continue
+                    elif filecmp.cmp(path, source, shallow=False):
+                        continue
+                dest = os.path.join(upper, rel, name)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                if os.path.lexists(dest):
+                    os.remove(dest)
+                shutil.copy2(path, dest, follow_symlinks=False)
+
+    def umount(self, mnt, lazy=False):
+        with self._lock:
+            if mnt not in self._mounts:
+                raise OSError(errno.EINVAL, os.strerror(errno.EINVAL), mnt)
+            _, lowers, upper, _ = self._mounts.pop(mnt)
+            self._write()
+        self._copy_up(mnt, lowers, upper)
+        for entry in os.scandir(mnt):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+
+
+_mounter = None
+_mounter_lock = threading.Lock()
+
+
+def get_mounter():
+    global _mounter, table
+    with _mounter_lock:
+        if _mounter is None:
+            backend = os.getenv("LXNS_MOUNT_BACKEND") or config.get(
+                "mount", "backend", fallback="native")
+            if backend == "native":
+                _mounter = NativeMounter()
+            elif backend == "subprocess":
+                _mounter = SubprocessMounter()
+            elif backend == "fake":
+                _mounter = FakeMounter()
+                table = _mounter.table
+            else:
+                raise ValueError(f"Unknown mount backend {backend}")
+        return _mounter
+
+
+def set_mounter(mounter):
+    # A mounter with a table of its own, like FakeMounter, replaces the kernel's
+    global _mounter, table
+    with _mounter_lock:
+        _mounter = mounter
+        if hasattr(mounter, "table"):
+            table = mounter.table
+
+
+def overlay_mount(lowerdir, upperdir, workdir, mountpoint):
+    lowers = [lowerdir] if isinstance(lowerdir, str) else list(lowerdir)
+    lowers = [os.path.abspath(x) for x in lowers]
+    [upper, work, mnt] = map(os.path.abspath, [upperdir, workdir, mountpoint])
+    try:
+        with trace.span("overlay mount", "fs", target=mnt, layers=len(lowers)):
+            get_mounter().overlay_mount(lowers, upper, work, mnt)
+    finally:
+        table.invalidate()
+
+
+def umount(mountpoint, lazy=False):
+    try:
+        with trace.span("umount", "fs", target=os.path.abspath(mountpoint), lazy=lazy):
+            get_mounter().umount(os.path.abspath(mountpoint), lazy)
+    finally:
+        table.invalidate()
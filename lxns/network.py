@@ -0,0 +1,207 @@
+import ipaddress
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from loguru import logger
+
+from . import config
+from . import locks
+from . import systemd
+from . import trace
+
+TABLE = "lxns"
+FORWARDS = "forwards"
+
+DEFAULT_ADDRESS_TIMEOUT = 30
+
+# Host port -> container address, one map element per container. Connections to the
+# host's own addresses are left to container_<name>.socket, which boots a lazy
+# container and is what the supervisor counts in /proc/net/tcp. That's why
+# iptables_patcher.py turned nspawn's Port= LOCAL match into BROADCAST, and the rules
+# keep that: only broadcast destinations are DNATed.
+RULESET = f"""
+add table ip {TABLE}
+add map ip {TABLE} {FORWARDS} {{ type inet_service : ipv4_addr ; }}
+add chain ip {TABLE} prerouting {{ type nat hook prerouting priority dstnat ; }}
+add chain ip {TABLE} output {{ type nat hook output priority -100 ; }}
+flush chain ip {TABLE} prerouting
+flush chain ip {TABLE} output
+add rule ip {TABLE} prerouting fib daddr type broadcast meta l4proto tcp dnat to tcp dport map @{FORWARDS}
+add rule ip {TABLE} output ip daddr != 127.0.0.0/8 fib daddr type broadcast meta l4proto tcp dnat to tcp dport map @{FORWARDS}
+"""
+
+
+class NetworkError(OSError):
+    pass
+
+
+class LibNftables(object):
+    # In-process through libnftables, no fork per rule change
+
+    def __init__(self):
+        import nftables
+
+        self._nft = nftables.Nftables()
+        self._lock = threading.Lock()
+
+    def run(self, commands):
+        with self._lock:
+            rc, _, error = self._nft.cmd(commands)
+        if rc != 0:
+            raise NetworkError(f"nft failed: {error.strip()}")
+
+
+class SubprocessNftables(object):
+    def run(self, commands):
+        result = trace.run(["nft", "-f", "-"], input=commands.encode("utf-8"),
+                                capture_output=True)
+        if result.returncode != 0:
+            raise NetworkError(
+                f"nft failed: {result.stderr.decode('utf-8').strip()}")
+
+
+class FakeNftables(object):
+    # Records the map instead of touching the host, used by tests and benchmarks
+
+    def __init__(self):
+        self.forwards = {}
+        self.commands = []
+
+    def run(self, commands):
+        self.commands.append(commands)
+        for line in commands.splitlines():
+            words = line.split()
+            if words[:2] == ["add", "element"]:
+                port, _, address = line[line.index("{") + 1:line.index("}")].split()
+                self.forwards[int(port)] = address
+            elif words[:2] == ["delete", "element"]:
+                port = int(line[line.index("{") + 1:line.index("}")])
+                if port not in self.forwards:
+                    raise NetworkError("nft failed: No such file or directory")
+                del self.forwards[port]
+
+
+class Forwarder(object):
+    def __init__(self, backend):
+        self._nft = backend
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def _ensure(self):
+        # Idempotent, it only resets our own two rules
+        with self._lock:
+            if not self._ready:
+                self._nft.run(RULESET)
+                self._ready = True
+
+    def add(self, port, address):
+        ipaddress.IPv4Address(address)
+        self._ensure()
+        # Elements can't be overwritten in place, drop a stale one first
+        self._discard(port)
+        self._nft.run(
+            f"add element ip {TABLE} {FORWARDS} {{ {port} : {address} }}\n")
+
+    def remove(self, port):
+        self._ensure()
+        self._discard(port)
+
+    def _discard(self, port):
+        try:
+            self._nft.run(f"delete element ip {TABLE} {FORWARDS} {{ {port} }}\n")
+        except NetworkError:
+            pass
+
+
+_forwarder = None
+_forwarder_lock = threading.Lock()
+
+
+def _create_backend(backend):
+    if backend == "fake":
+        return FakeNftables()
+    if backend == "subprocess":
+        return SubprocessNftables()
+    if backend == "libnftables":
+        return LibNftables()
+    if backend == "auto":
+        try:
+            return LibNftables()
+        except ImportError:
+            logger.debug("nftables bindings not installed, falling back to nft.")
+        except OSError as e:
+            logger.debug(f"libnftables unavailable ({e}), falling back to nft.")
+        return SubprocessNftables()
+    raise ValueError(f"Unknown network backend {backend}")
+
+
+def get_forwarder():
+    global _forwarder
+    with _forwarder_lock:
+        if _forwarder is None:
+            backend = os.getenv("LXNS_NETWORK_BACKEND") or config.get(
+                "network", "backend", fallback="auto")
+            _forwarder = Forwarder(_create_backend(backend))
+        return _forwarder
+
+
+def set_forwarder(forwarder):
+    global _forwarder
+    with _forwarder_lock:
+        _forwarder = forwarder
+
+
+def _address(name):
+    try:
+        addresses = systemd.get_manager().machine_addresses(name)
+    except systemd.SystemdError:
+        # Not registered with machined (yet, or any more)
+        return None
+    for address in addresses:
+        address = ipaddress.ip_address(address)
+        if address.version == 4 and not address.is_link_local:
+            return str(address)
+    return None
+
+
+def wait_address(name, timeout=None):
+    # The guest only gets its lease from the host's networkd once it has booted
+    if timeout is None:
+        timeout = config.getint("network", "address_timeout",
+                                fallback=DEFAULT_ADDRESS_TIMEOUT)
+    deadline = time.monotonic() + timeout
+    while True:
+        address = _address(name)
+        if address is not None:
+            return address
+        if time.monotonic() > deadline:
+            raise NetworkError(f"Container {name} got no IPv4 address in {timeout}s.")
+        time.sleep(0.5)
+
+
+def forward(name, port):
+    address = wait_address(name)
+    # A stop that came in while we waited has run its unforward already, don't add
+    # an element behind it
+    with locks.file_lock(f"forward-{port}"):
+        if _address(name) != address:
+            logger.debug(f"Container {name} went away before its port was forwarded.")
+            return
+        get_forwarder().add(port, address)
+    logger.debug(f"Forwarding port {port} to {name} at {address}.")
+
+
+def forward_later(name):
+    # Detached, so the container's start job doesn't wait for the guest's lease
+    subprocess.Popen([sys.executable, "-m", "lxns", "net_up", name, "--wait"],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def unforward(port):
+    if port > 0:
+        with locks.file_lock(f"forward-{port}"):
+            get_forwarder().remove(port)
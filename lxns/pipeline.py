@@ -0,0 +1,202 @@
+import asyncio
+import base64
+import json
+import os
+import pickle
+import time
+
+from loguru import logger
+
+from . import consts
+from . import trace
+
+STARTED = "started"
+DONE = "done"
+UNDONE = "undone"
+
+
+class PipelineError(RuntimeError):
+    pass
+
+
+class Step(object):
+    def __init__(self, name, run, undo=None, after=(), restore=None, check=None):
+        self.name = name
+        # Blocking callables, run on the loop's executor so independent steps overlap
+        self.run = run
+        self.undo = undo
+        self.after = tuple(after)
+        # Re-applies a finished step's result to the object when resuming
+        self.restore = restore
+        # Whether a finished step's effect is still there when resuming, a mount doesn't
+        # survive a reboot. Without it the step is run again before anything waiting on it.
+        self.check = check
+
+
+def journal_path(op, name):
+    return os.path.join(consts.JOURNAL_DIR, f"{op}-{name}.jsonl")
+
+
+class Journal(object):
+    # Append-only record of a pipeline's progress, one fsync'd JSON line per event
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def create(cls, op, name, subject):
+        os.makedirs(consts.JOURNAL_DIR, mode=0o700, exist_ok=True)
+        journal = cls(journal_path(op, name))
+        header = {
+            "op": op,
+            "name": name,
+            "time": time.time(),
+            # The subject carries the root password, like the index does
+            "subject": base64.b64encode(pickle.dumps(subject)).decode("ascii"),
+        }
+        fd = os.open(journal.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps(header) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        return journal
+
+    def append(self, step, state, result=None):
+        record = {"step": step, "state": state}
+        if result is not None:
+            record["result"] = result
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read(self):
+        # Header, then the last state and result of each step in completion order
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        header = json.loads(lines[0])
+        steps = {}
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A torn last line from a crash mid-append
+                break
+            steps.pop(record["step"], None)
+            steps[record["step"]] = (record["state"], record.get("result"))
+        return header, steps
+
+    def subject(self):
+        header, _ = self.read()
+        return pickle.loads(base64.b64decode(header["subject"]))
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def pending():
+    # (op, name, journal) of every pipeline that didn't finish
+    try:
+        entries = sorted(os.listdir(consts.JOURNAL_DIR))
+    except FileNotFoundError:
+        return []
+    result = []
+    for entry in entries:
+        if entry.endswith(".jsonl"):
+            op, _, name = entry[:-len(".jsonl")].partition("-")
+            result.append((op, name, Journal(os.path.join(consts.JOURNAL_DIR, entry))))
+    return result
+
+
+class Pipeline(object):
+    def __init__(self, label, steps, journal):
+        self.label = label
+        self.steps = {x.name: x for x in steps}
+        self.journal = journal
+        for step in steps:
+            for dep in step.after:
+                if dep not in self.steps:
+                    raise ValueError(f"Step {step.name} depends on unknown step {dep}.")
+
+    def run(self, keep_journal=False):
+        # keep_journal leaves removing it to the caller, once it has recorded the outcome
+        _, states = self.journal.read()
+        done = set()
+        for name, (state, result) in states.items():
+            if state == DONE and name in self.steps:
+                done.add(name)
+                if self.steps[name].restore is not None:
+                    self.steps[name].restore(result)
+        for name in list(done):
+            step = self.steps[name]
+            waiting = any(name in x.after for x in self.steps.values() if x.name not in done)
+            if step.check is not None and waiting and not step.check():
+                logger.info(f"{self.label}: {name} no longer holds, running it again.")
+                done.discard(name)
+        try:
+            asyncio.run(self._run(done))
+        except BaseException as e:
+            if isinstance(e, (PipelineError, KeyboardInterrupt)):
+                raise
+            raise PipelineError(f"{self.label} failed: {e}") from e
+        if not keep_journal:
+            self.journal.remove()
+
+    async def _run(self, done):
+        loop = asyncio.get_running_loop()
+        # Set once a step finished either way, dependents check failures before starting
+        finished = {name: asyncio.Event() for name in self.steps}
+        for name in done:
+            finished[name].set()
+        failures = []
+
+        async def execute(step):
+            try:
+                for dep in step.after:
+                    await finished[dep].wait()
+                if failures:
+                    return
+                self.journal.append(step.name, STARTED)
+                start = time.monotonic()
+                result = await loop.run_in_executor(None, self._call, step.name, step.run)
+                self.journal.append(step.name, DONE, result)
+                logger.debug(f"{self.label}: {step.name} took {time.monotonic() - start:.3f}s")
+            except BaseException as e:
+                failures.append(e)
+            finally:
+                finished[step.name].set()
+
+        # Steps already on the executor can't be interrupted, so everything lands
+        # before a failure propagates and a rollback may start
+        await asyncio.gather(*(execute(x) for x in self.steps.values() if x.name not in done))
+        if failures:
+            raise failures[0]
+
+    def _call(self, name, func):
+        # "build mount", "destroy unmount": the operation, not the container, so traces
+        # of different containers aggregate
+        with trace.span(f"{self.label.partition(' ')[0]} {name}", "step", pipeline=self.label):
+            return func()
+
+    def rollback(self):
+        # Undo every step that started, newest first. Undos must tolerate partial work.
+        _, states = self.journal.read()
+        failed = []
+        for name, (state, _) in reversed(list(states.items())):
+            step = self.steps.get(name)
+            if state == UNDONE or step is None or step.undo is None:
+                continue
+            try:
+                self._call(f"undo {name}", step.undo)
+            except Exception as e:
+                logger.warning(f"{self.label}: undoing {name} failed: {e}")
+                failed.append(name)
+                continue
+            self.journal.append(name, UNDONE)
+        if failed:
+            raise PipelineError(
+                f"{self.label}: rollback incomplete, {', '.join(failed)} couldn't be undone.")
+        self.journal.remove()
@@ -0,0 +1,95 @@
+import secrets
+import subprocess
+import sys
+import time
+
+from loguru import logger
+
+from . import config
+from . import disk
+from . import locks
+from .container import Container, build_all
+
+DEFAULT_REFILL_RATE = 4
+DEFAULT_REFILL_INTERVAL = 60
+
+
+def configured_images():
+    return [name[len("pool:"):] for name in config.sections("pool:")]
+
+
+def size(image):
+    return config.getint(f"pool:{image}", "size", fallback=0)
+
+
+def refill_rate(image):
+    # Upper bound on containers built per refill pass, so refills don't hog the host
+    return config.getint(f"pool:{image}", "refill_rate",
+                         fallback=config.getint("pool", "refill_rate", fallback=DEFAULT_REFILL_RATE))
+
+
+def fill(index, image, jobs=None):
+    with locks.file_lock(f"pool-{image}"):
+        missing = min(size(image) - index.pool_count(image), refill_rate(image))
+        if missing <= 0:
+            return 0
+        containers = []
+        for _ in range(missing):
+            container = Container(f"pool-{image}-{secrets.token_hex(4)}", image)
+            # Placeholder password, replaced when the container is handed out
+            container.password = secrets.token_urlsafe(24)
+            containers.append(container)
+
+        report = build_all(f"pool fill {image}", containers, index.pool_add, jobs=jobs)
+        report.print()
+        return len(report.results)
+
+
+def take(index, image, name, password):
+    container = index.pool_take(image)
+    if container is None:
+        return None
+    try:
+        # The port reserved while pre-building stays with the container
+        container.rename(name)
+        container.password = password
+    except Exception as e:
+        logger.warning(f"Pooled container {container.name} is unusable: {e}")
+        try:
+            container.destroy()
+            disk.purge_later()
+        except Exception as e:
+            logger.warning(f"Failed to clean up {container.name}: {e}")
+        return None
+    return container
+
+
+def drain(index, image):
+    drained = 0
+    while True:
+        container = index.pool_take(image)
+        if container is None:
+            if drained:
+                disk.purge_later()
+            return drained
+        container.destroy()
+        drained += 1
+
+
+def refill_async(image):
+    # Detached so the user's create returns while the pool is topped up
+    subprocess.Popen([sys.executable, "-m", "lxns", "pool_fill", image],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def watch(index, images, jobs=None):
+    interval = config.getint("pool", "refill_interval",
+                             fallback=DEFAULT_REFILL_INTERVAL)
+    while True:
+        for image in images:
+            try:
+                fill(index, image, jobs)
+            except Exception as e:
+                logger.error(f"Refilling pool of {image} failed: {e}")
+        time.sleep(interval)
@@ -0,0 +1,162 @@
+import errno
+import os
+import socket
+import struct
+from contextlib import closing
+
+from loguru import logger
+
+from . import config
+from . import consts
+from . import locks
+from .index import ContainerIndex
+
+HEADER = struct.Struct("<4sHHI")
+MAGIC = b"LXP1"
+
+DEFAULT_RANGE = "20000-29999"
+
+
+class PortError(OSError):
+    pass
+
+
+def port_range():
+    start, _, end = config.get("ports", "range", fallback=DEFAULT_RANGE).partition("-")
+    return int(start), int(end)
+
+
+def _in_use(port):
+    # Something outside lxns may already listen there
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+        try:
+            s.bind(("", port))
+        except OSError as e:
+            if e.errno == errno.EADDRINUSE:
+                return True
+            raise
+    return False
+
+
+class _Bitmap(object):
+    def __init__(self, start, end, hint=0, bits=None):
+        self.start = start
+        self.end = end
+        self.hint = hint
+        self.bits = bits if bits is not None else bytearray((end - start) // 8 + 1)
+
+    @classmethod
+    def load(cls, path, start, end):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if len(data) < HEADER.size:
+            return None
+        magic, file_start, file_end, hint = HEADER.unpack_from(data)
+        # A changed range invalidates the map, it gets rebuilt from the index
+        if magic != MAGIC or (file_start, file_end) != (start, end):
+            return None
+        return cls(start, end, hint, bytearray(data[HEADER.size:]))
+
+    def save(self, path):
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, self.start, self.end, self.hint))
+            f.write(self.bits)
+        os.replace(tmp, path)
+
+    def __contains__(self, port):
+        offset = port - self.start
+        return bool(self.bits[offset >> 3] & (1 << (offset & 7)))
+
+    def set(self, port):
+        offset = port - self.start
+        self.bits[offset >> 3] |= 1 << (offset & 7)
+
+    def clear(self, port):
+        offset = port - self.start
+        self.bits[offset >> 3] &= ~(1 << (offset & 7)) & 0xff
+
+    def candidates(self):
+        # Scan from the rotating hint, skipping full bytes, so allocation is amortized O(1)
+        size = self.end - self.start + 1
+        offset = self.hint % size
+        scanned = 0
+        while scanned < size:
+            if offset & 7 == 0 and self.bits[offset >> 3] == 0xff and scanned + 8 <= size:
+                step = 8
+            else:
+                if not self.bits[offset >> 3] & (1 << (offset & 7)):
+                    yield self.start + offset
+                step = 1
+            scanned += step
+            offset = (offset + step) % size
+
+
+class PortAllocator(object):
+    def __init__(self, path=consts.PORT_MAP):
+        self._path = path
+
+    def _load(self):
+        start, end = port_range()
+        bitmap = _Bitmap.load(self._path, start, end)
+        if bitmap is None:
+            bitmap = _Bitmap(start, end)
+            self._seed(bitmap)
+        return bitmap
+
+    def _seed(self, bitmap):
+        index = ContainerIndex(readonly=True)
+        try:
+            for port in index.ports():
+                if bitmap.start <= port <= bitmap.end:
+                    bitmap.set(port)
+        finally:
+            index.close()
+
+    def allocate(self):
+        with locks.file_lock("ports"):
+            bitmap = self._load()
+            for port in bitmap.candidates():
+                if _in_use(port):
+                    continue
+                bitmap.set(port)
+                bitmap.hint = port - bitmap.start + 1
+                bitmap.save(self._path)
+                return port
+        raise PortError(
+            f"No free port left in {bitmap.start}-{bitmap.end}.")
+
+    def release(self, port):
+        with locks.file_lock("ports"):
+            bitmap = self._load()
+            if bitmap.start <= port <= bitmap.end and port in bitmap:
+                bitmap.clear(port)
+                bitmap.save(self._path)
+
+    def sync(self):
+        # Rebuild the map from the ports recorded in the index
+        with locks.file_lock("ports"):
+            start, end = port_range()
+            bitmap = _Bitmap(start, end)
+            self._seed(bitmap)
+            bitmap.save(self._path)
+        logger.info(f"Port map rebuilt for {start}-{end}.")
+
+
+_allocator = PortAllocator()
+
+
+def allocate():
+    return _allocator.allocate()
+
+
+def release(port):
+    if port > 0:
+        _allocator.release(port)
+
+
+def sync():
+    _allocator.sync()
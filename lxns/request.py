@@ -0,0 +1,7 @@
+# Per-request state while lxnsd runs a command on behalf of a client
+import contextvars
+
+# uid of the connected client, None when lxns runs directly
+peer_uid = contextvars.ContextVar("peer_uid", default=None)
+# Password the client prompted for, the daemon has no terminal to ask on
+password = contextvars.ContextVar("password", default=None)
@@ -0,0 +1,160 @@
+import ctypes
+import ctypes.util
+import os
+import secrets
+import stat
+import threading
+import time
+
+from . import config
+from . import layers
+from . import trace
+
+SALT_CHARS = "./0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+# Big enough for struct crypt_data of both glibc and libxcrypt
+CRYPT_DATA_SIZE = 1 << 18
+
+OPAQUE_XATTRS = ("trusted.overlay.opaque", "user.overlay.opaque")
+
+
+class ShadowError(OSError):
+    pass
+
+
+class _Crypt(object):
+    def __init__(self):
+        self._lib = ctypes.CDLL(ctypes.util.find_library("crypt") or "libcrypt.so.1", use_errno=True)
+        self._lib.crypt_r.restype = ctypes.c_char_p
+        self._lib.crypt_r.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_void_p]
+        # crypt_gensalt only exists in libxcrypt, which is also what provides yescrypt
+        self._gensalt = getattr(self._lib, "crypt_gensalt", None)
+        if self._gensalt is not None:
+            self._gensalt.restype = ctypes.c_char_p
+            self._gensalt.argtypes = [ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p, ctypes.c_int]
+        self._local = threading.local()
+
+    def gensalt(self, scheme):
+        if scheme == "yescrypt" and self._gensalt is not None:
+            salt = self._gensalt(b"$y$", 0, None, 0)
+            if salt:
+                return salt.decode("ascii")
+        # SHA-512 crypt, supported by every libcrypt
+        return "$6$" + "".join(secrets.choice(SALT_CHARS) for _ in range(16))
+
+    def crypt(self, password, salt):
+        # crypt_r with a per-thread buffer, so batch rotations hash in parallel
+        if not hasattr(self._local, "data"):
+            self._local.data = ctypes.create_string_buffer(CRYPT_DATA_SIZE)
+        ctypes.memset(self._local.data, 0, CRYPT_DATA_SIZE)
+        result = self._lib.crypt_r(password.encode("utf-8"), salt.encode("ascii"), self._local.data)
+        if not result or result.startswith(b"*"):
+            raise ShadowError(f"crypt failed for salt {salt[:4]}")
+        return result.decode("ascii")
+
+
+_crypt = None
+
+
+def hash_password(password, scheme=None):
+    global _crypt
+    if _crypt is None:
+        _crypt = _Crypt()
+    scheme = scheme or config.get("shadow", "scheme", fallback="yescrypt")
+    return _crypt.crypt(password, _crypt.gensalt(scheme))
+
+
+def _is_opaque(path):
+    for name in OPAQUE_XATTRS:
+        try:
+            if os.getxattr(path, name) == b"y":
+                return True
+        except OSError:
+            pass
+    return False
+
+
+def _source(rootdir, rel, lowers):
+    # Where the merged view would read rel from: the tree itself, else the topmost lowerdir
+    path = os.path.join(rootdir, rel)
+    try:
+        st = os.lstat(path)
+        if layers.is_whiteout(st):
+            raise ShadowError(f"{rel} was deleted in {rootdir}")
+        return path, st
+    except FileNotFoundError:
+        pass
+    if _is_opaque(os.path.join(rootdir, os.path.dirname(rel))):
+        raise ShadowError(f"{rel} doesn't exist in {rootdir}")
+    found = layers.lookup(lowers, rel)
+    if found is None:
+        raise ShadowError(f"{rel} doesn't exist in {rootdir}")
+    return found
+
+
+def _copy_up_dirs(rootdir, rel, lowers):
+    # Create missing parents with the lowerdir's metadata, like overlay copy-up does
+    parts = rel.split(os.sep)[:-1]
+    for i in range(1, len(parts) + 1):
+        sub = os.path.join(*parts[:i])
+        path = os.path.join(rootdir, sub)
+        if os.path.isdir(path):
+            continue
+        found = layers.lookup(lowers, sub)
+        st = found[1] if found else None
+        os.mkdir(path, stat.S_IMODE(st.st_mode) if st else 0o755)
+        if st:
+            os.chown(path, st.st_uid, st.st_gid)
+            os.chmod(path, stat.S_IMODE(st.st_mode))
+
+
+def _update_entries(content, passwords):
+    today = str(int(time.time() // 86400))
+    remaining = dict(passwords)
+    lines = content.split("\n")
+    for i, line in enumerate(lines):
+        fields = line.split(":")
+        if len(fields) < 3 or fields[0] not in remaining:
+            continue
+        fields[1] = remaining.pop(fields[0])
+        fields[2] = today
+        lines[i] = ":".join(fields)
+    if remaining:
+        raise KeyError(f"No shadow entry for {', '.join(sorted(remaining))}")
+    return "\n".join(lines)
+
+
+def set_passwords(rootdir, passwords, lowers=(), scheme=None):
+    # passwords maps user to plaintext; lowers are read-only layers under rootdir (top first)
+    rel = os.path.join("etc", "shadow")
+    src, st = _source(rootdir, rel, list(lowers))
+    with open(src) as f:
+        content = f.read()
+    content = _update_entries(
+        content, {user: hash_password(password, scheme) for user, password in passwords.items()})
+    _copy_up_dirs(rootdir, rel, list(lowers))
+
+    # Atomic replace, keeping the original mode and owner
+    path = os.path.join(rootdir, rel)
+    tmp = f"{path}.lxns-tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o000)
+    try:
+        os.fchown(fd, st.st_uid, st.st_gid)
+        os.fchmod(fd, stat.S_IMODE(st.st_mode))
+        with open(fd, mode="w", closefd=False) as f:
+            f.write(content)
+            f.flush()
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
+    dir_fd = os.open(os.path.dirname(path), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def set_password(rootdir, username, password, lowers=(), scheme=None):
+    with trace.span("set password", "fs", target=rootdir, user=username):
+        set_passwords(rootdir, {username: password}, lowers, scheme)
@@ -0,0 +1,152 @@
+import csv
+import json
+import os
+import sys
+import time
+
+import prettytable
+
+from . import cgroup
+from . import consts
+from . import mounts
+from . import systemd
+
+
+def collect(index):
+    # One ListMachines round trip and a few cgroup and /proc reads per running machine,
+    # instead of a machinectl fork or a bus call per container
+    machines = {x["name"]: x for x in systemd.get_manager().list_machines()}
+    mtab = mounts.table.snapshot()
+    now = time.time()
+    rows = []
+    for name, image, port in index.summaries():
+        machine = machines.get(name)
+        path = cgroup.find(name) if machine else None
+        since = cgroup.started(path) if path else None
+        mounted = os.path.join(consts.SYSTEMD_MOUNTPOINT, name) in mtab
+        if machine:
+            state = "running"
+        else:
+            # Suspended by the supervisor or mounted by hand, no machine registered
+            state = "mounted" if mounted else "stopped"
+        rows.append({
+            "name": name,
+            "image": image,
+            "port": port,
+            "state": state,
+            "mounted": mounted,
+            "memory": cgroup.memory_current(path) if path else None,
+            "cpu": cgroup.cpu_usage_usec(path) / 1e6 if path else None,
+            "uptime": int(now - since) if since else None,
+        })
+    return rows
+
+
+def collect_usage(names):
+    rows = []
+    for name in names:
+        path = cgroup.find(name)
+        row = {"name": name, "state": "running" if path else "stopped"}
+        row.update(cgroup.usage(path) if path else dict.fromkeys(USAGE_KEYS))
+        rows.append(row)
+    return rows
+
+
+def _size(value):
+    for unit in ("B", "K", "M", "G"):
+        if value < 1024:
+            return f"{value:.1f}{unit}" if unit != "B" else f"{value}B"
+        value /= 1024
+    return f"{value:.1f}T"
+
+
+def _duration(seconds):
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if days:
+        return f"{days}d {hours}h"
+    if hours:
+        return f"{hours}h {minutes}m"
+    return f"{minutes}m {seconds}s"
+
+
+def _seconds(value):
+    return f"{value:.1f}s"
+
+
+def _yes_no(value):
+    return "yes" if value else "no"
+
+
+# (key, header, formatter for the table view)
+LIST_COLUMNS = [
+    ("name", "Name", str),
+    ("image", "Image", str),
+    ("port", "Port", str),
+    ("state", "State", str),
+    ("mounted", "Mounted", _yes_no),
+    ("memory", "Memory", _size),
+    ("cpu", "CPU", _seconds),
+    ("uptime", "Uptime", _duration),
+]
+
+USAGE_COLUMNS = [
+    ("name", "Name", str),
+    ("state", "State", str),
+    ("memory", "Memory", _size),
+    ("memory_peak", "Peak", _size),
+    ("memory_max", "Memory Max", _size),
+    ("cpu", "CPU", _seconds),
+    ("cpu_throttled", "Throttled", _seconds),
+    ("io_read", "Read", _size),
+    ("io_write", "Written", _size),
+    ("tasks", "Tasks", str),
+    ("tasks_max", "Tasks Max", str),
+]
+
+USAGE_KEYS = [key for key, _, _ in USAGE_COLUMNS[2:]]
+
+DU_COLUMNS = [
+    ("name", "Name", str),
+    ("image", "Image", str),
+    ("upper", "Upper", _size),
+    ("files", "Files", str),
+    ("snapshots", "Snapshots", _size),
+]
+
+IMAGE_DU_COLUMNS = [
+    ("name", "Name", str),
+    ("layers", "Layers", str),
+    ("size", "Size", _size),
+    ("shared", "Shared", _size),
+    ("containers", "Containers", str),
+]
+
+
+def print_table(rows, columns):
+    table = prettytable.PrettyTable()
+    table.field_names = [header for _, header, _ in columns]
+    for row in rows:
+        table.add_row([
+            "-" if row[key] is None else fmt(row[key]) for key, _, fmt in columns])
+    print(table)
+
+
+def print_json(rows, columns):
+    json.dump(rows, sys.stdout, indent=2)
+    print()
+
+
+def print_csv(rows, columns):
+    writer = csv.DictWriter(sys.stdout, fieldnames=[key for key, _, _ in columns])
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+FORMATS = {
+    "table": print_table,
+    "json": print_json,
+    "csv": print_csv,
+}
@@ -0,0 +1,97 @@
+import time
+from collections import Counter
+
+from loguru import logger
+
+from . import cgroup
+from . import config
+from . import template
+from . import units
+from .template import Template
+
+DEFAULT_IDLE_TIMEOUT = 1800
+DEFAULT_INTERVAL = 60
+# CPU share (percent of one core) below which a machine counts as idle
+DEFAULT_CPU_THRESHOLD = 1.0
+
+TCP_ESTABLISHED = "01"
+
+
+def established_connections():
+    # One pass over the host's TCP tables, counting established sockets per local port
+    counts = Counter()
+    for table in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(table) as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    if fields[3] == TCP_ESTABLISHED:
+                        counts[int(fields[1].rsplit(":", 1)[1], 16)] += 1
+        except FileNotFoundError:
+            pass
+    return counts
+
+
+class Supervisor(object):
+    def __init__(self, index):
+        self._index = index
+        self.idle_timeout = config.getint(
+            "supervisor", "idle_timeout", fallback=DEFAULT_IDLE_TIMEOUT)
+        self.interval = config.getint(
+            "supervisor", "interval", fallback=DEFAULT_INTERVAL)
+        self.cpu_threshold = config.getfloat(
+            "supervisor", "cpu_threshold", fallback=DEFAULT_CPU_THRESHOLD)
+        # name -> (cpu usage_usec, sample time, last time the machine was busy)
+        self._state = {}
+
+    def prepare(self):
+        # Older units lack the ExecStartPre that remounts the overlay on socket activation
+        with units.transaction() as txn:
+            for container in self._index:
+                container._write_host_units(
+                    txn, Template(template.set_for_image(container.image)))
+
+    def tick(self):
+        now = time.monotonic()
+        connections = established_connections()
+        seen = set()
+        for name, _, port in self._index.summaries():
+            path = cgroup.find(name)
+            if path is None:
+                continue
+            seen.add(name)
+            usage = cgroup.cpu_usage_usec(path)
+            if name not in self._state:
+                self._state[name] = (usage, now, now)
+                continue
+            last_usage, last_sample, last_busy = self._state[name]
+            cpu_percent = (usage - last_usage) / max(now - last_sample, 1e-6) / 1e4
+            if connections[port] or cpu_percent >= self.cpu_threshold:
+                last_busy = now
+            self._state[name] = (usage, now, last_busy)
+            if now - last_busy >= self.idle_timeout:
+                self.scale_down(name)
+                seen.discard(name)
+        # Forget machines that stopped on their own
+        for name in set(self._state) - seen:
+            del self._state[name]
+
+    def scale_down(self, name):
+        container = self._index.get(name)
+        if container is None:
+            return
+        try:
+            container.suspend()
+        except Exception as e:
+            logger.error(f"Failed to suspend idle container {name}: {e}")
+            return
+        logger.info(f"Suspended idle container {name}.")
+
+    def run(self):
+        self.prepare()
+        logger.info(
+            f"Supervising containers, idle timeout {self.idle_timeout}s.")
+        while True:
+            self.tick()
+            time.sleep(self.interval)
@@ -0,0 +1,279 @@
+import ipaddress
+import itertools
+import os
+import threading
+import time
+from collections import deque
+
+from loguru import logger
+
+from . import config
+from . import limits
+from . import trace
+
+SYSTEMD_BUS_NAME = "org.freedesktop.systemd1"
+SYSTEMD_PATH = "/org/freedesktop/systemd1"
+MANAGER_INTERFACE = "org.freedesktop.systemd1.Manager"
+
+MACHINED_BUS_NAME = "org.freedesktop.machine1"
+MACHINED_PATH = "/org/freedesktop/machine1"
+MACHINED_INTERFACE = "org.freedesktop.machine1.Manager"
+
+JOB_TIMEOUT = 90
+
+
+class SystemdError(OSError):
+    pass
+
+
+class _JeepneyBus(object):
+    # Thin wrapper around one persistent system bus connection
+
+    def __init__(self):
+        from jeepney import MatchRule, message_bus
+        from jeepney.io.blocking import Proxy, open_dbus_connection
+
+        self._conn = open_dbus_connection(bus="SYSTEM")
+        # All socket I/O goes through this lock, the connection isn't thread-safe
+        self._lock = threading.Lock()
+        self._finished = {}
+        rule = MatchRule(type="signal", sender=SYSTEMD_BUS_NAME, interface=MANAGER_INTERFACE,
+                         member="JobRemoved", path=SYSTEMD_PATH)
+        Proxy(message_bus, self._conn).AddMatch(rule)
+        self._signals = self._conn.filter(rule, queue=deque()).queue
+        self.call(SYSTEMD_PATH, MANAGER_INTERFACE, "Subscribe")
+
+    def call(self, path, interface, member, signature=None, body=(), destination=SYSTEMD_BUS_NAME):
+        from jeepney import DBusAddress, new_method_call
+        from jeepney.wrappers import DBusErrorResponse, unwrap_msg
+
+        address = DBusAddress(path, bus_name=destination, interface=interface)
+        with self._lock:
+            try:
+                # Error replies come back as ordinary messages, unwrap_msg raises for them
+                return unwrap_msg(self._conn.send_and_get_reply(
+                    new_method_call(address, member, signature, body)))
+            except DBusErrorResponse as e:
+                raise SystemdError(f"{member} failed: {e.name}: {e.data}")
+
+    def _drain(self):
+        while self._signals:
+            _, job, _, result = self._signals.popleft().body
+            self._finished[job] = result
+
+    def wait_job(self, job, timeout=JOB_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                self._drain()
+                if job in self._finished:
+                    return self._finished.pop(job)
+                try:
+                    # Short reads so other threads get a turn at the socket
+                    msg = self._conn.recv_until_filtered(self._signals, timeout=0.1)
+                    _, path, _, result = msg.body
+                    self._finished[path] = result
+                except TimeoutError:
+                    pass
+            if time.monotonic() > deadline:
+                raise SystemdError(f"Timed out waiting for job {job}")
+
+    def close(self):
+        self._conn.close()
+
+
+class FakeBus(object):
+    # In-memory stand-in for the systemd bus, used by tests and benchmarks
+
+    def __init__(self):
+        self.calls = []
+        self.units = {}
+        self.reloads = 0
+        self._jobs = itertools.count(1)
+        self._finished = {}
+        self._lock = threading.Lock()
+
+    def call(self, path, interface, member, signature=None, body=(), destination=SYSTEMD_BUS_NAME):
+        with self._lock:
+            self.calls.append((member, tuple(body)))
+            if member == "ListMachines":
+                # Every active container service stands for a running machine
+                return ([(unit[len("container_"):-len(".service")], "container", "systemd-nspawn",
+                          f"{MACHINED_PATH}/machine/{unit}")
+                         for unit, state in sorted(self.units.items())
+                         if state == "active" and unit.startswith("container_") and unit.endswith(".service")],)
+            if member == "GetMachineAddresses":
+                # Pretend every machine got a lease in 10.0.0.0/8
+                digest = sum(body[0].encode("utf-8")) % 250 + 2
+                return ([(2, bytes([10, 0, 0, digest]))],)
+            if member in ("StartUnit", "StopUnit", "RestartUnit"):
+                unit = body[0]
+                self.units[unit] = "inactive" if member == "StopUnit" else "active"
+                job = f"{SYSTEMD_PATH}/job/{next(self._jobs)}"
+                self._finished[job] = "done"
+                return (job,)
+            if member == "Reload":
+                self.reloads += 1
+            return ()
+
+    def wait_job(self, job, timeout=JOB_TIMEOUT):
+        with self._lock:
+            return self._finished.pop(job)
+
+    def close(self):
+        pass
+
+
+class Manager(object):
+    def __init__(self, bus):
+        self._bus = bus
+
+    def _job(self, member, unit, wait):
+        with trace.span(member, "systemd", unit=unit, wait=wait):
+            job, = self._bus.call(SYSTEMD_PATH, MANAGER_INTERFACE,
+                                  member, "ss", (unit, "replace"))
+            if wait:
+                result = self._bus.wait_job(job)
+                if result != "done":
+                    raise SystemdError(
+                        f"Job for {unit} finished with result '{result}'.")
+        return job
+
+    def start_unit(self, unit, wait=True):
+        return self._job("StartUnit", unit, wait)
+
+    def stop_unit(self, unit, wait=True):
+        return self._job("StopUnit", unit, wait)
+
+    def restart_unit(self, unit, wait=True):
+        return self._job("RestartUnit", unit, wait)
+
+    def reload(self):
+        # Manager.Reload only replies once the reload has finished
+        with trace.span("Reload", "systemd"):
+            self._bus.call(SYSTEMD_PATH, MANAGER_INTERFACE, "Reload")
+
+    def set_limits(self, unit, changes, runtime=True):
+        # Applies to the live cgroup right away, no restart needed
+        self._bus.call(SYSTEMD_PATH, MANAGER_INTERFACE, "SetUnitProperties", "sba(sv)",
+                       (unit, runtime, limits.dbus_properties(changes)))
+
+    def list_machines(self):
+        # One round trip whatever the number of machines, uptimes come from the cgroups
+        machines, = self._bus.call(MACHINED_PATH, MACHINED_INTERFACE, "ListMachines",
+                                   destination=MACHINED_BUS_NAME)
+        return [{"name": name, "class": machine_class, "service": service}
+                for name, machine_class, service, _ in machines]
+
+    def machine_addresses(self, name):
+        addresses, = self._bus.call(MACHINED_PATH, MACHINED_INTERFACE, "GetMachineAddresses",
+                                    "s", (name,), destination=MACHINED_BUS_NAME)
+        return [str(ipaddress.ip_address(bytes(address))) for _, address in addresses]
+
+    def close(self):
+        self._bus.close()
+
+
+class SubprocessManager(object):
+    # Fallback that forks systemctl, for hosts without a usable D-Bus library
+
+    def _systemctl(self, *args):
+        result = trace.run(["systemctl", *args], capture_output=True)
+        if result.returncode != 0:
+            raise SystemdError(
+                f"systemctl {' '.join(args)} failed: {result.stderr.decode('utf-8').strip()}")
+
+    def start_unit(self, unit, wait=True):
+        self._systemctl("start", *([] if wait else ["--no-block"]), unit)
+
+    def stop_unit(self, unit, wait=True):
+        self._systemctl("stop", *([] if wait else ["--no-block"]), unit)
+
+    def restart_unit(self, unit, wait=True):
+        self._systemctl("restart", *([] if wait else ["--no-block"]), unit)
+
+    def reload(self):
+        self._systemctl("daemon-reload")
+
+    def set_limits(self, unit, changes, runtime=True):
+        self._systemctl("set-property", *(["--runtime"] if runtime else []),
+                        unit, *limits.assignments(changes))
+
+    def list_machines(self):
+        result = trace.run(["machinectl", "list", "--no-legend", "--no-pager"],
+                                capture_output=True)
+        if result.returncode != 0:
+            raise SystemdError(
+                f"machinectl list failed: {result.stderr.decode('utf-8').strip()}")
+        machines = []
+        for line in result.stdout.decode("utf-8").splitlines():
+            fields = line.split()
+            if len(fields) >= 3:
+                machines.append({"name": fields[0], "class": fields[1],
+                                 "service": fields[2]})
+        return machines
+
+    def machine_addresses(self, name):
+        result = trace.run(["machinectl", "status", "--no-pager", name],
+                                capture_output=True)
+        if result.returncode != 0:
+            raise SystemdError(
+                f"machinectl status failed: {result.stderr.decode('utf-8').strip()}")
+        addresses = []
+        in_addresses = False
+        # "Address: a" followed by indented continuation lines for more addresses
+        for line in result.stdout.decode("utf-8").splitlines():
+            key, sep, value = line.strip().partition(": ")
+            if sep and key == "Address":
+                in_addresses = True
+            elif sep or not in_addresses:
+                in_addresses = False
+                continue
+            else:
+                value = line
+            try:
+                addresses.append(str(ipaddress.ip_address(value.strip())))
+            except ValueError:
+                in_addresses = False
+        return addresses
+
+    def close(self):
+        pass
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def _create_manager(backend):
+    if backend == "fake":
+        return Manager(FakeBus())
+    if backend == "subprocess":
+        return SubprocessManager()
+    if backend == "dbus":
+        return Manager(_JeepneyBus())
+    if backend == "auto":
+        try:
+            return Manager(_JeepneyBus())
+        except ImportError:
+            logger.debug("jeepney not installed, falling back to systemctl.")
+        except (OSError, KeyError) as e:
+            logger.debug(f"System bus unavailable ({e}), falling back to systemctl.")
+        return SubprocessManager()
+    raise ValueError(f"Unknown systemd backend {backend}")
+
+
+def get_manager():
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            backend = os.getenv("LXNS_SYSTEMD_BACKEND") or config.get(
+                "systemd", "backend", fallback="auto")
+            _manager = _create_manager(backend)
+        return _manager
+
+
+def set_manager(manager):
+    global _manager
+    with _manager_lock:
+        _manager = manager
@@ -1,16 +1,172 @@
 import os
+import threading
 from string import Template as _Template
 
+from . import config
+from . import consts
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "templates")
+
+DEFAULT_SET = "default"
+
+# attribute -> (file, whether it has ${placeholders})
+_FILES = {
+    "nspawn": ("default.nspawn", True),
+    "sshd_socket": ("sshd.socket", True),
+    "sshd_service": ("sshd@.service", False),
+    "container_service": ("container-default.service", True),
+    "container_socket": ("container-default.socket", True),
+    "supervisor_service": ("lxns-supervisor.service", True),
+    "daemon_service": ("lxnsd.service", True),
+}
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class Registry(object):
+    # Compiled templates, cached per process until one of their source files changes.
+    #
+    # A file of set "debian" is looked up in <user>/debian, <package>/debian, <user>
+    # and <package>, first match wins. Fragments in <file>.d/ of any of these are
+    # appended in file name order, later directories replacing same-named fragments.
+
+    def __init__(self, dirs=None):
+        self._dirs = dirs
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def dirs(self):
+        if self._dirs is not None:
+            return self._dirs
+        return [config.get("templates", "dir", fallback=consts.TEMPLATE_DIR), PACKAGE_DIR]
+
+    def _search(self, template_set):
+        dirs = self.dirs()
+        if template_set == DEFAULT_SET:
+            return dirs
+        return [os.path.join(x, template_set) for x in dirs] + dirs
+
+    def _signature(self, search, filename):
+        # Stats only, a cache hit never reads a file
+        return tuple((_mtime(os.path.join(x, filename)), _mtime(os.path.join(x, f"{filename}.d")))
+                     for x in search)
+
+    def _load(self, search, filename, substitutes):
+        base = None
+        for directory in search:
+            path = os.path.join(directory, filename)
+            if os.path.isfile(path):
+                base = path
+                break
+        if base is None:
+            raise FileNotFoundError(f"Template {filename} not found in {', '.join(search)}.")
+        fragments = {}
+        for directory in reversed(search):
+            dropin = os.path.join(directory, f"{filename}.d")
+            if os.path.isdir(dropin):
+                for entry in os.listdir(dropin):
+                    if entry.endswith(".conf"):
+                        fragments[entry] = os.path.join(dropin, entry)
+        parts = []
+        # Fragment mtimes join the signature, editing one in place must invalidate too
+        stamps = []
+        for path in [base] + [fragments[x] for x in sorted(fragments)]:
+            with open(path) as f:
+                content = f.read()
+                stamps.append((path, os.fstat(f.fileno()).st_mtime_ns))
+            parts.append(content if content.endswith("\n") or not content else content + "\n")
+        content = "".join(parts)
+        return (_Template(content) if substitutes else content), tuple(stamps)
+
+    def get(self, template_set, filename, substitutes=True):
+        search = self._search(template_set)
+        key = (template_set, filename, substitutes)
+        signature = self._signature(search, filename)
+        with self._lock:
+            cached = self._cache.get(key)
+        if cached is not None:
+            cached_signature, stamps, value = cached
+            if cached_signature == signature and all(_mtime(path) == mtime for path, mtime in stamps):
+                return value
+        value, stamps = self._load(search, filename, substitutes)
+        with self._lock:
+            self._cache[key] = (signature, stamps, value)
+        return value
+
+    def sets(self):
+        found = {DEFAULT_SET}
+        for directory in self.dirs():
+            if os.path.isdir(directory):
+                found.update(x for x in os.listdir(directory)
+                             if os.path.isdir(os.path.join(directory, x)) and not x.endswith(".d"))
+        return sorted(found)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+registry = Registry()
+
+_image_sets = {}
+_image_sets_lock = threading.Lock()
+
+
+def _os_release_id(image):
+    from . import images
+
+    for lower in images.lowerdirs(image):
+        for path in ("etc/os-release", "usr/lib/os-release"):
+            path = os.path.join(lower, path)
+            # An absolute link would resolve against the host
+            if os.path.islink(path) and os.readlink(path).startswith("/"):
+                continue
+            try:
+                with open(path) as f:
+                    for line in f:
+                        key, _, value = line.strip().partition("=")
+                        if key == "ID":
+                            return value.strip("\"'")
+            except FileNotFoundError:
+                continue
+    return None
+
+
+def set_for_image(image):
+    # [image:<name>] templates wins, then the image manifest, then the image's os-release ID
+    from . import images
+
+    configured = config.get(f"image:{image}", "templates")
+    if configured:
+        return configured
+    manifest = images.read_manifest(image) or {}
+    if manifest.get("templates"):
+        return manifest["templates"]
+    # Restaging an image under the same name changes its layers
+    stamp = tuple(manifest.get("layers", []))
+    with _image_sets_lock:
+        cached = _image_sets.get(image)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    distro = _os_release_id(image)
+    template_set = distro if distro in registry.sets() else DEFAULT_SET
+    with _image_sets_lock:
+        _image_sets[image] = (stamp, template_set)
+    return template_set
+
 
 class Template:
-    def __init__(self):
-        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "templates/default.nspawn")) as f:
-            self.nspawn = _Template(f.read())
-        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "templates/sshd.socket")) as f:
-            self.sshd_socket = _Template(f.read())
-        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "templates/sshd@.service")) as f:
-            self.sshd_service = f.read()
-        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "templates/container-default.service")) as f:
-            self.container_service = _Template(f.read())
-        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "templates/container-default.socket")) as f:
-            self.container_socket = _Template(f.read())
+    def __init__(self, template_set=DEFAULT_SET):
+        self.template_set = template_set
+
+    def __getattr__(self, name):
+        try:
+            filename, substitutes = _FILES[name]
+        except KeyError:
+            raise AttributeError(name) from None
+        return registry.get(self.template_set, filename, substitutes)
@@ -0,0 +1,252 @@
+import json
+import os
+import subprocess
+import threading
+import time
+
+from loguru import logger
+
+from . import consts
+
+# Kept with each span, failed commands are what traces get read for
+STDERR_LIMIT = 2000
+
+_lock = threading.Lock()
+# Finished spans while recording, None otherwise. Process-wide rather than per context:
+# steps run on batch and executor threads, which don't inherit contextvars.
+_spans = None
+
+
+class _Span(object):
+    __slots__ = ("name", "cat", "args", "_start", "_t0")
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self._start = time.time()
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self._t0
+        # fire exits with 0 after --help, that isn't a failure
+        if exc_type is not None and not (issubclass(exc_type, SystemExit) and not exc_value.code):
+            self.args.setdefault("error", f"{exc_type.__name__}: {exc_value}")
+        record = {
+            "name": self.name,
+            "cat": self.cat,
+            "start": self._start,
+            "duration": duration,
+            "pid": os.getpid(),
+            "tid": threading.get_native_id(),
+            "args": self.args,
+        }
+        with _lock:
+            if _spans is not None:
+                _spans.append(record)
+        return False
+
+
+class _NullSpan(object):
+    # What span() hands out while not recording, costs an attribute lookup
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL = _NullSpan()
+
+
+def enabled():
+    return _spans is not None
+
+
+def span(name, cat="lxns", **args):
+    if _spans is None:
+        return _NULL
+    return _Span(name, cat, args)
+
+
+def start():
+    global _spans
+    with _lock:
+        _spans = []
+
+
+def stop():
+    global _spans
+    with _lock:
+        spans, _spans = _spans, None
+    return spans or []
+
+
+def _command_name(command):
+    # "systemctl daemon-reload", "machinectl status", but "tar" rather than "tar --numeric-owner"
+    name = os.path.basename(str(command[0]))
+    if len(command) > 1:
+        arg = str(command[1])
+        if arg[:1].isalpha() and "/" not in arg:
+            name += f" {arg}"
+    return name
+
+
+def _stderr(value):
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", "replace")
+    return value.strip()[-STDERR_LIMIT:] if value else None
+
+
+def run(command, **kwargs):
+    # subprocess.run, recorded with its exit code and captured stderr
+    with span(_command_name(command), "exec", argv=[str(x) for x in command]) as s:
+        try:
+            result = subprocess.run(command, **kwargs)
+        except subprocess.CalledProcessError as e:
+            s.set(exit=e.returncode)
+            if _stderr(e.stderr):
+                s.set(stderr=_stderr(e.stderr))
+            raise
+        s.set(exit=result.returncode)
+        if _stderr(result.stderr):
+            s.set(stderr=_stderr(result.stderr))
+    return result
+
+
+def parse_flag(argv):
+    # Strips --trace / --trace=PATH. Returns the rest and the path, "" for the default
+    # one or None when tracing wasn't asked for.
+    path = None
+    rest = []
+    for arg in argv:
+        if arg == "--trace":
+            path = ""
+        elif arg.startswith("--trace="):
+            path = arg[len("--trace="):]
+        else:
+            rest.append(arg)
+    return rest, path
+
+
+def default_path(command):
+    # The command name comes from the client, keep it from leaving TRACE_DIR
+    command = "".join(x if x.isalnum() or x in "_-" else "_" for x in command or "lxns")
+    return os.path.join(
+        consts.TRACE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{command}.jsonl")
+
+
+def to_chrome(spans):
+    # Complete ("X") events in microseconds, loadable in chrome://tracing and Perfetto
+    return {"traceEvents": [{
+        "name": x["name"],
+        "cat": x["cat"],
+        "ph": "X",
+        "ts": x["start"] * 1e6,
+        "dur": x["duration"] * 1e6,
+        "pid": x["pid"],
+        "tid": x["tid"],
+        "args": x["args"],
+    } for x in spans], "displayTimeUnit": "ms"}
+
+
+def save(spans, path):
+    # .json gets the Chrome trace format, anything else JSON lines
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with open(path, mode="w") as f:
+        if path.endswith(".json"):
+            json.dump(to_chrome(spans), f)
+        else:
+            for record in spans:
+                f.write(json.dumps(record) + "\n")
+
+
+def finish(path, command):
+    spans = stop()
+    path = path or default_path(command)
+    try:
+        save(spans, path)
+    except OSError as e:
+        logger.warning(f"Couldn't write trace to {path}: {e}")
+        return None
+    logger.info(f"Trace of {len(spans)} span(s) written to {path}.")
+    return path
+
+
+def load(path):
+    with open(path) as f:
+        content = f.read()
+    if content.startswith("{\"traceEvents\""):
+        return [{
+            "name": x["name"],
+            "cat": x.get("cat"),
+            "start": x["ts"] / 1e6,
+            "duration": x["dur"] / 1e6,
+            "pid": x.get("pid"),
+            "tid": x.get("tid"),
+            "args": x.get("args", {}),
+        } for x in json.loads(content)["traceEvents"] if x.get("ph") == "X"]
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def files():
+    if not os.path.isdir(consts.TRACE_DIR):
+        return []
+    return sorted(os.path.join(consts.TRACE_DIR, x) for x in os.listdir(consts.TRACE_DIR)
+                  if x.endswith(".jsonl") or x.endswith(".json"))
+
+
+def _percentile(values, percent):
+    # Nearest rank on sorted values
+    index = max(0, -(-len(values) * percent // 100) - 1)
+    return values[int(index)]
+
+
+def stats(spans):
+    # Per span name across every run given, slowest total first
+    durations = {}
+    for record in spans:
+        durations.setdefault((record["cat"], record["name"]), []).append(record["duration"])
+    rows = []
+    for (cat, name), values in durations.items():
+        values.sort()
+        rows.append({
+            "name": name,
+            "cat": cat,
+            "count": len(values),
+            "p50": _percentile(values, 50),
+            "p90": _percentile(values, 90),
+            "p99": _percentile(values, 99),
+            "max": values[-1],
+            "total": sum(values),
+        })
+    rows.sort(key=lambda x: x["total"], reverse=True)
+    return rows
+
+
+def _ms(value):
+    return f"{value * 1000:.1f}ms"
+
+
+# (key, header, formatter) like status.LIST_COLUMNS
+STATS_COLUMNS = [
+    ("name", "Span", str),
+    ("cat", "Category", str),
+    ("count", "Count", str),
+    ("p50", "p50", _ms),
+    ("p90", "p90", _ms),
+    ("p99", "p99", _ms),
+    ("max", "Max", _ms),
+    ("total", "Total", _ms),
+]
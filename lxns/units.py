@@ -0,0 +1,91 @@
+import os
+import threading
+from contextlib import contextmanager
+
+from . import systemd
+from . import trace
+
+
+class UnitTransaction(object):
+    # Buffers unit file writes and removals, applying them with one daemon-reload
+
+    def __init__(self, parent=None):
+        self._parent = parent
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def write(self, path, content):
+        with self._lock:
+            self._pending[path] = content
+
+    def remove(self, path):
+        with self._lock:
+            self._pending[path] = None
+
+    def _merge(self, pending):
+        with self._lock:
+            self._pending.update(pending)
+
+    def rollback(self):
+        with self._lock:
+            self._pending.clear()
+
+    def commit(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if self._parent is not None:
+            # Nested scopes only hand their changes up to the outermost transaction
+            self._parent._merge(pending)
+            return False
+        changed = False
+        with trace.span("write units", "fs", units=len(pending)):
+            for path, content in sorted(pending.items()):
+                if content is None:
+                    if os.path.lexists(path):
+                        os.remove(path)
+                        changed = True
+                elif _write_if_changed(path, content):
+                    changed = True
+        if changed:
+            systemd.get_manager().reload()
+        return changed
+
+
+def _write_if_changed(path, content):
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.lxns-tmp"
+    with open(tmp, mode="w") as f:
+        f.write(content)
+    os.replace(tmp, path)
+    return True
+
+
+_current = None
+_current_lock = threading.Lock()
+
+
+@contextmanager
+def transaction():
+    global _current
+    with _current_lock:
+        outer = _current is None
+        txn = UnitTransaction(None if outer else _current)
+        if outer:
+            _current = txn
+    try:
+        yield txn
+    except BaseException:
+        txn.rollback()
+        raise
+    else:
+        txn.commit()
+    finally:
+        if outer:
+            with _current_lock:
+                _current = None
@@ -1,17 +1,12 @@
 #!/bin/python
 import os
-import socket
 import subprocess
 
-from contextlib import closing
-
 from . import consts
-
-
-def get_free_port():
-    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
-        s.bind(('', 0))  # pylint: disable=no-member
-        return s.getsockname()[1]  # pylint: disable=no-member
+from . import images
+from . import locks
+from . import mounts
+from . import shadow
 
 
 def mkdir(path, safe=True):
@@ -34,8 +29,13 @@ def remove(path):
         pass
 
 
+def container_lock(name):
+    # Serialize operations on one container across threads and processes
+    return locks.file_lock(f"container-{name}")
+
+
 def overlay_mount_with_name(name, image):
-    overlay_mount(os.path.join(consts.IMAGE_DIR, image), os.path.join(consts.MACHINE_DIR, name), os.path.join(consts.WORK_DIR, name), os.path.join(consts.SYSTEMD_MOUNTPOINT, name))
+    overlay_mount(images.lowerdirs(image), os.path.join(consts.MACHINE_DIR, name), os.path.join(consts.WORK_DIR, name), os.path.join(consts.SYSTEMD_MOUNTPOINT, name))
 
 
 def overlay_unmount_with_name(name):
@@ -43,39 +43,21 @@ def overlay_unmount_with_name(name):
 
 
 def overlay_mount(lowerdir, upperdir, workdir, mountpoint):
-    [lower, upper, work, mnt] = map(lambda x: os.path.abspath(
-        x), [lowerdir, upperdir, workdir, mountpoint])
-    subprocess.run(["mount", "-t", "overlay", "overlay", "-o",
-                    f"lowerdir={lower},upperdir={upper},workdir={work}", mnt])
+    mounts.overlay_mount(lowerdir, upperdir, workdir, mountpoint)
 
 
 def overlay_unmount(mountpoint):
-    subprocess.run(["umount", mountpoint])
+    if mounts.is_mounted(mountpoint):
+        mounts.umount(mountpoint)
 
 
-def container_boot(rootdir):
-    subprocess.run(["systemd-nspawn", "-b", "-D", rootdir])
-
-
-def os_install(rootdir, ostype):
-    if ostype == "arch":
-        subprocess.run(["pacstrap", "-c", "-i", rootdir, "base",
-                        "base-devel", "openssh", "--ignore", "linux,linux-firmware"])
-        if not os.path.exists(os.path.join(rootdir, "bin/sudo")):
-            raise OSError("OS installation failed")
-    else:
-        raise ValueError("OS type not supported")
+def is_mounted(path):
+    return mounts.is_mounted(path)
 
 
-def post_os_install(rootdir):
-    subprocess.run(["systemd-nspawn", "-D", rootdir,
-                    "systemctl", "enable", "systemd-networkd"])
-    with open(os.path.join(rootdir, "etc/securetty"), mode="a") as f:
-        f.write("pts/0")
-    with open(os.path.join(rootdir, "etc/ssh/sshd_config"), mode="a") as f:
-        f.write("PermitRootLogin yes")
+def container_boot(rootdir):
+    subprocess.run(["systemd-nspawn", "-b", "-D", rootdir])
 
 
-def change_pass(rootdir, username, passwd):
-    subprocess.run(["chpasswd", "-R", rootdir],
-                   input=f"{username}:{passwd}".encode("utf-8"))
+def change_pass(rootdir, username, passwd, lowers=()):
+    shadow.set_password(rootdir, username, passwd, lowers)
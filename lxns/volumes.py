@@ -0,0 +1,198 @@
+import os
+import re
+
+from . import config
+from . import consts
+
+# Spec key -> .nspawn [Files] setting. A spec maps each key to a list of entries:
+#   bind, bind_ro   HOST[:GUEST], the host path must exist
+#   tmpfs           GUEST[:SIZE]
+#   cache           NAME:GUEST, a directory under VOLUME_DIR shared by every container naming it
+SETTINGS = {
+    "bind": "Bind",
+    "bind_ro": "BindReadOnly",
+    "tmpfs": "TemporaryFileSystem",
+    "cache": "Bind",
+}
+
+# What the packaged default.nspawn templates bound into every container before volumes
+# existed, per template set. Containers indexed back then keep them.
+LEGACY = {
+    "default": {"bind": "/var/cache/pacman/pkg /dev/nvidia0 /dev/nvidiactl /dev/nvidia-uvm "
+                        "/dev/nvidia-uvm-tools"},
+    "debian": {"bind": "/var/cache/apt/archives"},
+}
+
+_NAME = re.compile(r"^[a-z0-9][a-z0-9_.-]*$")
+_SIZE = re.compile(r"^(\d+[KMGT]?|\d+%)$", re.IGNORECASE)
+
+# Guest paths nspawn manages itself
+_RESERVED = ("/proc", "/sys")
+
+
+class VolumeError(ValueError):
+    pass
+
+
+def _path(value, what):
+    if not value.startswith("/"):
+        raise VolumeError(f"{what} {value} isn't an absolute path.")
+    if ".." in value.split("/"):
+        raise VolumeError(f"{what} {value} mustn't contain '..'.")
+    path = os.path.normpath(value)
+    # normpath keeps a leading "//"
+    return "/" + path.lstrip("/")
+
+
+def _guest(value):
+    path = _path(value, "Guest path")
+    if path == "/" or any(path == x or path.startswith(x + "/") for x in _RESERVED):
+        raise VolumeError(f"Can't mount over {path}.")
+    return path
+
+
+def _bind(value):
+    host, _, guest = value.partition(":")
+    host = _path(host, "Host path")
+    return f"{host}:{_guest(guest or host)}"
+
+
+def _tmpfs(value):
+    guest, _, size = value.partition(":")
+    guest = _guest(guest)
+    if not size:
+        return guest
+    if not _SIZE.match(size):
+        raise VolumeError(f"Invalid tmpfs size {size}.")
+    return f"{guest}:{size.upper()}"
+
+
+def _cache(value):
+    name, sep, guest = value.partition(":")
+    if not sep or not _NAME.match(name):
+        raise VolumeError(f"Cache volume {value} must be NAME:GUEST with a lowercase name.")
+    return f"{name}:{_guest(guest)}"
+
+
+_PARSERS = {
+    "bind": _bind,
+    "bind_ro": _bind,
+    "tmpfs": _tmpfs,
+    "cache": _cache,
+}
+
+
+def _entries(value):
+    # Fire hands over "a,b" as a tuple, config values are whitespace separated
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return value.split()
+    return [str(x) for x in value]
+
+
+def parse(**options):
+    spec = {}
+    for key, value in options.items():
+        if key not in SETTINGS:
+            raise VolumeError(f"Unknown volume type {key}.")
+        entries = [_PARSERS[key](x) for x in _entries(value)]
+        if entries:
+            spec[key] = entries
+    return merge(spec)
+
+
+def guest_path(key, entry):
+    if key == "tmpfs":
+        return entry.partition(":")[0]
+    return entry.partition(":")[2]
+
+
+def merge(*specs):
+    # Later specs win per guest path, so a container can override its image's /tmp size
+    by_guest = {}
+    for spec in specs:
+        for key in SETTINGS:
+            for entry in spec.get(key, []):
+                by_guest[guest_path(key, entry)] = (key, entry)
+    result = {}
+    for guest in sorted(by_guest):
+        key, entry = by_guest[guest]
+        result.setdefault(key, []).append(entry)
+    return result
+
+
+def _configured(section):
+    try:
+        return parse(**{key: config.get(section, key) for key in SETTINGS})
+    except VolumeError as e:
+        raise VolumeError(f"[{section}]: {e}") from e
+
+
+def for_image(image):
+    # [volumes] applies to every container, [image:<name>] to those of one image
+    return merge(_configured("volumes"), _configured(f"image:{image}"))
+
+
+def legacy(template_set):
+    # Sources the host doesn't have are dropped, nspawn would refuse to boot over them
+    spec = parse(**LEGACY.get(template_set, LEGACY["default"]))
+    for key in list(spec):
+        spec[key] = [x for x in spec[key] if os.path.exists(x.partition(":")[0])]
+        if not spec[key]:
+            del spec[key]
+    return spec
+
+
+def cache_path(name):
+    return os.path.join(consts.VOLUME_DIR, name)
+
+
+def check(spec):
+    # Host side, at create time: what nspawn would otherwise only report at boot
+    for key in ("bind", "bind_ro"):
+        for entry in spec.get(key, []):
+            host = entry.partition(":")[0]
+            if not os.path.exists(host):
+                raise VolumeError(f"Bind source {host} doesn't exist.")
+
+
+def prepare(spec):
+    for entry in spec.get("cache", []):
+        os.makedirs(cache_path(entry.partition(":")[0]), mode=0o755, exist_ok=True)
+
+
+def mountpoints(spec):
+    # Guest directories to create ahead of time. Device and file binds are left to nspawn.
+    result = []
+    for key in SETTINGS:
+        for entry in spec.get(key, []):
+            guest = guest_path(key, entry)
+            if guest.startswith("/dev/"):
+                continue
+            if key in ("bind", "bind_ro") and not os.path.isdir(entry.partition(":")[0]):
+                continue
+            result.append(guest)
+    return result
+
+
+def render(spec):
+    # Appended to the .nspawn file, systemd merges repeated sections
+    if not spec:
+        return ""
+    lines = ["", "# Generated by lxns from the container's volumes", "[Files]"]
+    for key in SETTINGS:
+        for entry in spec.get(key, []):
+            if key == "cache":
+                name, _, guest = entry.partition(":")
+                entry = f"{cache_path(name)}:{guest}"
+            elif key == "tmpfs" and ":" in entry:
+                guest, _, size = entry.partition(":")
+                entry = f"{guest}:size={size}"
+            lines.append(f"{SETTINGS[key]}={entry}")
+    return "\n".join(lines) + "\n"
+
+
+def describe(spec):
+    # (type, entry) rows for lxns info
+    return [(key, entry) for key in SETTINGS for entry in spec.get(key, [])]
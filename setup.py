@@ -15,7 +15,7 @@ setup(
         'lxns',
     ],
     package_data={
-        "lxns": ["templates/*"]
+        "lxns": ["templates/*", "templates/*/*"]
     },
     url='https://github.com/PhotonQuantum/lxns',
     keywords=['container'],
@@ -31,9 +31,13 @@ setup(
         'loguru',
         'python-slugify'
     ],
+    extras_require={
+        'dbus': ['jeepney'],
+    },
     entry_points={
         'console_scripts': [
             "lxns=lxns.__main__:main",
+            "lxnsd=lxns.daemon:main",
         ]
     },
 )
@@ -0,0 +1,40 @@
+import threading
+
+import pytest
+
+from lxns import systemd
+
+jeepney = pytest.importorskip("jeepney")
+
+
+class StubConnection(object):
+    # Answers every method call with the reply built by respond(call)
+
+    def __init__(self, respond):
+        self._respond = respond
+
+    def send_and_get_reply(self, msg):
+        return self._respond(msg)
+
+
+def make_bus(respond):
+    bus = systemd._JeepneyBus.__new__(systemd._JeepneyBus)
+    bus._conn = StubConnection(respond)
+    bus._lock = threading.Lock()
+    return bus
+
+
+def test_call_returns_reply_body():
+    bus = make_bus(lambda msg: jeepney.new_method_return(msg, "o", ("/org/freedesktop/systemd1/job/1",)))
+    assert bus.call(systemd.SYSTEMD_PATH, systemd.MANAGER_INTERFACE, "StartUnit", "ss",
+                    ("container_x.service", "replace")) == ("/org/freedesktop/systemd1/job/1",)
+
+
+def test_call_raises_on_error_reply():
+    bus = make_bus(lambda msg: jeepney.new_error(
+        msg, "org.freedesktop.systemd1.NoSuchUnit", "s", ("Unit container_x.service not found.",)))
+    manager = systemd.Manager(bus)
+    with pytest.raises(systemd.SystemdError, match="NoSuchUnit"):
+        manager.start_unit("container_x.service")
+    with pytest.raises(systemd.SystemdError, match="NoSuchUnit"):
+        manager.reload()